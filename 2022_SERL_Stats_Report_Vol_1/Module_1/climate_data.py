@@ -0,0 +1,197 @@
+"""
+Climate data ingestion (step 2)
+
+Reads the monthly serl_climate_data files for a year and holds the hourly
+temperatures as one dense grid_cell x hour array (ClimateData), from which the
+hourly, half-hourly and daily temperature products are made.
+
+The monthly files are read in parallel, one per worker process, each in
+chunks that are cut down to the grid cells needed as they are read, so only
+the rows kept are ever held in memory. The months are put together once,
+rather than appended to a growing dataframe one month at a time.
+
+The array is cached (as .npz, with a json description beside it) in
+locations.climate_cache_directory, or in a Climate_cache directory in the
+working directory if that isn't set - never in the SERL data tree. The cache is keyed on serl_data_version, the months and grid cells read,
+and the size and modification time of each monthly file, so reading the same
+year again - e.g. re-running the temperature notebook - doesn't parse the csvs
+again, and a new edition of the data is read afresh.
+"""
+import os
+import json
+import hashlib
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import locations # This is a separate Python script specifying the locations of all the different SERL data within the SERL secure environment.
+
+DEFAULT_CLIMATE_REGEXP = 'serl_climate_data_YYYY_MM_edition04.csv'
+CHUNK_ROWS = 1000000
+DEFAULT_CACHE_DIRECTORY = 'Climate_cache'
+KELVIN = 273.15
+
+
+def year_months(year, next_january=True):
+    '''The YYYY_MM of each month of year, and of January of the following year if next_january (we need one data
+    point for each grid_cell from 1st Jan of the following year - set to False if that file is not available in the
+    data release).'''
+    months = [str(year)+'_'+str(month).zfill(2) for month in range(1, 13)]
+    if next_january:
+        months.append(str(int(year)+1)+'_01')
+    return months
+
+
+def climate_file(year_month):
+    '''The path of the climate data file for year_month (YYYY_MM).'''
+    regexp = getattr(locations, 'climate_regexp', DEFAULT_CLIMATE_REGEXP)
+    year, month = year_month.split('_')
+    filename = regexp.replace('YYYY', year).replace('MM', month)
+    return os.path.join(locations.serl_data_path, locations.climate_directory, filename)
+
+
+def read_climate_file(path, grid_cells, chunk_rows=CHUNK_ROWS):
+    '''Read the hourly temperatures (grid_cell, date_time_utc, 2m_temperature_K) of grid_cells from one climate data
+    file, dropping the other grid cells chunk by chunk as the file is read.'''
+    grid_cells = set(grid_cells)
+    chunks = []
+    with pd.read_csv(path, index_col=False, usecols=['grid_cell', 'date_time_utc', '2m_temperature_K'],
+                     dtype={'grid_cell': str}, chunksize=chunk_rows) as reader:
+        for chunk in reader:
+            chunks.append(chunk[chunk.grid_cell.isin(grid_cells)])
+    data = pd.concat(chunks, ignore_index=True)
+    data['date_time_utc'] = pd.to_datetime(data.date_time_utc)
+    return data
+
+
+class ClimateData(object):
+    """Hourly temperatures for a list of grid cells, as a dense grid_cell x time array. present marks the grid_cell
+    and time combinations that were in the climate data files (temp_K is Nan where they weren't)."""
+
+    def __init__(self, grid_cells, times, temp_K, present, n_duplicates=0):
+        self.grid_cells = list(grid_cells)
+        self.times = pd.DatetimeIndex(times)
+        self.temp_K = temp_K
+        self.present = present
+        self.n_duplicates = n_duplicates
+
+    @classmethod
+    def from_frame(cls, data, grid_cells):
+        '''Put long hourly data (grid_cell, date_time_utc, 2m_temperature_K) into a dense array, with a row for each
+        of grid_cells (in that order) and a column for each time in the data (in time order).'''
+        times = pd.DatetimeIndex(np.unique(data.date_time_utc.values))
+        rows = pd.Index(grid_cells).get_indexer(data.grid_cell)
+        cols = times.get_indexer(data.date_time_utc)
+        temp_K = np.full((len(grid_cells), len(times)), np.nan)
+        present = np.zeros((len(grid_cells), len(times)), dtype=bool)
+        temp_K[rows, cols] = data['2m_temperature_K'].values
+        present[rows, cols] = True
+        # The data files shouldn't hold any grid_cell and time twice, but if they do only one is kept
+        n_duplicates = len(data.index) - int(present.sum())
+        return cls(grid_cells, times, temp_K, present, n_duplicates)
+
+    @property
+    def temp_C(self):
+        return self.temp_K - KELVIN
+
+    def hourly(self):
+        '''The hourly data, indexed by grid_cell and date_time_utc, with columns 2m_temperature_K and temp_C.'''
+        rows, cols = np.nonzero(self.present)
+        index = pd.MultiIndex.from_arrays([np.asarray(self.grid_cells, dtype=object)[rows], self.times[cols]],
+                                          names=['grid_cell', 'date_time_utc'])
+        return pd.DataFrame({'2m_temperature_K': self.temp_K[rows, cols],
+                             'temp_C': self.temp_C[rows, cols]}, index=index)
+
+    def half_hourly(self, index_start_date, index_end_date):
+        '''temp_C every half hour from index_start_date to index_end_date (UTC, both included) for every grid cell,
+        indexed by grid_cell then date_time_utc. Half-hours between the hourly values take the value before them;
+        any other gaps are left as Nan.'''
+        date_time_index_new = pd.date_range(index_start_date, index_end_date, freq='30T')
+        hourly_cols = self.times.get_indexer(date_time_index_new)
+        temp_C = np.full((len(self.grid_cells), len(date_time_index_new)), np.nan)
+        found = hourly_cols >= 0
+        temp_C[:, found] = self.temp_C[:, hourly_cols[found]]
+        # Forward fill one step along the whole column (grid cell after grid cell), as fillna(method='ffill', limit=1)
+        temp_C = temp_C.ravel()
+        fill = np.r_[False, np.isnan(temp_C[1:]) & ~np.isnan(temp_C[:-1])]
+        temp_C[fill] = temp_C[np.flatnonzero(fill)-1]
+        index = pd.MultiIndex.from_product([self.grid_cells, date_time_index_new], names=['grid_cell', 'date_time_utc'])
+        return pd.DataFrame({'temp_C': temp_C}, index=index)
+
+    def daily(self):
+        '''The daily mean, maximum and minimum of temp_C (mean_temp_C, T_X, T_N) and T_M, the mean of T_X and T_N, per
+        grid_cell and Read_date_effective_local (the UK local date of each hour), indexed by both.'''
+        local_dates = self.times.tz_localize(tz='UTC').tz_convert(tz='Europe/London').date
+        date_codes, dates = pd.factorize(local_dates, sort=True)
+        rows, cols = np.nonzero(self.present)
+        values = pd.DataFrame({'grid_cell': rows, 'Read_date_effective_local': date_codes[cols],
+                               'temp_C': self.temp_C[rows, cols]})
+        daily = values.groupby(by=['grid_cell', 'Read_date_effective_local']).temp_C.agg(['mean', 'max', 'min'])
+        daily.rename(columns={'mean': 'mean_temp_C', 'max': 'T_X', 'min': 'T_N'}, inplace=True)
+        daily['T_M'] = (daily.T_X + daily.T_N)/2
+        daily.index = pd.MultiIndex.from_arrays([np.asarray(self.grid_cells, dtype=object)[daily.index.get_level_values(0)],
+                                                 np.asarray(dates, dtype=object)[daily.index.get_level_values(1)]],
+                                                names=['grid_cell', 'Read_date_effective_local'])
+        return daily.sort_index()
+
+    def save(self, path):
+        np.savez(path, grid_cells=np.asarray(self.grid_cells, dtype=str), times=self.times.values,
+                 temp_K=self.temp_K, present=self.present, n_duplicates=self.n_duplicates)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            return cls(f['grid_cells'].tolist(), f['times'], f['temp_K'], f['present'], int(f['n_duplicates']))
+
+
+def _cache_description(paths, grid_cells):
+    # What the cached array was made from - it's only used if all of this still matches
+    return {'serl_data_version': locations.serl_data_version,
+            'files': [{'path': os.path.abspath(path),
+                       'size_bytes': os.path.getsize(path),
+                       'mtime': os.path.getmtime(path)} for path in paths],
+            'grid_cells': list(grid_cells)}
+
+
+def cache_paths(months, grid_cells, cache_directory=None):
+    '''Where the array for these months and grid cells, and its json description, are cached.'''
+    if cache_directory is None:
+        cache_directory = getattr(locations, 'climate_cache_directory', None)
+    if cache_directory is None:
+        cache_directory = DEFAULT_CACHE_DIRECTORY
+    key = hashlib.sha1(json.dumps([str(locations.serl_data_version), months, list(grid_cells)]).encode()).hexdigest()[:10]
+    stem = os.path.join(cache_directory, 'serl_climate_data_'+months[0]+'_to_'+months[-1]+'.cache_'+key)
+    return stem+'.npz', stem+'.json'
+
+
+def read_climate(months, grid_cells, n_workers=None, cache=True, cache_directory=None):
+    '''Read the climate data files for months (a list of YYYY_MM - see year_months) for grid_cells, in parallel, and
+    return them as ClimateData. With cache, the result is read from (or saved to) the climate cache.'''
+    paths = [climate_file(month) for month in months]
+    if cache:
+        array_path, description_path = cache_paths(months, grid_cells, cache_directory)
+        if os.path.exists(array_path) and os.path.exists(description_path):
+            with open(description_path) as f:
+                if json.load(f) == json.loads(json.dumps(_cache_description(paths, grid_cells))):
+                    print("Climate data read from the cache:", array_path)
+                    return ClimateData.load(array_path)
+    if n_workers is None:
+        n_workers = os.cpu_count()
+    if n_workers <= 1 or len(paths) <= 1:
+        frames = [read_climate_file(path, grid_cells) for path in paths]
+    else:
+        with ProcessPoolExecutor(max_workers=min(n_workers, len(paths))) as pool:
+            frames = list(pool.map(read_climate_file, paths, [grid_cells]*len(paths)))
+    climate = ClimateData.from_frame(pd.concat(frames, ignore_index=True), grid_cells)
+    if cache:
+        try:
+            if not os.path.exists(os.path.dirname(array_path)):
+                os.makedirs(os.path.dirname(array_path))
+            climate.save(array_path)
+            with open(description_path, 'w') as f:
+                json.dump(_cache_description(paths, grid_cells), f)
+        except OSError as e:
+            warnings.warn("Couldn't write the climate cache to "+os.path.abspath(os.path.dirname(array_path))+" ("+str(e)
+                          + ") - the files will be read again next time. Set climate_cache_directory in locations.py "
+                          "to a writable directory.")
+    return climate
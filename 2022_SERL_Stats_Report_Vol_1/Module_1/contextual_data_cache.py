@@ -0,0 +1,89 @@
+"""
+Cache for the SERL contextual data files
+
+The participant summary, survey, EPC and read type files are read by the data
+picker, Module 2 and Module 3, several times per run of the pipeline. This
+parses each csv once and keeps the typed dataframe as parquet (or pickle, if a
+column can't be stored as parquet) next to the source file, or in
+locations.contextual_cache_directory if that is set. A small json file beside
+the cache records the source file's size, modification time and sha1 hash, so
+the cache is rebuilt whenever the source file changes.
+"""
+import os
+import json
+import hashlib
+from pathlib import Path
+import pandas as pd
+import locations # This is a separate Python script specifying the locations of all the different SERL data within the SERL secure environment.
+
+# Parse each file in one go, so every column gets a single consistent type (the survey file needs this)
+DEFAULT_READ_CSV_KWARGS = {'low_memory': False}
+
+
+def file_sha1(path):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def cache_paths(path, read_csv_kwargs, cache_directory=None):
+    '''Where the cached copy of path and its json description are kept. Different read_csv arguments give
+    differently typed frames, so they're cached separately.'''
+    if cache_directory is None:
+        cache_directory = getattr(locations, 'contextual_cache_directory', None)
+    if cache_directory is None:
+        cache_directory = os.path.dirname(os.path.abspath(path))
+    kwargs_key = hashlib.sha1(json.dumps(read_csv_kwargs, sort_keys=True, default=str).encode()).hexdigest()[:10]
+    stem = os.path.join(cache_directory, Path(path).stem+'.cache_'+kwargs_key)
+    return stem, stem+'.json'
+
+
+def _source_unchanged(path, description):
+    stat = os.stat(path)
+    if stat.st_size != description['source_size_bytes']:
+        return False
+    if stat.st_mtime == description['source_mtime']:
+        return True
+    # Same size but touched since (e.g. copied) - only rebuild if the contents have actually changed
+    return file_sha1(path) == description['source_sha1']
+
+
+def read_contextual(path, cache_directory=None, **read_csv_kwargs):
+    '''Return the contextual data file at path as a dataframe, from the cache if the source hasn't changed
+    since it was cached, otherwise parsing the csv (with read_csv_kwargs) and caching the result.'''
+    kwargs = dict(DEFAULT_READ_CSV_KWARGS)
+    kwargs.update(read_csv_kwargs)
+    stem, description_path = cache_paths(path, kwargs, cache_directory)
+    if os.path.exists(description_path):
+        with open(description_path) as f:
+            description = json.load(f)
+        if os.path.exists(stem+'.'+description['format']) and _source_unchanged(path, description):
+            if description['format'] == 'parquet':
+                return pd.read_parquet(stem+'.parquet')
+            return pd.read_pickle(stem+'.pkl')
+
+    data = pd.read_csv(path, **kwargs)
+    stat = os.stat(path)
+    description = {'source': os.path.abspath(path),
+                   'source_size_bytes': stat.st_size,
+                   'source_mtime': stat.st_mtime,
+                   'source_sha1': file_sha1(path),
+                   'read_csv_kwargs': kwargs}
+    try:
+        if not os.path.exists(os.path.dirname(stem)):
+            os.makedirs(os.path.dirname(stem))
+        try:
+            data.to_parquet(stem+'.parquet', index=False)
+            description['format'] = 'parquet'
+        except (ImportError, ValueError, TypeError, NotImplementedError) as e:
+            # e.g. no parquet engine installed, or an object column of mixed types that parquet can't hold
+            print("Couldn't cache "+Path(path).name+" as parquet ("+str(e)+"), caching as pickle instead.")
+            data.to_pickle(stem+'.pkl')
+            description['format'] = 'pkl'
+        with open(description_path, 'w') as f:
+            json.dump(description, f, default=str)
+    except OSError as e:
+        print("Couldn't write the cache for "+Path(path).name+" ("+str(e)+") - it will be parsed again next time.")
+    return data
@@ -0,0 +1,116 @@
+"""
+Final daily data as PUPRN x day arrays (step 3.1C)
+
+DailyArrays holds the final daily data as one matrix per column, with a row
+per PUPRN and a column per day, instead of a long dataframe indexed by PUPRN
+and date. Every home gets a full year of days just by having a row, so there's
+no need to build a PUPRN x date MultiIndex and merge the energy data onto it,
+and the temperature data is gathered onto the homes by the row of each home's
+grid cell in a grid_cell x day matrix, rather than merged per PUPRN.
+
+to_frame gives the long layout saved as annual_report_sm_daily_YYYY.csv, and
+save/load keep the arrays themselves (.npz) for anything that wants the data
+as a matrix.
+"""
+import numpy as np
+import pandas as pd
+
+FLAG_COLUMNS = ['Hh_sum_flag_elec', 'Hh_sum_flag_gas']
+
+
+def _codes(values, labels):
+    # The position of each value in labels
+    return pd.Index(labels).get_indexer(values)
+
+
+def layout(frames, first_date, last_date):
+    '''The rows (every PUPRN in any of frames, sorted) and columns (every day from first_date to last_date, plus any
+    other days in the data) of the matrices for frames, and which of the columns are in the period.'''
+    period = pd.date_range(first_date, last_date, freq='D')
+    puprns = np.unique(np.concatenate([frame.index.get_level_values('PUPRN').astype(str) for frame in frames]))
+    dates = period.union(pd.DatetimeIndex(np.unique(np.concatenate(
+        [frame.index.get_level_values('Read_date_effective_local').values for frame in frames]))))
+    return puprns, dates, dates.isin(period)
+
+
+def to_matrices(frame, puprns, dates):
+    '''Each column of frame (indexed by PUPRN and Read_date_effective_local) as a puprns x dates matrix, Nan where
+    frame has no row. Flags and float32 columns are kept as float32, anything else is float64. Also returns which
+    PUPRN and day combinations frame has a row for, and how many of its rows are duplicates.'''
+    shape = (len(puprns), len(dates))
+    rows = _codes(frame.index.get_level_values('PUPRN').astype(str), puprns)
+    cols = _codes(frame.index.get_level_values('Read_date_effective_local'), dates)
+    columns = {}
+    for col in frame.columns:
+        dtype = np.float32 if col in FLAG_COLUMNS or frame[col].dtype == np.float32 else float
+        matrix = np.full(shape, np.nan, dtype=dtype)
+        # The data should hold each PUPRN and day once, but if it doesn't only one is kept
+        matrix[rows, cols] = frame[col].to_numpy(dtype=dtype, na_value=np.nan)
+        columns[col] = matrix
+    present = np.zeros(shape, dtype=bool)
+    present[rows, cols] = True
+    return columns, present, int(frame.index.duplicated().sum())
+
+
+class DailyArrays(object):
+    """Daily data as PUPRN x day matrices. present marks the PUPRN and day combinations that had any energy data,
+    and in_period the days of the period (e.g. the year) that every PUPRN has a row for."""
+
+    def __init__(self, puprns, dates, columns, present, in_period, n_duplicates=0):
+        self.puprns = pd.Index(puprns, name='PUPRN')
+        self.dates = pd.DatetimeIndex(dates, name='Read_date_effective_local')
+        self.columns = columns
+        self.present = present
+        self.in_period = in_period
+        self.n_duplicates = n_duplicates
+
+    @classmethod
+    def from_long(cls, frames, first_date, last_date):
+        '''Put long daily data (each of frames indexed by PUPRN and Read_date_effective_local, as datetimes) into
+        matrices, with a row for every PUPRN in any of them and a column for every day from first_date to last_date,
+        plus any other days in the data.'''
+        puprns, dates, in_period = layout(frames, first_date, last_date)
+        columns = {}
+        present = np.zeros((len(puprns), len(dates)), dtype=bool)
+        n_duplicates = 0
+        for frame in frames:
+            frame_columns, frame_present, frame_duplicates = to_matrices(frame, puprns, dates)
+            columns.update(frame_columns)
+            present |= frame_present
+            n_duplicates = n_duplicates + frame_duplicates
+        return cls(puprns, dates, columns, present, in_period, n_duplicates)
+
+    def add_temperatures(self, temperature_daily_data, puprn_to_grid_cell, columns=['mean_temp_C', 'hdd']):
+        '''Add columns of the daily temperature data (with grid_cell and Read_date_effective_local columns) to each
+        PUPRN, from its grid cell in puprn_to_grid_cell (with PUPRN and grid_cell columns). Nan if there isn't one.'''
+        grid_cells = pd.Index(temperature_daily_data.grid_cell.unique())
+        rows = _codes(temperature_daily_data.grid_cell, grid_cells)
+        cols = _codes(temperature_daily_data.Read_date_effective_local, self.dates)
+        in_dates = cols >= 0
+        grid_cell_of_puprn = puprn_to_grid_cell.drop_duplicates('PUPRN').set_index('PUPRN').grid_cell
+        home_rows = _codes(grid_cell_of_puprn.reindex(self.puprns.astype(object)), grid_cells)
+        for col in columns:
+            by_grid_cell = np.full((len(grid_cells)+1, len(self.dates)), np.nan)
+            by_grid_cell[rows[in_dates], cols[in_dates]] = temperature_daily_data[col].values[in_dates]
+            # Homes without a (known) grid cell take the last row, which is all Nan
+            self.columns[col] = by_grid_cell[home_rows]
+
+    def to_frame(self):
+        '''The long layout: indexed by PUPRN and Read_date_effective_local (sorted by both), with a row for every day of
+        the period for every PUPRN, and for any other days it has energy data for.'''
+        keep = (self.in_period[np.newaxis, :] | self.present).ravel()
+        rows, cols = np.divmod(np.flatnonzero(keep), len(self.dates))
+        index = pd.MultiIndex.from_arrays([self.puprns[rows], self.dates[cols]],
+                                          names=['PUPRN', 'Read_date_effective_local'])
+        return pd.DataFrame({col: matrix.ravel()[keep] for col, matrix in self.columns.items()}, index=index)
+
+    def save(self, path):
+        np.savez(path, puprns=np.asarray(self.puprns, dtype=str), dates=self.dates.values, present=self.present,
+                 in_period=self.in_period, n_duplicates=self.n_duplicates, column_names=np.array(list(self.columns)),
+                 **{'column_'+col: matrix for col, matrix in self.columns.items()})
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            columns = {col: f['column_'+col] for col in f['column_names']}
+            return cls(f['puprns'], f['dates'], columns, f['present'], f['in_period'], int(f['n_duplicates']))
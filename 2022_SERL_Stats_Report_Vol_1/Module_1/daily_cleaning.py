@@ -0,0 +1,148 @@
+"""
+Clean daily gas and electricity data (steps 3.1A, 3.1B and 3.1C in one pass)
+
+The best estimate of each day's gas and net electricity use is picked from the
+daily reads (steps 1.1A and 1.1B) and the daily sums of the hh reads (steps
+1.1A and 1.1C):
+- gas: the hh sum if there is one (Hh_sum_flag_gas 1), otherwise the daily read
+  if Gas_flag is 1 (Hh_sum_flag_gas 0), otherwise Nan
+- electricity: the net hh sum if there is one (Hh_sum_flag_elec 1), otherwise
+  the daily import read if Elec_act_imp_flag is 1 and the home never exports
+  (Hh_sum_flag_elec 0), otherwise Nan
+- some meters report hh sums in units of 10Wh. Days where the daily import read
+  is 8 to 12 times the import hh sum are dealt with as set by
+  treat_hh_sum_10Wh: 'by_day' sets those days to Nan, unless the daily read and
+  hh sum are both 0 (see fix_10Wh_by_day), 'by_PUPRN' removes the electricity
+  data of every PUPRN with any such day, and anything else leaves them as they
+  are.
+
+The rules only compare values of the same PUPRN and day, so they're written for
+arrays of any shape. clean_daily applies them to all the homes and days at once,
+as PUPRN x day matrices (see daily_arrays.py), straight from the step 1.1
+outputs, so the final daily data is made without saving and reading back the
+separate gas and electricity files of steps 3.1A and 3.1B. Those notebooks use
+the same rules, for anyone who wants the files.
+"""
+import numpy as np
+import daily_arrays
+
+GAS_COLUMNS = ['Gas_flag', 'Gas_d_kWh', 'Gas_hh_sum_kWh']
+ELEC_DAILY_COLUMNS = ['Elec_act_imp_flag', 'Elec_act_imp_d_Wh']
+ELEC_HH_COLUMNS = ['Elec_act_net_hh_sum_Wh', 'Elec_act_imp_hh_sum_Wh']
+
+
+def _flags(values):
+    # Read flags as floats, with Nan for missing ones (they may be a nullable integer column)
+    if hasattr(values, 'to_numpy'):
+        return values.to_numpy(dtype=float, na_value=np.nan)
+    return np.asarray(values, dtype=float)
+
+
+def gas_best_estimate(Gas_hh_sum_kWh, Gas_flag, Gas_d_kWh):
+    '''Clean_gas_d_kWh and Hh_sum_flag_gas, from arrays (or Series) of Gas_hh_sum_kWh, Gas_flag and Gas_d_kWh.'''
+    hh_sum = np.asarray(Gas_hh_sum_kWh)
+    use_daily = np.isnan(hh_sum) & (_flags(Gas_flag) == 1)
+    clean = np.where(use_daily, np.asarray(Gas_d_kWh), hh_sum)
+    flag = np.where(np.isnan(hh_sum), np.where(use_daily, 0, np.nan), 1)
+    return clean, flag
+
+
+def elec_best_estimate(Elec_act_net_hh_sum_Wh, Elec_act_imp_flag, Elec_act_imp_d_Wh, exporter):
+    '''Clean_elec_net_d_Wh and Hh_sum_flag_elec, from arrays (or Series) of Elec_act_net_hh_sum_Wh,
+    Elec_act_imp_flag and Elec_act_imp_d_Wh, and whether the PUPRN is an exporter (which broadcasts against them,
+    e.g. a column of one per PUPRN for PUPRN x day matrices).'''
+    hh_sum = np.asarray(Elec_act_net_hh_sum_Wh)
+    use_daily = np.isnan(hh_sum) & (_flags(Elec_act_imp_flag) == 1) & ~np.asarray(exporter, dtype=bool)
+    clean = np.where(use_daily, np.asarray(Elec_act_imp_d_Wh), hh_sum)
+    flag = np.where(np.isnan(hh_sum), np.where(use_daily, 0, np.nan), 1)
+    return clean, flag
+
+
+def days_of_10Wh(Elec_act_imp_d_Wh, Elec_act_imp_hh_sum_Wh):
+    '''Whether the daily import read is around 10x (8x-12x) the import hh sum, i.e. the hh data looks to be in units
+    of 10Wh. False where either is missing.'''
+    daily = np.asarray(Elec_act_imp_d_Wh)
+    hh_sum = np.asarray(Elec_act_imp_hh_sum_Wh)
+    with np.errstate(invalid='ignore'):
+        return (daily >= 8*hh_sum) & (daily <= 12*hh_sum)
+
+
+def fix_10Wh_by_day(clean, flag, Elec_act_imp_d_Wh, Elec_act_imp_hh_sum_Wh, days):
+    '''The 'by_day' treatment of the days of 10Wh, in place on clean (Clean_elec_net_d_Wh) and flag: the daily read
+    is only kept where it equals the import hh sum, which in practice means days where both are 0. Every other day of
+    10Wh is Nan.'''
+    daily = np.asarray(Elec_act_imp_d_Wh)
+    hh_sum = np.asarray(Elec_act_imp_hh_sum_Wh)
+    no_export = days & (hh_sum == clean)
+    flag[no_export] = 0
+    clean[no_export] = daily[no_export]
+    # As in step 3.1B, the export test is made again after the daily reads are put in, so it compares them (rather
+    # than the net hh sums) with the import hh sums, and only days where both are 0 keep the daily read.
+    export = days & (hh_sum != clean)
+    flag[export] = np.nan
+    clean[export] = np.nan
+
+
+def report_10Wh(treat_hh_sum_10Wh, n_rows_10Wh, n_rows, n_PUPRNs_10Wh, n_PUPRNs, n_PUPRNs_final):
+    '''The description of the days of 10Wh found, and what was done with them, to print.'''
+    if treat_hh_sum_10Wh == 'by_day':
+        report = 'These were fixed on a day by day basis for the affected rows by using the daily read where valid to do so, or else assigning a value of NaN.'
+    elif treat_hh_sum_10Wh == 'by_PUPRN':
+        report = "These were fixed on a PURPN by PUPRN basis by removing those PUPRNs' data from this year's output. Final count of PUPRNs saved is "+str(n_PUPRNs_final)
+        if n_PUPRNs == (n_PUPRNs_final + n_PUPRNs_10Wh):
+            report = report+". This is the expected number."
+        else:
+            report = report+"\nWARNING: This is NOT the expected number of PUPRNs - check for errors."
+    else:
+        report = "No action was taken with these rows - the output contains these hh_sum values even if they are likely to be in the incorrect units (10Whs)"
+    return f"There were {n_rows_10Wh} rows where the daily import value is around 10x (8x-12x) the hh sum, out of a total of {n_rows}.\n {n_PUPRNs_10Wh} PUPRNs are affected, out of a total of {n_PUPRNs}.\n{report}"
+
+
+def clean_daily(gas_daily_data, elec_daily_data_from_daily, elec_daily_data_from_hh, exporter_puprns, first_date,
+                last_date, treat_hh_sum_10Wh='by_PUPRN'):
+    '''The clean daily gas and electricity (Clean_elec_net_d_kWh, Hh_sum_flag_elec, Clean_gas_d_kWh and
+    Hh_sum_flag_gas) of every PUPRN, as daily_arrays.DailyArrays with a column for every day from first_date to
+    last_date, from the step 1.1 daily gas, daily electricity and electricity daily-from-hh data (each indexed by
+    PUPRN and Read_date_effective_local, as datetimes) and the list of exporting PUPRNs. Also returns the report on
+    the days of 10Wh.'''
+    frames = [gas_daily_data[GAS_COLUMNS], elec_daily_data_from_daily[ELEC_DAILY_COLUMNS],
+              elec_daily_data_from_hh[ELEC_HH_COLUMNS]]
+    puprns, dates, in_period = daily_arrays.layout(frames, first_date, last_date)
+    data = {}
+    present = []
+    n_duplicates = 0
+    for frame in frames:
+        frame_columns, frame_present, frame_duplicates = daily_arrays.to_matrices(frame, puprns, dates)
+        data.update(frame_columns)
+        present.append(frame_present)
+        n_duplicates = n_duplicates + frame_duplicates
+    gas_present = present[0]
+    elec_present = present[1] | present[2]
+
+    clean_gas, flag_gas = gas_best_estimate(data['Gas_hh_sum_kWh'], data['Gas_flag'], data['Gas_d_kWh'])
+    exporter = np.isin(puprns, list(exporter_puprns))[:, np.newaxis]
+    clean_elec, flag_elec = elec_best_estimate(data['Elec_act_net_hh_sum_Wh'], data['Elec_act_imp_flag'],
+                                               data['Elec_act_imp_d_Wh'], exporter)
+
+    # The days of 10Wh
+    days = days_of_10Wh(data['Elec_act_imp_d_Wh'], data['Elec_act_imp_hh_sum_Wh'])
+    puprns_10Wh = days.any(axis=1)
+    n_rows_elec = int(elec_present.sum())
+    n_puprns_elec = int(elec_present.any(axis=1).sum())
+    if treat_hh_sum_10Wh == 'by_day':
+        fix_10Wh_by_day(clean_elec, flag_elec, data['Elec_act_imp_d_Wh'], data['Elec_act_imp_hh_sum_Wh'], days)
+    elif treat_hh_sum_10Wh == 'by_PUPRN':
+        elec_present = elec_present & ~puprns_10Wh[:, np.newaxis]
+        clean_elec[puprns_10Wh] = np.nan
+        flag_elec[puprns_10Wh] = np.nan
+    report = report_10Wh(treat_hh_sum_10Wh, int(days.sum()), n_rows_elec, int(puprns_10Wh.sum()), n_puprns_elec,
+                         int(elec_present.any(axis=1).sum()))
+
+    # A PUPRN whose only data was electricity that's been removed has no row
+    present = gas_present | elec_present
+    keep = present.any(axis=1)
+    columns = {'Clean_elec_net_d_kWh': (clean_elec/1000)[keep],
+               'Hh_sum_flag_elec': flag_elec[keep].astype(np.float32),
+               'Clean_gas_d_kWh': clean_gas[keep],
+               'Hh_sum_flag_gas': flag_gas[keep].astype(np.float32)}
+    return daily_arrays.DailyArrays(puprns[keep], dates, columns, present[keep], in_period, n_duplicates), report
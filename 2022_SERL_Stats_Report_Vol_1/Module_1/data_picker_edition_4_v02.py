@@ -2,6 +2,7 @@
 SERL energy data picker
 """
 import re
+import copy
 import warnings
 import pandas as pd 
 import numpy as np
@@ -13,14 +14,51 @@ from datetime import datetime
 from datetime import date
 import csv
 import locations # This is a separate Python script specifying the locations of all the different SERL data within the SERL secure environment.
+import data_picker_parquet_store
+import data_picker_manifest
+import data_picker_writer
+import data_picker_formats
+import data_picker_execution
+import data_picker_run_record
+import data_picker_planner
+import data_picker_sampling
+import contextual_data_cache
+import data_picker_result_cache
+import serl_schema
 
 DEFAULT_START_YEAR = 2018
 DEFAULT_START_MONTH = '06'
 
+def add_local_time_columns(data, compact=False):
+    '''Add the local time columns to a (pandas) dataframe of hh data. Read_date_time_local is always
+    "YYYY-MM-DD HH:MM:SS TZ", so the time and timezone are sliced out of the string rather than split row by row.
+    Read_time_local_midpoint is 15 minutes before Read_time_local, and Readings_from_midnight_local counts the
+    half hours from midnight (the reading ending 00:30 is 1, the one ending at midnight is 48).
+    If compact is True, only Readings_from_midnight_local (as int8) and Timezone_BST (True for BST) are added.'''
+    read_time = data.Read_date_time_local.str.slice(11, 19)
+    seconds = (read_time.str.slice(0, 2).astype('int32')*3600 + read_time.str.slice(3, 5).astype('int32')*60
+               + read_time.str.slice(6, 8).astype('int32'))
+    midpoint_seconds = (seconds - 15*60) % (24*3600)
+    midpoint_minutes = midpoint_seconds // 60
+    readings_from_midnight = (2*midpoint_minutes + 30) // 60
+    data = data.copy()
+    if compact:
+        data['Readings_from_midnight_local'] = readings_from_midnight.astype('int8')
+        data['Timezone_BST'] = data.Read_date_time_local.str.slice(20) == 'BST'
+        return data
+    data['Read_time_local'] = read_time
+    data['Read_time_local_midpoint'] = ((midpoint_minutes // 60).astype(str).str.zfill(2) + ':'
+                                        + (midpoint_minutes % 60).astype(str).str.zfill(2) + ':'
+                                        + (midpoint_seconds % 60).astype(str).str.zfill(2))
+    data['Timezone'] = data.Read_date_time_local.str.slice(20)
+    data['Readings_from_midnight_local'] = readings_from_midnight.astype('int32')
+    return data
+
+
 class SerlDataSelector(object):
     """Interface to the SERL dataset edition4"""
     
-    def __init__(self, res=None, folder_path=None):        
+    def __init__(self, res=None, folder_path=None, parquet_path=None, profile=None):        
         warnings.filterwarnings("always", category=UserWarning, module="SerlDataSelector")
         if folder_path is None:
             if res is None:
@@ -35,9 +73,23 @@ class SerlDataSelector(object):
         else:
             print("Not none: ",folder_path)
             self.folder_path = Path(folder_path)
+        # The parquet copy of the same data, used by load_data(source='parquet')
+        if parquet_path is None:
+            if res=='hh':
+                self.parquet_path=Path(locations.energy_hh_parquet_directory)
+            else:
+                self.parquet_path=Path(locations.energy_daily_parquet_directory)
+        else:
+            self.parquet_path = Path(parquet_path)
         self.file_identifier = "serl_smart_meter*.csv"        
         self.filenames = self._mapping(self.folder_path)
         self.datecol='Read_date_effective_local'
+        # Index of what's in each data file, if one has been built for this edition (see build_manifest)
+        self.manifest = data_picker_manifest.load_manifest(self.folder_path)
+        # How dask runs the selections - settings left as None are worked out from the machine and the files read
+        self.profile = profile if profile is not None else data_picker_execution.ExecutionProfile()
+        # Replaced by each load_data / load_batch (see data_picker_run_record.py)
+        self.run_record = data_picker_run_record.RunRecord()
         
         if len(self.filenames) == 0:
             warnings.warn('The specified path does not seem to contain any serl data')
@@ -50,38 +102,13 @@ class SerlDataSelector(object):
         print('Found {} data files'.format(len(filenames)))
         return filenames
 
-    def load_data(self, filename=locations.energy_daily_regexp,
-                res = 'daily', 
-                usecols = 'All',
-                filter_rows_on_participant_cat_data = 'No_filters',
-                filter_rows_on_survey_cat_data = 'No_filters',
-                filter_Valid_read_time = 'All',
-                filter_Gas_flag = 'All',
-                filter_Elec_act_imp_flag = 'All',
-                filter_Elec_act_exp_flag = 'All',
-                filter_Elec_react_imp_flag = 'All',
-                filter_Elec_react_exp_flag = 'All',
-                inc_time_change_days = True, 
-                first_date = 'earliest_date', last_date = 'latest_date',
-                add_local_time_cols = False,
-                merge_participant_data_variables = False,
-                merge_survey_data_variables = False,
-                add_net_electricity_column = False,
-                add_sum_gas_column = False,
-                output_filename = 'Default'):                
+    def build_manifest(self):
+        # Scan the data files once and save an index of their dates and PUPRNs, used by load_data to pick which files to read
+        self.manifest = data_picker_manifest.build_manifest(self.folder_path, self.file_identifier)
+        return self.manifest
 
-        self.res = res
-        self.add_gas_hh_sum = add_sum_gas_column
-        self.add_net_electricity_column = add_net_electricity_column
-        participant_data = pd.read_csv(os.path.join(locations.serl_data_path,locations.participant_data_file))
-        survey_data = pd.read_csv(os.path.join(locations.serl_data_path,locations.survey_data_file),low_memory=False)
-        print(usecols)
-        print(last_date)
-        if (first_date==''):
-            first_date='earliest_date'
-        if (last_date==''):
-            last_date='latest_date'
-        # 'Load' in the columns requested using dask.
+    def _csv_filelist(self, filename, first_date, last_date):
+        # Work out which csv files to read, by substituting the years/months of the date range into the filename's YYYY/MM
         filelist=[]
         yearreplace=False
         monthreplace=False
@@ -91,10 +118,6 @@ class SerlDataSelector(object):
         endyear=datetime.today().year
         endmonth=datetime.today().month
 
-        if self.res=='hh':
-            if filename==locations.energy_daily_regexp:
-                filename=locations.energy_hh_regexp
-                
         if re.search("YYYY",filename):
             if first_date=='earliest_date' and last_date=='latest_date':
                 filename = filename.replace('YYYY','*')
@@ -135,127 +158,326 @@ class SerlDataSelector(object):
                 else:
                     filelist.extend(glob.glob(os.path.join(self.folder_path,files)))
         print("Found "+str(len(filelist))+" files to load / select from (" +str(startyear)+' to '+str(endyear)+").")
-        #print(str(filelist))
-        self.drop_columns_before_save=[]
-        if res=='hh':
-            self.datecol='Read_date_time_local'
-            if usecols == 'All':
-                data = dd.read_csv(filelist,
-                                dtype={'Elec_act_imp_hh_Wh': 'float64','Elec_act_exp_hh_Wh': 'float64','Gas_hh_Wh': 'float64'})
+        return filelist
+
+    def _no_filters(self, filters):
+        return isinstance(filters, str) and filters=='No_filters'
+
+    def _puprns_matching(self, contextual_data, filters):
+        '''Return the PUPRNs (as a pandas Index) in the participant or survey data that match filters. filters is either
+        a dictionary of {column name: list of values} (each column is filtered using isin), a query string over the
+        columns (e.g. "Region=='WALES' and IMD_quintile>=3"), or a function that takes the dataframe and returns a
+        boolean Series.'''
+        if isinstance(filters, dict):
+            mask = pd.Series(True, index=contextual_data.index)
+            for key, value in filters.items():
+                mask = mask & contextual_data[key].isin(value)
+            selected = contextual_data[mask]
+        elif isinstance(filters, str):
+            selected = contextual_data.query(filters)
+        else:
+            selected = contextual_data[filters(contextual_data)]
+        return pd.Index(selected.PUPRN.unique()) #.unique() shouldn't be necessary, but just in case
+
+    def _selected_puprns(self, participant_data, survey_data, participant_filters, survey_filters, sample=None):
+        # Get the set of PUPRNs that match the participant filters and the survey filters specified, and are in the
+        # sample (see data_picker_sampling.py), or None if there aren't any filters or a sample
+        selected = None
+        if sample is not None:
+            selected = data_picker_sampling.sample_puprns(participant_data, sample)
+        if not self._no_filters(participant_filters):
+            selected_participant = self._puprns_matching(participant_data, participant_filters)
+            if selected is None:
+                selected = selected_participant
+            else:
+                selected = selected.intersection(selected_participant)
+        if not self._no_filters(survey_filters):
+            selected_survey = self._puprns_matching(survey_data, survey_filters)
+            if selected is None:
+                selected = selected_survey
             else:
-                if add_net_electricity_column!=False:
-                    if 'Elec_act_imp_hh_Wh' not in usecols:
-                        self.drop_columns_before_save.append('Elec_act_imp_hh_Wh')
-                        usecols.append('Elec_act_imp_hh_Wh')
-                    if 'Elec_act_exp_hh_Wh' not in usecols:
-                        self.drop_columns_before_save.append('Elec_act_exp_hh_Wh')
-                        usecols.append('Elec_act_exp_hh_Wh')
-                data = dd.read_csv(filelist,
-                               usecols=usecols,
-                               dtype={'Elec_act_imp_hh_Wh': 'float64','Elec_act_exp_hh_Wh': 'float64','Gas_hh_Wh': 'float64'})
+                selected = selected.intersection(selected_survey) # hash join, not a nested loop
+        return selected
+
+    def _columns_to_read(self, res, usecols, add_net_electricity_column, add_sum_gas_column):
+        '''Return the columns to read (None for all of them), and the ones only read to derive the extra columns,
+        which are dropped again before saving. Like the original code, this adds those columns to usecols.'''
+        drop_columns_before_save=[]
+        if res=='hh':
+            if usecols != 'All' and add_net_electricity_column!=False:
+                if 'Elec_act_imp_hh_Wh' not in usecols:
+                    drop_columns_before_save.append('Elec_act_imp_hh_Wh')
+                    usecols.append('Elec_act_imp_hh_Wh')
+                if 'Elec_act_exp_hh_Wh' not in usecols:
+                    drop_columns_before_save.append('Elec_act_exp_hh_Wh')
+                    usecols.append('Elec_act_exp_hh_Wh')
         else:
-            if usecols == 'All':
-                print("FS1")
-                data = dd.read_csv(filelist)
+            if usecols != 'All' and ('Gas_hh_sum_m3' not in usecols) and (add_sum_gas_column != False):
+                drop_columns_before_save.append('Gas_hh_sum_m3')
+                usecols.append('Gas_hh_sum_m3')
+        readcols = None if usecols == 'All' else usecols
+        return readcols, drop_columns_before_save
+
+    def _read_source(self, filename, readcols, first_date, last_date, puprn_filter, source):
+        '''Lazily read the smart meter data (as a dask dataframe) from the csv files or the parquet store, only
+        opening the files that can contain the dates and PUPRNs requested. Rows aren't filtered here.'''
+        with self.run_record.stage('find the files and set up the read'):
+            if source=='parquet':
+                self._resolve_profile(data_picker_parquet_store.list_store_files(self.parquet_path, first_date, last_date))
+                # Only the year/month partitions in the date range are opened, and row groups that can't contain
+                # the dates or PUPRNs requested are skipped. The row-level filters in load_data still apply.
+                data = data_picker_parquet_store.read_store(self.parquet_path, columns=readcols,
+                                                            first_date=first_date, last_date=last_date,
+                                                            puprns=puprn_filter)
+                return serl_schema.apply_schema(data)
+            if self.res=='hh':
+                if filename==locations.energy_daily_regexp:
+                    filename=locations.energy_hh_regexp
+            if self.manifest is not None:
+                # Look up the files whose contents overlap the dates and PUPRNs requested
+                filelist = data_picker_manifest.plan_files(self.manifest, self.folder_path, filename,
+                                                           first_date, last_date, puprns=puprn_filter)
+                print("Found "+str(len(filelist))+" files to load / select from (from the manifest).")
             else:
-                print("FS2")
-                print(filelist)
-                if ('Gas_hh_sum_m3' not in usecols) and (add_sum_gas_column != False):
-                    self.drop_columns_before_save.append('Gas_hh_sum_m3')
-                    usecols.append('Gas_hh_sum_m3')
-                data = dd.read_csv(filelist, usecols=usecols)
-
-        # Filter out dates oustide the desired range
-        if first_date!='earliest_date':
-            data = data.loc[data.Read_date_effective_local>=first_date]
-        if last_date!='latest_date':
-            data = data.loc[data.Read_date_effective_local<=last_date]
+                filelist = self._csv_filelist(filename, first_date, last_date)
+            profile = self._resolve_profile(filelist)
+            # Read with the compact dtypes declared in serl_schema, rather than letting dask infer them
+            return dd.read_csv(filelist, usecols=readcols, dtype=serl_schema.dtypes(readcols), blocksize=profile.blocksize)
+
+    def _resolve_profile(self, filelist):
+        # Fill in the execution profile for reading these files (sizes from the manifest, if there is one)
+        sizes = {}
+        if self.manifest is not None:
+            sizes = {entry['filename']: entry['size_bytes'] for entry in self.manifest['files']}
+        data_bytes = sum(sizes.get(Path(f).name, None) or os.path.getsize(f) for f in filelist)
+        self.execution_profile = self.profile.resolve(data_bytes)
+        # Kept for estimating the size of the selection (see data_picker_planner.py)
+        self.source_files = list(filelist)
+        self.source_bytes = data_bytes
+        print("Execution profile: "+str(self.execution_profile))
+        self.run_record.set(files_read=len(filelist), bytes_read=data_bytes, execution_profile=self.execution_profile.describe())
+        return self.execution_profile
+
+    def _plan(self, data, first_date, last_date, puprn_filter, participant_data, lazy, cached_rows=None):
+        # The execution plan for the (dask) selection in data - cached_rows is its size if it came from the result cache
+        if cached_rows is not None:
+            n_rows, rows_how = cached_rows, 'the rows in the result cache'
+            input_bytes = None
+        else:
+            n_rows, rows_how = data_picker_planner.estimate_rows(self.source_files, self.manifest, first_date, last_date,
+                                                                 puprns=puprn_filter,
+                                                                 n_participants=participant_data.PUPRN.nunique())
+            input_bytes = self.source_bytes
+        return data_picker_planner.plan(data._meta, n_rows, rows_how, input_bytes, self._active_profile(), lazy=lazy,
+                                        requested_scheduler=self.profile.scheduler)
+
+    def _active_profile(self):
+        # The profile the data was read with, or one for this machine if the data came from the result cache
+        if getattr(self, 'execution_profile', None) is None:
+            self.execution_profile = self.profile.resolve()
+        return self.execution_profile
+
+    def _cache_key(self, cache_args, source):
+        '''The result cache key for a selection made with cache_args from source, or None if it can't be cached.'''
+        if not isinstance(source, str):
+            return None
+        if any(callable(v) for v in cache_args.values()):
+            print("Selections filtered with a function aren't cached - loading from the source data instead.")
+            return None
+        if source=='parquet':
+            source_files = glob.glob(os.path.join(self.parquet_path, '**', '*.parquet'), recursive=True)
+        else:
+            source_files = glob.glob(os.path.join(self.folder_path, self.file_identifier))
+        for contextual_file in [locations.participant_data_file, locations.survey_data_file, locations.bst_dates]:
+            source_files.append(os.path.join(locations.serl_data_path, contextual_file))
+        cache_args = dict(cache_args, source=source)
+        return data_picker_result_cache.fingerprint(cache_args, source_files, self.manifest if source!='parquet' else None)
+
+    def load_data(self, filename=locations.energy_daily_regexp,
+                res = 'daily', 
+                usecols = 'All',
+                filter_rows_on_participant_cat_data = 'No_filters',
+                filter_rows_on_survey_cat_data = 'No_filters',
+                filter_Valid_read_time = 'All',
+                filter_Gas_flag = 'All',
+                filter_Elec_act_imp_flag = 'All',
+                filter_Elec_act_exp_flag = 'All',
+                filter_Elec_react_imp_flag = 'All',
+                filter_Elec_react_exp_flag = 'All',
+                inc_time_change_days = True, 
+                first_date = 'earliest_date', last_date = 'latest_date',
+                add_local_time_cols = False,
+                merge_participant_data_variables = False,
+                merge_survey_data_variables = False,
+                add_net_electricity_column = False,
+                add_sum_gas_column = False,
+                output_filename = 'Default',
+                source = 'csv',
+                lazy = 'auto',
+                compact_local_time_cols = False,
+                cache = False,
+                dry_run = False,
+                sample = None):                
 
+        # Everything the selection depends on, to look it up in the result cache. Copied, as some of the lists get changed below.
+        cache_args = copy.deepcopy({k: v for k, v in locals().items() if k not in ['self', 'output_filename', 'source', 'lazy', 'cache', 'dry_run']})
+        self.cache_args = cache_args
+        self.res = res
+        self.add_gas_hh_sum = add_sum_gas_column
+        self.add_net_electricity_column = add_net_electricity_column
+        # Where the time, rows and memory go (see data_picker_run_record.py)
+        self.run_record = data_picker_run_record.RunRecord()
+        record = self.run_record
+        self.plan = None
+        with record.stage('read the contextual data'):
+            participant_data = contextual_data_cache.read_contextual(os.path.join(locations.serl_data_path,locations.participant_data_file))
+            survey_data = contextual_data_cache.read_contextual(os.path.join(locations.serl_data_path,locations.survey_data_file))
+        print(usecols)
+        print(last_date)
+        if (first_date==''):
+            first_date='earliest_date'
+        if (last_date==''):
+            last_date='latest_date'
         # Filter out other rows as requested
-        # Get a list of PUPRNs that match the participant filters specified
-        if len(filter_rows_on_survey_cat_data)==0:
+        # Get the set of PUPRNs that match the participant filters specified
+        if isinstance(filter_rows_on_survey_cat_data, (dict, str)) and len(filter_rows_on_survey_cat_data)==0:
             filter_rows_on_survey_cat_data='No_filters'
-        if len(filter_rows_on_participant_cat_data)==0:
+        if isinstance(filter_rows_on_participant_cat_data, (dict, str)) and len(filter_rows_on_participant_cat_data)==0:
             filter_rows_on_participant_cat_data='No_filters'
 
-        if filter_rows_on_participant_cat_data!='No_filters':
-            for key, value in filter_rows_on_participant_cat_data.items():
-                participant_data = participant_data[participant_data[key].isin(value)]
-            participant_list_ppt = participant_data.PUPRN.unique().tolist() #.unique() shouldn't be necessary, but just in case
-            participant_list=participant_list_ppt # Final participant list to include will be this, if not updated below.
-        # Get a list of PUPRNs that match the survey filters specified
-        if filter_rows_on_survey_cat_data!='No_filters':
-            for key, value in filter_rows_on_survey_cat_data.items():
-                survey_data = survey_data[survey_data[key].isin(value)]
-            participant_list_survey = survey_data.PUPRN.unique().tolist() #.unique() shouldn't be necessary, but just in case
-            participant_list=participant_list_survey # Final participant list to include will be this, if not updated below.
-        # Create the final set of PUPRNS that match all criteria
-        if filter_rows_on_participant_cat_data!='No_filters' and filter_rows_on_survey_cat_data!='No_filters':
-            participant_list=[x for x in participant_list_ppt if x in participant_list_survey] # Final participant list to include will be this, if there were filters based on participant and survey data.
-        # Then filter data on that list of PUPRNs
-        if filter_rows_on_participant_cat_data!='No_filters' or filter_rows_on_survey_cat_data!='No_filters':
-            data = data[data.PUPRN.isin(participant_list)]        
-
-        # Filter out dates when the clocks change, if inc_time_change_days == False
-        if inc_time_change_days != True:
-            clock_changes = pd.read_csv(os.path.join(locations.serl_data_path,locations.bst_dates),index_col=False)
-            if inc_time_change_days == False:
-                droplist= clock_changes.Read_date_effective_local.tolist()
-            if inc_time_change_days == 25:
-                droplist= clock_changes[clock_changes.n_hh==46].Read_date_effective_local.tolist()
-            if inc_time_change_days == 23:
-                droplist= clock_changes[clock_changes.n_hh==50].Read_date_effective_local.tolist()
-            data=data.loc[~data.Read_date_effective_local.isin(droplist)]
-
-        # Filter out flagged reads, as specified in any of the filter arguments
-        if filter_Valid_read_time!='All':
-            data = data[data.Valid_read_time==filter_Valid_read_time]
-        if filter_Gas_flag!='All':
-            data = data[data.Gas_flag.isin(filter_Gas_flag)]
-        if filter_Elec_act_imp_flag!='All':
-            data = data[data.Elec_act_imp_flag.isin(filter_Elec_act_imp_flag)]
-        if filter_Elec_act_exp_flag!='All' and res == 'hh':
-            data = data[data.Elec_act_exp_flag.isin(filter_Elec_act_exp_flag)]    
-        if filter_Elec_react_imp_flag!='All' and res == 'hh':
-            data = data[data.Elec_react_imp_flag.isin(filter_Elec_react_imp_flag)]
-        if filter_Elec_react_exp_flag!='All' and res == 'hh':
-            data = data[data.Elec_react_exp_flag.isin(filter_Elec_react_exp_flag)]
-
-        # Merge in (left-join) variables from the participant data and the survey data if requested to do so
-        if merge_participant_data_variables!=False:
-            merge_participant_data_variables.insert(0,'PUPRN')
-            data = data.merge(participant_data[merge_participant_data_variables],on='PUPRN',how='left')
-        if merge_survey_data_variables!=False:
-            merge_survey_data_variables.insert(0,'PUPRN')
-            data = data.merge(survey_data[merge_survey_data_variables],on='PUPRN',how='left')
-
-        # add net electricity use (import - export)
-        if res=='hh' and 'Elec_act_imp_hh_Wh' in usecols  and 'Elec_act_exp_hh_Wh' in usecols and add_net_electricity_column!=False:
-            data['Elec_act_net_hh_Wh']=data.Elec_act_imp_hh_Wh-data.Elec_act_exp_hh_Wh.fillna(0)
-
-        # Add Gas_hh_sum_kWh, for daily data. 
-        # NB. Figures returned to 3dp to be in keeping with measurement accuracy reported for variables already in the df
-        if res!='hh' and 'Gas_hh_sum_m3' in usecols and add_sum_gas_column != False:
-            data['Gas_hh_sum_kWh']=data.Gas_hh_sum_m3 * 1.02264 * 39.5 / 3.6
-            data.round({'Gas_hh_sum_kWh':3})
-
-        # add_local_time_cols: for hh data, add: Read_time_local, Read_time_local_midpoint, Time_zone, Midpoint_seconds_from_midnight
-        # NB. Dask doesn't fully support string splitting - the workaround here converts the time string to a list, so individual elements can be extracted.
-        if res=='hh' and add_local_time_cols== True:
-            data['Time_Temp']=data.Read_date_time_local.str.split(n=2)
-            data['Read_time_local']=data.apply(lambda x: x['Time_Temp'][1], axis=1, meta=pd.Series())
-            data['Read_time_local_midpoint']=(dd.to_datetime(data.Read_time_local,format="%H:%M:%S")
-                                              - pd.Timedelta(minutes=15))
-            data['Timezone']=data.apply(lambda x: x['Time_Temp'][2], axis=1, meta=pd.Series())
-            data['Readings_from_midnight_local'] = (data.Read_time_local_midpoint.dt.hour
-                                                    + data.Read_time_local_midpoint.dt.minute/60)*2 +0.5
-            data.Read_time_local_midpoint = data.Read_time_local_midpoint.dt.time
-            data.Readings_from_midnight_local = data.Readings_from_midnight_local.astype('int32')
-            data = data.drop(['Time_Temp'],axis=1)
-
-        # That's all we can do (quickly) in dask.
-        data=data.drop(self.drop_columns_before_save,axis=1)
-        data=data.compute()
+        # A deterministic sample of the PUPRNs, if asked for (see data_picker_sampling.py)
+        self.sample = data_picker_sampling.sample_spec(sample)
+        with record.stage('select PUPRNs'):
+            self.participant_list = self._selected_puprns(participant_data, survey_data,
+                                                          filter_rows_on_participant_cat_data, filter_rows_on_survey_cat_data,
+                                                          self.sample)
+        if self.sample is not None:
+            print("Sample: "+data_picker_sampling.describe(self.sample)+" - "+str(len(self.participant_list))+" PUPRNs selected.")
+
+        # Work out which columns need reading, including any only needed to derive the extra columns
+        if res=='hh':
+            self.datecol='Read_date_time_local'
+        readcols, self.drop_columns_before_save = self._columns_to_read(res, usecols, add_net_electricity_column,
+                                                                        add_sum_gas_column)
+
+        puprn_filter = self.participant_list
+
+        # Return the same selection from the result cache if it's already been made from this data (see data_picker_result_cache.py)
+        cache_key = None
+        data = None
+        cached_rows = None
+        if cache and not dry_run:
+            cache_key = self._cache_key(cache_args, source)
+            if cache_key is not None:
+                with record.stage('read from the result cache'):
+                    # With lazy='auto', read lazily and let the plan below decide whether to compute it
+                    data = data_picker_result_cache.ResultCache().get(cache_key, lazy=lazy!=False)
+                if data is not None:
+                    cached_rows = data_picker_result_cache.ResultCache().description(cache_key)['n_rows']
+                if isinstance(data, pd.DataFrame):
+                    data['PUPRN']=serl_schema.puprn_categorical(data.PUPRN)
+
+        if data is None:
+            # 'Load' in the columns requested using dask.
+            if isinstance(source, dd.DataFrame):
+                # A read of the source files shared with other selections (see load_batch) - just take the columns needed
+                data = source if readcols is None else source[[c for c in source.columns if c in readcols]]
+            else:
+                data = self._read_source(filename, readcols, first_date, last_date, puprn_filter, source)
+            record.set(partitions=data.npartitions)
+            # Count the rows left after each step, as the selection is computed
+            record.checkpoint('read from the files', data)
+
+            # Semi-join on the selected PUPRNs straight after each partition is read, so that all the later steps only
+            # see rows for those homes
+            if puprn_filter is not None:
+                data = data[data.PUPRN.isin(puprn_filter)]
+                record.checkpoint('selected PUPRNs', data)
+
+            # Filter out dates oustide the desired range
+            if first_date!='earliest_date':
+                data = data.loc[data.Read_date_effective_local>=first_date]
+            if last_date!='latest_date':
+                data = data.loc[data.Read_date_effective_local<=last_date]
+            if first_date!='earliest_date' or last_date!='latest_date':
+                record.checkpoint('date range', data)
+
+            # Filter out dates when the clocks change, if inc_time_change_days == False
+            if inc_time_change_days != True:
+                clock_changes = pd.read_csv(os.path.join(locations.serl_data_path,locations.bst_dates),index_col=False)
+                if inc_time_change_days == False:
+                    droplist= clock_changes.Read_date_effective_local.tolist()
+                if inc_time_change_days == 25:
+                    droplist= clock_changes[clock_changes.n_hh==46].Read_date_effective_local.tolist()
+                if inc_time_change_days == 23:
+                    droplist= clock_changes[clock_changes.n_hh==50].Read_date_effective_local.tolist()
+                data=data.loc[~data.Read_date_effective_local.isin(droplist)]
+                record.checkpoint('clock change days removed', data)
+
+            # Filter out flagged reads, as specified in any of the filter arguments
+            unflagged = data
+            if filter_Valid_read_time!='All':
+                data = data[data.Valid_read_time==filter_Valid_read_time]
+            if filter_Gas_flag!='All':
+                data = data[data.Gas_flag.isin(filter_Gas_flag)]
+            if filter_Elec_act_imp_flag!='All':
+                data = data[data.Elec_act_imp_flag.isin(filter_Elec_act_imp_flag)]
+            if filter_Elec_act_exp_flag!='All' and res == 'hh':
+                data = data[data.Elec_act_exp_flag.isin(filter_Elec_act_exp_flag)]    
+            if filter_Elec_react_imp_flag!='All' and res == 'hh':
+                data = data[data.Elec_react_imp_flag.isin(filter_Elec_react_imp_flag)]
+            if filter_Elec_react_exp_flag!='All' and res == 'hh':
+                data = data[data.Elec_react_exp_flag.isin(filter_Elec_react_exp_flag)]
+            if data is not unflagged:
+                record.checkpoint('read flags and Valid_read_time', data)
+
+            # Merge in (left-join) variables from the participant data and the survey data if requested to do so
+            if merge_participant_data_variables!=False:
+                merge_participant_data_variables.insert(0,'PUPRN')
+                data = data.merge(participant_data[merge_participant_data_variables],on='PUPRN',how='left')
+            if merge_survey_data_variables!=False:
+                merge_survey_data_variables.insert(0,'PUPRN')
+                data = data.merge(survey_data[merge_survey_data_variables],on='PUPRN',how='left')
+
+            # add net electricity use (import - export)
+            if res=='hh' and 'Elec_act_imp_hh_Wh' in usecols  and 'Elec_act_exp_hh_Wh' in usecols and add_net_electricity_column!=False:
+                data['Elec_act_net_hh_Wh']=data.Elec_act_imp_hh_Wh-data.Elec_act_exp_hh_Wh.fillna(0)
+
+            # Add Gas_hh_sum_kWh, for daily data. 
+            # NB. Figures returned to 3dp to be in keeping with measurement accuracy reported for variables already in the df
+            if res!='hh' and 'Gas_hh_sum_m3' in usecols and add_sum_gas_column != False:
+                data['Gas_hh_sum_kWh']=data.Gas_hh_sum_m3 * 1.02264 * 39.5 / 3.6
+                data.round({'Gas_hh_sum_kWh':3})
+
+            # add_local_time_cols: for hh data, add: Read_time_local, Read_time_local_midpoint, Time_zone, Midpoint_seconds_from_midnight
+            # Derived with string slicing and integer arithmetic on whole partitions (see add_local_time_columns)
+            if res=='hh' and add_local_time_cols== True:
+                data = data.map_partitions(add_local_time_columns, compact_local_time_cols,
+                                           meta=add_local_time_columns(data._meta, compact_local_time_cols))
+
+            # That's all we can do (quickly) in dask.
+            data=data.drop(self.drop_columns_before_save,axis=1)
+
+        # Estimate the size of the selection and decide whether to compute it now or stream it (see data_picker_planner.py)
+        if (lazy=='auto' or dry_run) and not isinstance(data, pd.DataFrame):
+            with record.stage('plan the execution'):
+                self.plan = self._plan(data, first_date, last_date, puprn_filter, participant_data, lazy, cached_rows)
+            print(self.plan.explain())
+            record.set(plan=self.plan.describe())
+            if dry_run:
+                return self.plan
+            lazy = self.plan.lazy
+            self.execution_profile = self.plan.profile
+        # In lazy mode, keep the dask graph - it's only executed when the data is saved
+        if not lazy and not isinstance(data, pd.DataFrame):
+            with self._active_profile().activate(), record.stage('compute the selection (read, filter, merge)', profile_tasks=True):
+                data=record.compute(data)
+            # Hold PUPRN as a categorical in memory (sorted categories, so sorting by it still sorts alphanumerically)
+            data['PUPRN']=serl_schema.puprn_categorical(data.PUPRN)
+            if cache_key is not None and cached_rows is None:
+                data_picker_result_cache.ResultCache().put(cache_key, data, cache_args)
+        # A lazy selection is added to the result cache as its partitions are computed, when it's saved
+        self.cache_key = cache_key if lazy and cached_rows is None else None
 
         self.data = data
         self.filter_rows_on_participant_cat_data = filter_rows_on_participant_cat_data
@@ -274,8 +496,12 @@ class SerlDataSelector(object):
         self.usecols=usecols
         return data
 
-    def save_data(self, output_filename="Default", output_directory="Data", metadata_filename="meta.csv", save_method="per_home"):
+    def save_data(self, output_filename="Default", output_directory="Data", metadata_filename="meta.csv", save_method="per_home",
+                  n_workers=None, spill_directory=None, file_format="csv"):
         data = self.data
+        # csv, csv.gz, parquet or feather (see data_picker_formats.py) - checked before anything is computed
+        data_picker_formats.extension(file_format)
+        self.file_format = file_format
            
         timenow = datetime.now().strftime("%Y_%m_%d_%H-%M-%S")
     
@@ -289,36 +515,270 @@ class SerlDataSelector(object):
         else:
             metadata_filename = "Metadata_about_"+output_filename+".csv"
 
-        self.puprns=sorted(data.PUPRN.unique(), key=str.lower) # Get a list of PUPRNs in the output data, sorted alphanumerically (case insensitive)
-        self.first_date_in_df = data.Read_date_effective_local.min()
-        self.last_date_in_df = data.Read_date_effective_local.max()
-        self.save_metadata(metadata_filename=metadata_filename, output_directory=output_directory)
-        if save_method=='single_file':
-            data = data.sort_values(by=['PUPRN',self.datecol])
-            data.to_csv(os.path.join(output_directory,output_filename+".csv"),index=False)
-        elif save_method=='per_home':
-            if not os.path.exists(os.path.join(output_directory,output_filename)):
-                os.makedirs(os.path.join(output_directory,output_filename))
-            for pup in self.puprns:
-                print("Save for home "+pup)
-                homedata = data[data.PUPRN==pup]
-                #homedata = homedata.compute()
-                #print(homedata.head())
-                #homedata = homedata.sort_values(by=[self.datecol])
-                        #homedata.to_csv(os.path.join(output_directory,output_filename,pup+".csv"),single_file=True)
-                homedata.to_csv(os.path.join(output_directory,output_filename,pup+".csv"), index=False)
+        if not os.path.exists(output_directory):
+            os.makedirs(output_directory)
+        # The metadata is gathered as the data is written, so lazily loaded (dask) data is only computed once
+        stream = data_picker_writer.StreamMetadata()
+        # Write with the selector's execution profile (its dask scheduler, and the cores its dask workers don't take
+        # unless n_workers is given here)
+        profile = self._active_profile()
+        if n_workers is None:
+            n_workers = profile.writer_workers()
+        if spill_directory is None:
+            spill_directory = profile.spill_directory
+        on_partition = stream.update
+        cache_writer = None
+        if not isinstance(data, pd.DataFrame):
+            # Lazily loaded - count the rows after each step of the selection as its partitions are computed
+            data = self.run_record.counted_partitions(data)
+            if getattr(self, 'cache_key', None) is not None:
+                # and add them to the result cache (load_data was called with cache=True)
+                cache_writer = data_picker_result_cache.ResultCache().writer(self.cache_key, self.cache_args)
+                def on_partition(part):
+                    stream.update(part)
+                    cache_writer.add(part)
+        try:
+            with profile.activate(), self.run_record.stage('write the data', profile_tasks=True):
+                if save_method=='single_file':
+                    data_picker_writer.write_single_file(data, os.path.join(output_directory,output_filename+data_picker_formats.extension(file_format)),
+                                                         sortcols=['PUPRN',self.datecol],
+                                                         spill_directory=spill_directory,
+                                                         on_partition=on_partition,
+                                                         file_format=file_format,
+                                                         n_workers=n_workers)
+                elif save_method=='per_home':
+                    # Sort by PUPRN once, then write blocks of homes in parallel (spilling to disk first if the data is a dask dataframe)
+                    homes_saved = data_picker_writer.write_per_home(data, os.path.join(output_directory,output_filename),
+                                                                    sortcols=['PUPRN',self.datecol],
+                                                                    n_workers=n_workers,
+                                                                    spill_directory=spill_directory,
+                                                                    on_partition=on_partition,
+                                                                    file_format=file_format)
+                    print(homes_saved, "homes saved.")
+                elif isinstance(data, pd.DataFrame):
+                    stream.update(data)
+                else:
+                    for part in data_picker_writer.iter_partitions(data):
+                        on_partition(part)
+            if cache_writer is not None:
+                cache_writer.finish()
+                self.cache_key = None
+        finally:
+            if cache_writer is not None:
+                cache_writer.cleanup()
+        self._record_metadata(stream, metadata_filename, output_directory)
         print("\nProcess completed successfully - all requested data should now be saved.")
 
+    def _record_metadata(self, stream, metadata_filename, output_directory):
+        # Keep what was gathered about the saved data (see data_picker_writer.StreamMetadata) and save the metadata file
+        self.puprns=sorted(stream.puprns, key=str.lower) # Get a list of PUPRNs in the output data, sorted alphanumerically (case insensitive)
+        self.first_date_in_df = stream.first_date
+        self.last_date_in_df = stream.last_date
+        self.number_rows_in_df = stream.n_rows
+        self.data_head = stream.head
+        self.save_metadata(metadata_filename=metadata_filename, output_directory=output_directory)
+        # So that the later steps know their outputs are from a sample
+        sample = getattr(self, 'sample', None)
+        data_picker_sampling.save_sample_spec(output_directory, sample,
+                                              n_puprns=len(self.participant_list) if sample is not None else None)
+
+    def load_batch(self, selections, filename=locations.energy_daily_regexp, source='csv', n_workers=None,
+                   spill_directory=None):
+        '''Load, and optionally save, several selections of the same resolution data in one pass over the source files.
+        selections is a dictionary of {name: {'load': {load_data arguments}, 'save': {save_data arguments}}}. 'save'
+        can be left out to keep that selection in memory instead. Returns a dictionary of {name: SerlDataSelector},
+        each holding its selection (and metadata) just as if load_data and save_data had been called on it.'''
+        # The shared read and the shared pass are recorded here, then added to each selection's own run record
+        self.run_record = data_picker_run_record.RunRecord()
+        with self.run_record.stage('read the contextual data'):
+            participant_data = contextual_data_cache.read_contextual(os.path.join(locations.serl_data_path,locations.participant_data_file))
+            survey_data = contextual_data_cache.read_contextual(os.path.join(locations.serl_data_path,locations.survey_data_file))
+        res_values = set(selection.get('load', {}).get('res', 'daily') for selection in selections.values())
+        if len(res_values) != 1:
+            raise ValueError("All the selections in a batch must be for the same res - load the daily and hh data in separate batches.")
+        res = res_values.pop()
+        if getattr(self, 'res', res) != res:
+            raise ValueError("This selector reads the "+self.res+" data - initialise it with SerlDataSelector('"+res+"') for this batch.")
+
+        # The shared read has to cover every column, date and PUPRN that any of the selections needs
+        readcols = []
+        first_dates = []
+        last_dates = []
+        puprns = []
+        for selection in selections.values():
+            load_args = selection.get('load', {})
+            usecols = load_args.get('usecols', 'All')
+            selection_readcols, _ = self._columns_to_read(res, 'All' if usecols == 'All' else list(usecols),
+                                                          load_args.get('add_net_electricity_column', False),
+                                                          load_args.get('add_sum_gas_column', False))
+            if readcols is not None:
+                readcols = None if selection_readcols is None else readcols+[c for c in selection_readcols if c not in readcols]
+            first_dates.append(load_args.get('first_date', 'earliest_date') or 'earliest_date')
+            last_dates.append(load_args.get('last_date', 'latest_date') or 'latest_date')
+            filters = [load_args.get('filter_rows_on_participant_cat_data', 'No_filters'),
+                       load_args.get('filter_rows_on_survey_cat_data', 'No_filters')]
+            filters = ['No_filters' if isinstance(f, (dict, str)) and len(f)==0 else f for f in filters]
+            if puprns is not None:
+                selection_puprns = self._selected_puprns(participant_data, survey_data, filters[0], filters[1],
+                                                         data_picker_sampling.sample_spec(load_args.get('sample')))
+                puprns = None if selection_puprns is None else puprns+selection_puprns.tolist()
+        first_date = 'earliest_date' if 'earliest_date' in first_dates else min(first_dates)
+        last_date = 'latest_date' if 'latest_date' in last_dates else max(last_dates)
+        if puprns is not None:
+            puprns = pd.Index(puprns).unique()
+        shared = self._read_source(filename, readcols, first_date, last_date, puprns, source)
+        profile = self._active_profile()
+        if n_workers is None:
+            n_workers = profile.writer_workers()
+        if spill_directory is None:
+            spill_directory = profile.spill_directory
+
+        # Build each selection on top of the shared read
+        selectors = {}
+        for name, selection in selections.items():
+            print("\nSelection: "+name)
+            selectors[name] = copy.copy(self)
+            selectors[name].load_data(**dict(selection.get('load', {}), filename=filename, source=shared, lazy=True))
+
+        # Selections with cache=True that are already in the result cache are read back from there instead of from the
+        # shared pass, and the others are added to it as they're computed (see data_picker_result_cache.py)
+        cache_keys = {}
+        from_cache = []
+        for name, selection in selections.items():
+            load_args = selection.get('load', {})
+            if not load_args.get('cache', False):
+                continue
+            key = selectors[name]._cache_key(selectors[name].cache_args, source)
+            if key is None or key in cache_keys.values():
+                continue
+            if data_picker_result_cache.ResultCache().description(key) is None:
+                cache_keys[name] = key
+                continue
+            print("\nSelection: "+name+" (from the result cache)")
+            save_args = selection.get('save')
+            selectors[name].load_data(**dict(load_args, filename=filename, source=source, lazy=save_args is not None))
+            if save_args is not None:
+                selectors[name].save_data(**save_args)
+            from_cache.append(name)
+
+        # Then compute the rest together, a window of source partitions at a time, so each partition is only read once
+        names = [name for name in selectors if name not in from_cache]
+        streams = {}
+        writers = {}
+        in_memory = {}
+        for name in names:
+            save_args = selections[name].get('save')
+            if save_args is None:
+                in_memory[name] = []
+                continue
+            streams[name] = data_picker_writer.StreamMetadata()
+            output_directory = save_args.get('output_directory', 'Data')
+            if not os.path.exists(output_directory):
+                os.makedirs(output_directory)
+            save_method = save_args.get('save_method', 'per_home')
+            selectors[name].file_format = save_args.get('file_format', 'csv')
+            if save_method in ['per_home', 'single_file']:
+                output = os.path.join(output_directory, save_args['output_filename'])
+                if save_method == 'single_file':
+                    output = output+data_picker_formats.extension(selectors[name].file_format)
+                writers[name] = data_picker_writer.SpillingWriter(save_method, output, selectors[name].data.columns,
+                                                                  sortcols=['PUPRN',selectors[name].datecol],
+                                                                  n_workers=save_args.get('n_workers', n_workers),
+                                                                  spill_directory=save_args.get('spill_directory', spill_directory),
+                                                                  file_format=selectors[name].file_format)
+        # Not optimised one by one, or the read would be fused into each selection's own tasks and no longer shared
+        partitions = [selectors[name].data.to_delayed(optimize_graph=False) for name in names]
+        if len(set(len(p) for p in partitions)) > 1:
+            raise ValueError("The selections in a batch don't have the same partitions, so can't be computed together.")
+        # Each selection's row counts are computed alongside its partitions
+        checkpoints = [selectors[name].run_record.checkpoint_partitions() for name in names]
+        for name in names:
+            selectors[name].run_record.reset_counts()
+        cache_writers = {name: data_picker_result_cache.ResultCache().writer(key, selectors[name].cache_args)
+                         for name, key in cache_keys.items()}
+        try:
+            n_partitions = 0
+            with self.run_record.stage('compute the selections together (read, filter, merge, write)', profile_tasks=True):
+                tasks = [(list(parts), [[c[i] for c in selection_checkpoints] for selection_checkpoints in checkpoints])
+                         for i, parts in enumerate(zip(*partitions))]
+                # One source partition per worker is computed at a time, with every selection built on it - dask only
+                # runs the tasks they share (reading the source partition) once
+                with profile.activate():
+                    for parts, counts in data_picker_writer.compute_in_windows(tasks, profile.n_workers):
+                        for name, selection_counts in zip(names, counts):
+                            selectors[name].run_record.add_counts(selection_counts)
+                        for name, part in zip(names, parts):
+                            if name in cache_writers:
+                                cache_writers[name].add(part)
+                            if name in in_memory:
+                                in_memory[name].append(part)
+                                continue
+                            streams[name].update(part)
+                            if name in writers:
+                                writers[name].add(part)
+                        n_partitions = n_partitions + 1
+                        if n_partitions % 50 == 0:
+                            print(n_partitions, "partitions processed. Continuing...")
+
+            for name in names:
+                selector = selectors[name]
+                selector.run_record.include(self.run_record)
+                if name in cache_writers:
+                    cache_writers.pop(name).finish()
+                if name in in_memory:
+                    parts = in_memory.pop(name)
+                    data = pd.concat(parts, ignore_index=True) if len(parts) > 0 else selector.data._meta
+                    data['PUPRN']=serl_schema.puprn_categorical(data.PUPRN)
+                    selector.data = data
+                    continue
+                save_args = selections[name]['save']
+                if name in writers:
+                    print("\nWriting selection: "+name)
+                    homes_saved = writers.pop(name).finish()
+                    if homes_saved is not None:
+                        print(homes_saved, "homes saved.")
+                metadata_filename = "Metadata_about_"+save_args['output_filename']+".csv"
+                selector._record_metadata(streams[name], metadata_filename, save_args.get('output_directory', 'Data'))
+        finally:
+            for writer in list(writers.values())+list(cache_writers.values()):
+                writer.cleanup()
+        print("\nProcess completed successfully - all requested selections should now be loaded / saved.")
+        return selectors
+
+    def iter_homes(self, spill_directory=None):
+        '''Yield (PUPRN, dataframe) for each home in the loaded data, in PUPRN order, with each home's data sorted by
+        date/time - the same as reading back each file saved with save_method="per_home", but without writing them.
+        Only a bucket of homes is held in memory at a time if load_data was called with lazy=True.'''
+        profile = self._active_profile()
+        if spill_directory is None:
+            spill_directory = profile.spill_directory
+        with profile.activate():
+            for puprn, homedata in data_picker_writer.iter_homes(self.data, sortcols=['PUPRN',self.datecol],
+                                                                 spill_directory=spill_directory):
+                yield puprn, homedata
+
+    def close(self):
+        '''Shut down the local dask cluster, if one was started for this selector's selections (see
+        data_picker_execution.py). Also done at the end of a with block: with SerlDataSelector('hh') as selector: ...'''
+        self.profile.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
     # Save the metadata about what the file does and doesn't include
     def save_metadata (self, metadata_filename='metadata.txt', output_directory='Output'):
         data = self.data
         # Gathers some metadata to report back
         cols_in_df=data.columns.tolist()
-        try:
-            potential_PUPRNs_included=len(participant_list)
-        except:
+        if self.participant_list is not None:
+            potential_PUPRNs_included=len(self.participant_list)
+        else:
             potential_PUPRNs_included='All'
-        number_rows_in_df = len(data.index)
+        number_rows_in_df = self.number_rows_in_df
         #number_PUPRNs_in_df = len(data.PUPRN.unique().tolist())
         # the next three lines take a long time to run - at least make the list of PUPRNs re-usable..
         number_PUPRNs_in_df = len(self.puprns)
@@ -342,18 +802,26 @@ class SerlDataSelector(object):
                'Was an additional gas kWh column added based on Gas_hh_sum_m3? (only applies to daily data with Gas_hh_sum_m3 selected)':self.add_gas_hh_sum,
                'Was an additional net electricity kWh column added based on (Elec_act_imp_hh_Wh - Elec_act_exp_hh_Wh)? (only applies to half-hourly data with Elec_act_imp_hh_Wh and Elec_act_exp_hh_Wh selected)':self.add_net_electricity_column ,
                'Resultant number of unique PUPRNs in the dataframe that met all criteria AND had energy data':number_PUPRNs_in_df,
-               'Resultant number of rows':number_rows_in_df
+               'Resultant number of rows':number_rows_in_df,
+               'Format of the saved data':getattr(self, 'file_format', 'csv'),
+               'Sample of PUPRNs':data_picker_sampling.describe(getattr(self, 'sample', None))
                }
+        # Where the time, rows and memory went (see data_picker_run_record.py)
+        metadata.update(self.run_record.metadata())
         if not os.path.exists(output_directory):
             os.makedirs(output_directory)
         with open(os.path.join(output_directory,metadata_filename), 'w',newline='') as f:
             for key in metadata.keys():
                 f.write("%s, %s\n" % (key, metadata[key]))
+        # The run record is also saved as json, for comparing runs
+        run_record_filename = os.path.splitext(metadata_filename)[0]+"_run_record.json"
+        self.run_record.save(os.path.join(output_directory,run_record_filename))
     
         # Feed back some info about the outputs
         print("File saved in directory: ",output_directory,
             "\nDescription of its contents saved as: ",metadata_filename,
+            "\nRun record saved as: ",run_record_filename,
             "\n\nHere is that description, for reference:\n")
         for key, value in metadata.items():
             print(key, ': ', value)
-        print("\nHere's a sample of the dataframe (the head):\n(NB. The saved csv excludes the index.)\n", data.head())
+        print("\nHere's a sample of the dataframe (the head):\n(NB. The saved data excludes the index.)\n", self.data_head)
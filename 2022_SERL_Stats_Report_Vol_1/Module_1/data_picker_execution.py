@@ -0,0 +1,174 @@
+"""
+Execution profiles for the data picker
+
+An ExecutionProfile says how dask runs a selection: which scheduler (threads,
+processes, or a local dask.distributed cluster), how many workers, how much
+memory each worker may use, and how big each partition of the csv files is
+(read_csv's blocksize).
+
+By default the profile is worked out from the machine (CPUs and memory) and the
+size of the data files being read (from the manifest, if there is one):
+- blocksize is chosen so that every worker has a few partitions to work on, and
+  a parsed partition (several times bigger in memory than the csv text) takes up
+  only a small part of a worker's memory.
+- if dask.distributed is installed and the data is bigger than a quarter of the
+  machine's memory, a local cluster of single-threaded worker processes is used,
+  each with a memory limit, so that workers spill to disk rather than running
+  out of memory. Otherwise dask's threaded scheduler is used.
+
+So the same notebook can run on a laptop or on a large analysis node. A profile
+can also be given explicitly, e.g. SerlDataSelector('hh', profile=
+ExecutionProfile(scheduler='distributed', n_workers=16, memory_limit='8GB')).
+
+The profiles resolved for each selection share the local cluster of the profile
+they were resolved from, so a selector starts at most one cluster, whichever
+selections it makes, and it's reused as long as the workers asked for are the
+same. It's shut down by close() (or SerlDataSelector.close, or at the end of a
+with block on the selector). The worker pools that write the data out get the
+cores that aren't taken by the cluster's workers (see writer_workers).
+"""
+import os
+import contextlib
+import dask
+from dask.utils import parse_bytes, format_bytes
+
+try:
+    # Optional - only needed for scheduler='distributed'
+    from dask.distributed import Client, LocalCluster
+except ImportError:
+    Client = None
+    LocalCluster = None
+
+SCHEDULERS = ['threads', 'processes', 'synchronous', 'distributed']
+# How many times bigger a parsed partition is in memory than its csv text, roughly (for the SERL files)
+CSV_MEMORY_EXPANSION = 4
+MIN_BLOCKSIZE = 16*2**20
+MAX_BLOCKSIZE = 256*2**20
+PARTITIONS_PER_WORKER = 4
+# Spread the partitions in a worker's memory limit over this many at once (being parsed, filtered, handed on...)
+PARTITIONS_IN_MEMORY = 8
+
+
+def total_memory():
+    '''Total memory of this machine in bytes, or None if it can't be found.'''
+    try:
+        import psutil
+        return psutil.virtual_memory().total
+    except ImportError:
+        pass
+    try:
+        return os.sysconf('SC_PAGE_SIZE')*os.sysconf('SC_PHYS_PAGES')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def _as_bytes(size):
+    if size is None or isinstance(size, (int, float)):
+        return size
+    return parse_bytes(size)
+
+
+class ExecutionProfile(object):
+    """How dask runs a selection. Anything left as None is worked out from the machine and the data (see resolve)."""
+
+    def __init__(self, scheduler=None, n_workers=None, memory_limit=None, blocksize=None, spill_directory=None):
+        if scheduler is not None and scheduler not in SCHEDULERS:
+            raise ValueError("Unknown scheduler '"+str(scheduler)+"' - use one of: "+", ".join(SCHEDULERS))
+        if scheduler == 'distributed' and LocalCluster is None:
+            raise ImportError("scheduler='distributed' needs dask.distributed - install it with pip install distributed")
+        self.scheduler = scheduler
+        self.n_workers = n_workers
+        self.memory_limit = _as_bytes(memory_limit) # Per worker
+        self.blocksize = _as_bytes(blocksize)
+        self.spill_directory = spill_directory
+        self._client = None
+        self._client_workers = None
+        # The profile whose local cluster this one uses - itself, unless it was made by resolve or with_scheduler
+        self._owner = self
+
+    def resolve(self, data_bytes=None):
+        '''Return a copy of this profile with the settings left as None filled in, for reading data_bytes of csv.'''
+        memory = total_memory()
+        scheduler = self.scheduler
+        if scheduler is None:
+            big = data_bytes is not None and memory is not None and data_bytes*CSV_MEMORY_EXPANSION > memory/4
+            scheduler = 'distributed' if big and LocalCluster is not None else 'threads'
+        n_workers = self.n_workers
+        if n_workers is None:
+            n_workers = 1 if scheduler == 'synchronous' else os.cpu_count() or 1
+        memory_limit = self.memory_limit
+        if memory_limit is None and memory is not None:
+            # Leave a fifth of the memory for everything else
+            memory_limit = int(0.8*memory/n_workers)
+        blocksize = self.blocksize
+        if blocksize is None:
+            blocksize = MAX_BLOCKSIZE
+            if memory_limit is not None:
+                blocksize = min(blocksize, memory_limit//(CSV_MEMORY_EXPANSION*PARTITIONS_IN_MEMORY))
+            if data_bytes is not None:
+                blocksize = min(blocksize, data_bytes//(n_workers*PARTITIONS_PER_WORKER))
+            blocksize = int(max(blocksize, MIN_BLOCKSIZE))
+        return self._copy(scheduler, n_workers, memory_limit, blocksize)
+
+    def with_scheduler(self, scheduler):
+        '''Return a copy of this (resolved) profile that uses scheduler, sharing its local cluster.'''
+        return self._copy(scheduler, self.n_workers, self.memory_limit, self.blocksize)
+
+    def _copy(self, scheduler, n_workers, memory_limit, blocksize):
+        copied = ExecutionProfile(scheduler, n_workers, memory_limit, blocksize, self.spill_directory)
+        copied._owner = self._owner
+        return copied
+
+    def writer_workers(self):
+        '''How many worker processes to write the data out with: the cores not taken by the local cluster's workers
+        (at least 1). The threads and processes schedulers' workers are only busy while dask computes, not while the
+        data is written, so then it's n_workers.'''
+        if self.scheduler != 'distributed':
+            return self.n_workers
+        return max(1, (os.cpu_count() or 1) - self.n_workers)
+
+    def describe(self):
+        return {'scheduler': self.scheduler,
+                'n_workers': self.n_workers,
+                'memory_limit': None if self.memory_limit is None else format_bytes(self.memory_limit),
+                'blocksize': None if self.blocksize is None else format_bytes(self.blocksize)}
+
+    def __repr__(self):
+        return 'ExecutionProfile('+', '.join(k+'='+repr(v) for k, v in self.describe().items())+')'
+
+    @contextlib.contextmanager
+    def activate(self):
+        '''Run the dask computations inside the with block with this profile's scheduler and workers.'''
+        if self.scheduler == 'distributed':
+            # num_workers is also how many partitions are computed at a time (see data_picker_writer.compute_in_windows)
+            with dask.config.set(scheduler=self._owner._cluster_client(self), num_workers=self.n_workers):
+                yield
+        else:
+            with dask.config.set(scheduler=self.scheduler, num_workers=self.n_workers):
+                yield
+
+    def _cluster_client(self, profile):
+        # The client of the local cluster for profile (one resolved from this one). The cluster is started once and
+        # kept for later computations, unless a profile asks for different workers. Workers spill to spill_directory
+        # when they near their memory limit.
+        workers = (profile.n_workers, profile.memory_limit, profile.spill_directory)
+        if self._client is not None and self._client_workers != workers:
+            self.close()
+        if self._client is None:
+            cluster = LocalCluster(n_workers=profile.n_workers, threads_per_worker=1, processes=True,
+                                   memory_limit=profile.memory_limit if profile.memory_limit is not None else 'auto',
+                                   local_directory=profile.spill_directory)
+            self._client = Client(cluster, set_as_default=False)
+            self._client_workers = workers
+            print("Started a local dask cluster: "+str(self._client.dashboard_link))
+        return self._client
+
+    def close(self):
+        '''Shut down the local cluster, if one was started (by this profile or any profile resolved from it).'''
+        owner = self._owner
+        if owner._client is not None:
+            cluster = owner._client.cluster
+            owner._client.close()
+            cluster.close()
+            owner._client = None
+            owner._client_workers = None
@@ -0,0 +1,193 @@
+"""
+Output file formats for the data picker
+
+save_data can write its outputs as csv (the default), gzipped csv, parquet or
+feather. Parquet and feather keep the column dtypes, so they're much quicker
+to read back than csv as well as smaller; gzipped csv is still readable by
+anything that reads csv.
+
+A single file is written in chunks. For csv and gzipped csv, turning each
+chunk into text (and compressing it) is the slow part, so that's done by a
+pool of worker processes while the chunks are written out in order - a gzip
+file made of several compressed chunks one after the other is still a valid
+gzip file. Parquet files get a row group per chunk, feather files a record
+batch per chunk.
+
+read_frame reads any of these formats back, so the Module 1 notebooks and
+Module 2 don't need to know which format the data picker wrote.
+"""
+import os
+import gzip
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+
+FILE_FORMATS = {'csv': '.csv', 'csv.gz': '.csv.gz', 'parquet': '.parquet', 'feather': '.feather'}
+DEFAULT_CHUNK_ROWS = 250000
+
+
+def extension(file_format):
+    '''The file extension for file_format.'''
+    if file_format not in FILE_FORMATS:
+        raise ValueError("Unknown file_format '"+str(file_format)+"' - use one of: "+", ".join(FILE_FORMATS))
+    return FILE_FORMATS[file_format]
+
+
+def format_of(path):
+    '''The format of the file at path, from its extension, or None if it isn't one of the data picker's formats.'''
+    # Longest first, so '.csv.gz' isn't taken for '.gz'
+    for file_format, ext in sorted(FILE_FORMATS.items(), key=lambda item: -len(item[1])):
+        if str(path).lower().endswith(ext):
+            return file_format
+    return None
+
+
+def is_data_file(path):
+    return format_of(path) is not None
+
+
+def strip_extension(path):
+    '''The file name without its data file extension, e.g. the PUPRN of a per-home file.'''
+    name = os.path.basename(str(path))
+    file_format = format_of(name)
+    if file_format is None:
+        return name
+    return name[:-len(FILE_FORMATS[file_format])]
+
+
+def find_data_file(directory, name):
+    '''The path of the data file called name (with or without its extension) in directory, in whichever format it
+    was saved. Returns the csv path if there isn't one, so the error mentions the expected file.'''
+    stem = strip_extension(name)
+    for ext in FILE_FORMATS.values():
+        path = os.path.join(directory, stem+ext)
+        if os.path.exists(path):
+            return path
+    return os.path.join(directory, stem+'.csv')
+
+
+def _for_arrow(data):
+    # Categorical PUPRNs would be stored with each file's own categories - store them as plain strings instead
+    if 'PUPRN' in data.columns and isinstance(data.PUPRN.dtype, pd.CategoricalDtype):
+        data = data.assign(PUPRN=data.PUPRN.astype(str))
+    return data.reset_index(drop=True)
+
+
+def write_frame(data, path, file_format='csv'):
+    '''Write a whole (pandas) dataframe, without its index, to path in file_format.'''
+    if file_format == 'csv':
+        data.to_csv(path, index=False)
+    elif file_format == 'csv.gz':
+        data.to_csv(path, index=False, compression='gzip')
+    elif file_format == 'parquet':
+        _for_arrow(data).to_parquet(path, index=False)
+    elif file_format == 'feather':
+        _for_arrow(data).to_feather(path)
+    else:
+        extension(file_format)
+
+
+def read_frame(path, usecols=None, index_col=None, parse_dates=None, dtype=None, **read_csv_kwargs):
+    '''Read a data file written in any of the data picker's formats, with the same arguments (and result) as
+    pd.read_csv for the commonly used ones. Any other read_csv arguments are only used for csv files.'''
+    file_format = format_of(path)
+    if file_format is None or file_format in ['csv', 'csv.gz']:
+        return pd.read_csv(path, usecols=usecols, index_col=index_col, parse_dates=parse_dates, dtype=dtype,
+                           **read_csv_kwargs)
+    if file_format == 'parquet':
+        data = pd.read_parquet(path, columns=usecols)
+    else:
+        data = pd.read_feather(path, columns=usecols)
+    if dtype is not None:
+        declared = {col: d for col, d in dtype.items() if col in data.columns and str(data[col].dtype) != str(d)}
+        if len(declared) > 0:
+            data = data.astype(declared)
+    for col in (parse_dates or []):
+        # Columns can be given by name or position, as for read_csv
+        col = data.columns[col] if isinstance(col, int) else col
+        data[col] = pd.to_datetime(data[col])
+    if index_col is not None:
+        data = data.set_index(index_col)
+    return data
+
+
+def _encode_csv(chunk, header, compress):
+    # Format one chunk as csv text (and gzip it), in a worker process
+    text = chunk.to_csv(header=header, index=False).encode()
+    if compress:
+        return gzip.compress(text)
+    return text
+
+
+def _ordered_map(pool, fn, args, ahead):
+    # Like pool.map, but only keeps `ahead` chunks in flight, so the chunks aren't all held in memory at once
+    pending = deque()
+    for arg in args:
+        pending.append(pool.submit(fn, *arg))
+        if len(pending) >= ahead:
+            yield pending.popleft().result()
+    while len(pending) > 0:
+        yield pending.popleft().result()
+
+
+def _chunks(blocks, chunk_rows):
+    for block in blocks:
+        for start in range(0, len(block.index), chunk_rows):
+            yield block.iloc[start:start+chunk_rows]
+
+
+def _write_csv_chunks(chunks, output_file, columns, compress, n_workers):
+    header = [True]
+
+    def encode_args():
+        for chunk in chunks:
+            yield chunk, header[0], compress
+            header[0] = False
+
+    if n_workers is None:
+        n_workers = os.cpu_count()
+    with open(output_file, 'wb') as f:
+        if n_workers <= 1:
+            for args in encode_args():
+                f.write(_encode_csv(*args))
+        else:
+            with ProcessPoolExecutor(max_workers=n_workers) as pool:
+                for encoded in _ordered_map(pool, _encode_csv, encode_args(), ahead=2*n_workers):
+                    f.write(encoded)
+        if header[0]:
+            # No rows at all - still write the column names
+            f.write(_encode_csv(pd.DataFrame(columns=columns), True, compress))
+
+
+def _write_arrow_chunks(chunks, output_file, columns, file_format):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    writer = None
+    schema = None
+    try:
+        for chunk in chunks:
+            chunk = _for_arrow(chunk)
+            if writer is None:
+                schema = pa.Schema.from_pandas(chunk, preserve_index=False)
+                if file_format == 'parquet':
+                    writer = pq.ParquetWriter(output_file, schema)
+                else:
+                    writer = pa.ipc.new_file(output_file, schema, options=pa.ipc.IpcWriteOptions(compression='lz4'))
+            # Every chunk is stored with the first chunk's schema (e.g. a column that's all empty in one chunk)
+            writer.write_table(pa.Table.from_pandas(chunk, schema=schema, preserve_index=False))
+        if writer is None:
+            write_frame(pd.DataFrame(columns=columns), output_file, file_format)
+    finally:
+        if writer is not None:
+            writer.close()
+
+
+def write_chunked(blocks, output_file, columns, file_format='csv', n_workers=None, chunk_rows=DEFAULT_CHUNK_ROWS):
+    '''Write (pandas) blocks one after the other into a single file in file_format, in chunks of chunk_rows rows.
+    csv and gzipped csv chunks are formatted by n_workers worker processes.'''
+    extension(file_format)
+    chunks = _chunks(blocks, chunk_rows)
+    if file_format in ['csv', 'csv.gz']:
+        _write_csv_chunks(chunks, output_file, columns, file_format == 'csv.gz', n_workers)
+    else:
+        _write_arrow_chunks(chunks, output_file, columns, file_format)
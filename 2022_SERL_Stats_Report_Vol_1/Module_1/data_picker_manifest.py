@@ -0,0 +1,104 @@
+"""
+SERL smart meter file manifest
+
+Records, for each serl_smart_meter*.csv file in a data directory, its size,
+row count, earliest and latest Read_date_effective_local and the PUPRNs it
+contains. The manifest is built once per edition of the Observatory data
+(locations.serl_data_version) and saved as json in
+locations.manifest_directory, then reused by the data picker to work out the
+smallest set of files that can contain the dates and PUPRNs asked for.
+"""
+import os
+import glob
+import json
+import fnmatch
+from pathlib import Path
+import pandas as pd
+import locations # This is a separate Python script specifying the locations of all the different SERL data within the SERL secure environment.
+
+DATECOL = 'Read_date_effective_local'
+CHUNKSIZE = 2000000
+
+
+def manifest_path(folder_path):
+    '''Where the manifest for this data directory and edition is saved.'''
+    return os.path.join(locations.manifest_directory,
+                        'manifest_'+locations.serl_data_version+'_'+Path(folder_path).name+'.json')
+
+
+def build_manifest(folder_path, file_identifier="serl_smart_meter*.csv", save=True):
+    '''Scan every data file in folder_path once and record what's in it. Only the PUPRN and date columns
+    are read, in chunks, so this doesn't need much memory even for the hh files.'''
+    filenames = sorted(glob.glob(os.path.join(folder_path, file_identifier)))
+    print('Building manifest for {} data files in {}'.format(len(filenames), folder_path))
+    files = []
+    for filename in filenames:
+        n_rows = 0
+        min_date = None
+        max_date = None
+        puprns = set()
+        for chunk in pd.read_csv(filename, usecols=['PUPRN', DATECOL], chunksize=CHUNKSIZE):
+            if len(chunk.index) == 0:
+                continue
+            n_rows = n_rows + len(chunk.index)
+            chunk_min = chunk[DATECOL].min()
+            chunk_max = chunk[DATECOL].max()
+            min_date = chunk_min if min_date is None else min(min_date, chunk_min)
+            max_date = chunk_max if max_date is None else max(max_date, chunk_max)
+            puprns.update(chunk.PUPRN.unique().tolist())
+        files.append({'filename': os.path.basename(filename),
+                      'size_bytes': os.path.getsize(filename),
+                      'n_rows': n_rows,
+                      'min_date': min_date,
+                      'max_date': max_date,
+                      'n_puprns': len(puprns),
+                      'puprns': sorted(puprns, key=str.lower)})
+        print("Indexed "+os.path.basename(filename)+" ("+str(n_rows)+" rows, "+str(min_date)+" to "+str(max_date)+")")
+    manifest = {'serl_data_version': locations.serl_data_version,
+                'folder_path': str(folder_path),
+                'files': files}
+    if save:
+        save_manifest(manifest, folder_path)
+    return manifest
+
+
+def save_manifest(manifest, folder_path):
+    if not os.path.exists(locations.manifest_directory):
+        os.makedirs(locations.manifest_directory)
+    with open(manifest_path(folder_path), 'w') as f:
+        json.dump(manifest, f)
+    print("Manifest saved as: "+manifest_path(folder_path))
+
+
+def load_manifest(folder_path):
+    '''Return the saved manifest for folder_path, or None if there isn't one for this edition of the data.'''
+    path = manifest_path(folder_path)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        manifest = json.load(f)
+    if manifest.get('serl_data_version') != locations.serl_data_version:
+        return None
+    return manifest
+
+
+def plan_files(manifest, folder_path, filename='*', first_date='earliest_date', last_date='latest_date', puprns=None):
+    '''Return the full paths of the files listed in the manifest that match the filename pattern (YYYY and MM
+    are treated as wildcards) and that can contain rows in the date range for any of the PUPRNs.'''
+    pattern = filename.replace('YYYY', '*').replace('MM', '*')
+    if puprns is not None:
+        puprns = set(puprns)
+    filelist = []
+    for entry in manifest['files']:
+        if not fnmatch.fnmatch(entry['filename'], pattern):
+            continue
+        if entry['n_rows'] == 0:
+            continue
+        if first_date != 'earliest_date' and entry['max_date'] < first_date:
+            continue
+        if last_date != 'latest_date' and entry['min_date'] > last_date:
+            continue
+        if puprns is not None and puprns.isdisjoint(entry['puprns']):
+            continue
+        filelist.append(os.path.join(folder_path, entry['filename']))
+    return filelist
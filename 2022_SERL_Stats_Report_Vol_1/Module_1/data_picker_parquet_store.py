@@ -0,0 +1,110 @@
+"""
+SERL smart meter parquet store
+
+A one-off conversion of the serl_smart_meter*.csv files into a partitioned
+parquet dataset, laid out as <store>/year=YYYY/month=MM/<source file>.parquet
+(partitioned on Read_date_effective_local), with rows sorted by PUPRN so that
+each row group covers a narrow range of PUPRNs. The data picker can then read
+it with load_data(source='parquet'), which only opens the year/month
+partitions in the requested date range and lets parquet skip row groups that
+can't match the PUPRN and date filters.
+
+Run this file directly to convert both the daily and hh data listed in
+locations.py.
+"""
+import os
+import glob
+from pathlib import Path
+import pandas as pd
+import dask.dataframe as dd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import locations # This is a separate Python script specifying the locations of all the different SERL data within the SERL secure environment.
+
+DEFAULT_ROW_GROUP_SIZE = 250000
+DATECOL = 'Read_date_effective_local'
+ENERGY_DTYPES = {'Elec_act_imp_hh_Wh': 'float64','Elec_act_exp_hh_Wh': 'float64','Gas_hh_Wh': 'float64'}
+
+
+def convert_csv_to_parquet(csv_folder, parquet_folder, file_identifier="serl_smart_meter*.csv",
+                           row_group_size=DEFAULT_ROW_GROUP_SIZE, overwrite=False):
+    '''Convert every smart meter csv in csv_folder into the partitioned parquet store in parquet_folder.
+    Each csv is converted on its own, so only one file's worth of data is in memory at a time. Files
+    that have already been converted are skipped unless overwrite is True.'''
+    filenames = sorted(glob.glob(os.path.join(csv_folder, file_identifier)))
+    print('Found {} data files to convert'.format(len(filenames)))
+    for filename in filenames:
+        stem = Path(filename).stem
+        existing = glob.glob(os.path.join(parquet_folder, 'year=*', 'month=*', stem+'.parquet'))
+        if len(existing) > 0 and not overwrite:
+            print("Already converted, skipping: "+stem)
+            continue
+        for old_file in existing:
+            os.remove(old_file)
+        data = pd.read_csv(filename, dtype=ENERGY_DTYPES)
+        # Sort so each row group holds a narrow, contiguous range of PUPRNs
+        sortcols = ['PUPRN', 'Read_date_time_UTC'] if 'Read_date_time_UTC' in data.columns else ['PUPRN', DATECOL]
+        data = data.sort_values(by=sortcols)
+        # Monthly files in UTC can spill over into a neighbouring local month, so split on the local date
+        year_month = data[DATECOL].str.slice(0, 7)
+        for ym in sorted(year_month.unique()):
+            partition_dir = os.path.join(parquet_folder, 'year='+ym[0:4], 'month='+ym[5:7])
+            if not os.path.exists(partition_dir):
+                os.makedirs(partition_dir)
+            table = pa.Table.from_pandas(data[year_month == ym], preserve_index=False)
+            pq.write_table(table, os.path.join(partition_dir, stem+'.parquet'), row_group_size=row_group_size)
+        print("Converted "+stem+" ("+str(len(data.index))+" rows)")
+    print("\nConversion completed - the parquet store is in: "+str(parquet_folder))
+
+
+def list_store_files(parquet_folder, first_date='earliest_date', last_date='latest_date'):
+    '''Return the parquet files in the year/month partitions that overlap the requested date range.'''
+    filelist = []
+    for partition_dir in sorted(glob.glob(os.path.join(parquet_folder, 'year=*', 'month=*'))):
+        year = os.path.basename(os.path.dirname(partition_dir))[len('year='):]
+        month = os.path.basename(partition_dir)[len('month='):]
+        ym = year+'-'+month
+        # Compare on YYYY-MM, so the partitions holding first_date and last_date are kept
+        if first_date != 'earliest_date' and ym < first_date[0:7]:
+            continue
+        if last_date != 'latest_date' and ym > last_date[0:7]:
+            continue
+        filelist.extend(sorted(glob.glob(os.path.join(partition_dir, '*.parquet'))))
+    return filelist
+
+
+def read_store(parquet_folder, columns=None, first_date='earliest_date', last_date='latest_date', puprns=None):
+    '''Lazily read the parquet store with dask, only loading the requested columns and the partitions in
+    the date range. The date and PUPRN conditions are also passed down as parquet filters, so row groups
+    whose statistics show they can't match are skipped. Rows are not filtered here - the caller still
+    needs to apply the row-level filters.'''
+    filelist = list_store_files(parquet_folder, first_date, last_date)
+    print("Found "+str(len(filelist))+" parquet files to load / select from.")
+    filters = []
+    if first_date != 'earliest_date':
+        filters.append((DATECOL, '>=', first_date))
+    if last_date != 'latest_date':
+        filters.append((DATECOL, '<=', last_date))
+    if puprns is not None:
+        filters.append(('PUPRN', 'in', list(puprns)))
+    # Keep the columns in the same order as in the csv files, as read_csv with usecols does
+    if columns is not None and len(filelist) > 0:
+        columns = [c for c in pq.read_schema(filelist[0]).names if c in columns]
+    data = dd.read_parquet(filelist, columns=columns, filters=filters if len(filters) > 0 else None,
+                           engine='pyarrow', index=False)
+    # Don't return the hive partition columns if they were picked up from the directory names
+    partition_cols = [c for c in ['year', 'month'] if c in data.columns]
+    if len(partition_cols) > 0:
+        data = data.drop(partition_cols, axis=1)
+    return data
+
+
+def main():
+    convert_csv_to_parquet(os.path.join(locations.serl_data_path, locations.energy_daily_directory),
+                           locations.energy_daily_parquet_directory)
+    convert_csv_to_parquet(os.path.join(locations.serl_data_path, locations.energy_hh_directory),
+                           locations.energy_hh_parquet_directory)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,220 @@
+"""
+Execution planning for the data picker
+
+Before load_data computes a selection, it estimates how big the selection will
+be in memory and picks one of three ways of running it:
+- 'in_memory': compute the whole selection into a pandas dataframe (as
+  load_data has always done). Used when it fits comfortably in memory.
+- 'streaming': keep the selection as a lazy dask dataframe, which save_data
+  (or iter_homes) computes a window of partitions at a time, writing them out (via a
+  spill to disk, sorted by PUPRN, for 'per_home' and 'single_file').
+- 'spill': streaming, but run on a local dask.distributed cluster whose
+  workers each have a memory limit and spill to disk as they near it, with a
+  partition per worker computed at a time. Used when even the source data
+  being read is much bigger than the machine's memory. The cluster is the
+  selector's own (see data_picker_execution.py), so it's started once and
+  reused by its later selections. Without dask.distributed, this falls back to
+  streaming.
+
+The estimate is:
+- rows: from the manifest (see data_picker_manifest.py) if there is one - the
+  rows in each file, scaled by the share of its dates in the date range and
+  the share of its PUPRNs that are selected. Without a manifest, from the
+  size of the files and the length of their first lines, scaled by the share
+  of all participants that are selected. The read flag filters aren't
+  counted, so this is an upper bound.
+- bytes per row: from the columns and dtypes of the selection (strings are
+  held as python objects, so cost far more than their characters).
+
+load_data(lazy='auto') (the default) uses the plan; lazy=False or True still
+forces a computed or lazy selection. load_data(dry_run=True) only reports the
+plan, without computing anything.
+"""
+import os
+import pandas as pd
+from dask.utils import format_bytes
+import data_picker_execution
+
+STRATEGIES = ['in_memory', 'streaming', 'spill']
+# The share of the machine's memory an in-memory selection may use, allowing for the copy made when the partitions
+# are put together (and any sorting afterwards)
+IN_MEMORY_FRACTION = 0.5
+COMPUTE_OVERHEAD = 2
+# A python string takes this many bytes more than its characters, including the pointer to it in the column
+STRING_OVERHEAD = 57
+# Characters in the string columns of the selection (anything else is taken as STRING_DEFAULT_WIDTH)
+STRING_WIDTHS = {'PUPRN': 8, 'Read_date_effective_local': 10, 'Read_date_time_local': 23, 'Read_date_time_UTC': 19,
+                 'Read_time_local': 8, 'Read_time_local_midpoint': 8, 'Timezone': 3}
+STRING_DEFAULT_WIDTH = 16
+CSV_SAMPLE_LINES = 1000
+
+
+def _csv_bytes_per_row(path):
+    # Average length of the first lines of a csv file (after the header)
+    lengths = []
+    with open(path, 'rb') as f:
+        f.readline()
+        for line in f:
+            lengths.append(len(line))
+            if len(lengths) >= CSV_SAMPLE_LINES:
+                break
+    if len(lengths) == 0:
+        return None
+    return sum(lengths)/len(lengths)
+
+
+def _file_rows(path):
+    # Rows in a data file without a manifest entry - exact for parquet, estimated for csv
+    if path.endswith('.parquet'):
+        import pyarrow.parquet as pq
+        return pq.ParquetFile(path).metadata.num_rows
+    bytes_per_row = _csv_bytes_per_row(path)
+    if bytes_per_row is None:
+        return 0
+    return os.path.getsize(path)/bytes_per_row
+
+
+def _date_share(entry, first_date, last_date):
+    # The share of a file's days (from its manifest entry) that are in the date range
+    first = pd.Timestamp(entry['min_date'])
+    last = pd.Timestamp(entry['max_date'])
+    days = (last-first).days+1
+    if first_date != 'earliest_date':
+        first = max(first, pd.Timestamp(first_date))
+    if last_date != 'latest_date':
+        last = min(last, pd.Timestamp(last_date))
+    return max((last-first).days+1, 0)/days
+
+
+def estimate_rows(filelist, manifest=None, first_date='earliest_date', last_date='latest_date', puprns=None,
+                  n_participants=None):
+    '''Estimate the rows of filelist that are for the PUPRNs (all if None) in the date range. Returns (rows, a
+    description of how they were estimated).'''
+    entries = {}
+    if manifest is not None:
+        entries = {entry['filename']: entry for entry in manifest['files']}
+    if puprns is not None:
+        puprns = set(puprns)
+    rows = 0
+    from_manifest = 0
+    for path in filelist:
+        entry = entries.get(os.path.basename(path))
+        if entry is None:
+            # Monthly files have already been picked by their dates, so only the PUPRN filter is allowed for
+            file_rows = _file_rows(path)
+            if puprns is not None and n_participants:
+                file_rows = file_rows*min(len(puprns)/n_participants, 1)
+            rows = rows+file_rows
+            continue
+        from_manifest = from_manifest+1
+        if entry['n_rows'] == 0:
+            continue
+        file_rows = entry['n_rows']*_date_share(entry, first_date, last_date)
+        if puprns is not None and entry['n_puprns'] > 0:
+            file_rows = file_rows*len(puprns.intersection(entry['puprns']))/entry['n_puprns']
+        rows = rows+file_rows
+    if len(filelist) == 0:
+        how = 'no files to read'
+    elif from_manifest == len(filelist):
+        how = 'from the manifest'
+    elif from_manifest == 0:
+        how = 'from the size of the files'
+    else:
+        how = 'from the manifest and the size of the files'
+    return int(rows), how+', before the read flag filters'
+
+
+def bytes_per_row(meta):
+    '''Estimated bytes per row in memory of a dataframe with the columns and dtypes of meta (an empty dataframe).'''
+    total = 0
+    for col, dtype in meta.dtypes.items():
+        if isinstance(dtype, pd.CategoricalDtype):
+            total = total+2
+        elif dtype == object or isinstance(dtype, pd.StringDtype):
+            total = total+STRING_OVERHEAD+STRING_WIDTHS.get(col, STRING_DEFAULT_WIDTH)
+        elif isinstance(dtype, pd.api.extensions.ExtensionDtype):
+            # Nullable types also hold a mask byte per value
+            total = total+getattr(dtype, 'itemsize', 8)+1
+        else:
+            total = total+dtype.itemsize
+    # The index
+    return total+8
+
+
+class ExecutionPlan(object):
+    """How load_data will run a selection, and why (see explain)"""
+
+    def __init__(self, strategy, n_rows, rows_how, row_bytes, input_bytes, memory, profile, notes=None):
+        self.strategy = strategy
+        self.n_rows = n_rows
+        self.rows_how = rows_how
+        self.row_bytes = row_bytes
+        self.output_bytes = n_rows*row_bytes
+        self.input_bytes = input_bytes
+        self.memory = memory
+        self.profile = profile
+        self.notes = notes or []
+
+    @property
+    def lazy(self):
+        return self.strategy != 'in_memory'
+
+    def describe(self):
+        return {'strategy': self.strategy,
+                'estimated_rows': self.n_rows,
+                'estimated_size_in_memory': format_bytes(self.output_bytes),
+                'data_read': None if self.input_bytes is None else format_bytes(self.input_bytes),
+                'machine_memory': None if self.memory is None else format_bytes(self.memory)}
+
+    def explain(self):
+        '''A description of the plan, and the estimate it's based on, to print.'''
+        lines = ["Execution plan: "+self.strategy,
+                 "- Estimated rows: "+str(self.n_rows)+" ("+self.rows_how+")",
+                 "- Estimated size in memory: "+format_bytes(self.output_bytes)
+                 + " ("+str(int(self.row_bytes))+" bytes per row)"]
+        if self.input_bytes is not None:
+            lines.append("- Data files to read: "+format_bytes(self.input_bytes))
+        lines.append("- Memory on this machine: "+("unknown" if self.memory is None else format_bytes(self.memory)))
+        lines.append("- Execution profile: "+str(self.profile))
+        for note in self.notes:
+            lines.append("- "+note)
+        return "\n".join(lines)
+
+    def __repr__(self):
+        return 'ExecutionPlan('+', '.join(k+'='+repr(v) for k, v in self.describe().items())+')'
+
+
+def plan(meta, n_rows, rows_how, input_bytes, profile, lazy='auto', requested_scheduler=None):
+    '''Choose how to run a selection with the columns of meta and about n_rows rows, read from input_bytes of data
+    files with the (resolved) execution profile. lazy=False or True restricts the choice to in_memory or to streaming
+    / spill. requested_scheduler is the scheduler the user asked for, if any, which is always kept.'''
+    memory = data_picker_execution.total_memory()
+    row_bytes = bytes_per_row(meta)
+    output_bytes = n_rows*row_bytes
+    notes = []
+    fits = memory is None or output_bytes*COMPUTE_OVERHEAD <= IN_MEMORY_FRACTION*memory
+    big_input = (memory is not None and input_bytes is not None
+                 and input_bytes*data_picker_execution.CSV_MEMORY_EXPANSION > memory/4)
+    if lazy == False:
+        strategy = 'in_memory'
+        if not fits:
+            notes.append("lazy=False was given, but this is unlikely to fit in memory - try lazy='auto'")
+    elif lazy == 'auto' and fits:
+        strategy = 'in_memory'
+    elif big_input or (memory is not None and output_bytes > memory) or profile.scheduler == 'distributed':
+        strategy = 'spill'
+    else:
+        strategy = 'streaming'
+    if strategy == 'spill' and profile.scheduler != 'distributed':
+        if requested_scheduler is not None:
+            notes.append("scheduler='"+requested_scheduler+"' was given, so workers won't spill to disk")
+        elif data_picker_execution.LocalCluster is None:
+            notes.append("dask.distributed isn't installed, so streaming with the "+profile.scheduler
+                         + " scheduler instead (install distributed for workers that spill to disk)")
+            strategy = 'streaming'
+        else:
+            # On the selector's local cluster, so it isn't started again for each selection
+            profile = profile.with_scheduler('distributed')
+    if strategy != 'in_memory':
+        notes.append("Nothing is computed until save_data or iter_homes, which work through the data a partition at a time")
+    return ExecutionPlan(strategy, n_rows, rows_how, row_bytes, input_bytes, memory, profile, notes)
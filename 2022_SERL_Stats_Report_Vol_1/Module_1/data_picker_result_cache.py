@@ -0,0 +1,210 @@
+"""
+On-disk cache of data picker selections
+
+load_data(cache=True) fingerprints everything that determines a selection:
+the load_data arguments, the size and modification time of the source data
+files and the contextual data files, the manifest (if there is one) and
+locations.serl_data_version. The selection is saved under that fingerprint in
+locations.result_cache_directory once it has been computed, and re-running the
+same selection on the same data reads it back from there instead of scanning
+the source files again. Selections that are computed in memory are saved in one
+go (ResultCache.put); lazy selections, and those made by load_batch, are saved
+a partition at a time as they're written (CacheWriter), so they're cached
+without ever being held in memory.
+
+The cache is kept under locations.result_cache_max_gb by removing the least
+recently used selections whenever a new one is added.
+"""
+import os
+import json
+import glob
+import time
+import shutil
+import hashlib
+import pandas as pd
+import dask.dataframe as dd
+import locations # This is a separate Python script specifying the locations of all the different SERL data within the SERL secure environment.
+
+# Change this whenever the data picker changes what a selection contains, so older cached results aren't used
+CACHE_VERSION = 1
+DEFAULT_MAX_GB = 50
+
+
+def file_signature(path):
+    stat = os.stat(path)
+    return [str(path), stat.st_size, stat.st_mtime]
+
+
+def fingerprint(args, source_files, manifest=None):
+    '''A key for the selection made with args (a dictionary of the load_data arguments) from source_files, which
+    changes if any of the arguments, files, manifest or the edition of the data do.'''
+    manifest_summary = None
+    if manifest is not None:
+        manifest_summary = [[entry['filename'], entry['size_bytes'], entry['n_rows'], entry['min_date'], entry['max_date']]
+                            for entry in manifest['files']]
+    description = {'cache_version': CACHE_VERSION,
+                   'serl_data_version': locations.serl_data_version,
+                   'args': args,
+                   'files': [file_signature(path) for path in sorted(source_files)],
+                   'manifest': manifest_summary}
+    return hashlib.sha256(json.dumps(description, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class ResultCache(object):
+    """The cached selections in cache_directory, each saved as parquet (or pickle) with a json description"""
+
+    def __init__(self, cache_directory=None, max_gb=None):
+        if cache_directory is None:
+            cache_directory = locations.result_cache_directory
+        if max_gb is None:
+            max_gb = getattr(locations, 'result_cache_max_gb', DEFAULT_MAX_GB)
+        self.cache_directory = cache_directory
+        self.max_bytes = max_gb * 1e9
+
+    def _description_path(self, key):
+        return os.path.join(self.cache_directory, key+'.json')
+
+    def description(self, key):
+        '''The json description of the cached selection for key (its arguments, rows, size...), or None.'''
+        description_path = self._description_path(key)
+        if not os.path.exists(description_path):
+            return None
+        with open(description_path) as f:
+            return json.load(f)
+
+    def get(self, key, lazy=False):
+        '''Return the cached selection for key (as a dask dataframe if lazy), or None if it isn't cached.'''
+        description = self.description(key)
+        if description is None:
+            return None
+        description_path = self._description_path(key)
+        data_path = os.path.join(self.cache_directory, description['data_file'])
+        if not os.path.exists(data_path):
+            return None
+        print("Found this selection in the result cache ("+str(description['n_rows'])+" rows, saved "+description['created']+").")
+        description['last_used'] = time.time()
+        with open(description_path, 'w') as f:
+            json.dump(description, f)
+        if description['format'] == 'parquet':
+            if lazy:
+                data = dd.read_parquet(data_path, engine='pyarrow')
+                # The writers compare PUPRNs across partitions, so don't hand them categoricals read file by file
+                data['PUPRN'] = data.PUPRN.astype(str)
+                return data
+            return pd.read_parquet(data_path)
+        data = pd.read_pickle(data_path)
+        if lazy:
+            data['PUPRN'] = data.PUPRN.astype(str)
+            return dd.from_pandas(data, npartitions=1)
+        return data
+
+    def put(self, key, data, args):
+        '''Save a computed (pandas) selection under key, then evict old selections if the cache is too big.'''
+        if not os.path.exists(self.cache_directory):
+            os.makedirs(self.cache_directory)
+        try:
+            data.to_parquet(os.path.join(self.cache_directory, key+'.parquet'))
+            data_format = 'parquet'
+        except (ImportError, ValueError, TypeError, NotImplementedError) as e:
+            print("Couldn't cache the selection as parquet ("+str(e)+"), caching as pickle instead.")
+            data.to_pickle(os.path.join(self.cache_directory, key+'.pkl'))
+            data_format = 'pkl'
+        self._describe(key, args, len(data.index), data_format)
+
+    def writer(self, key, args):
+        '''A CacheWriter to save the selection for key a partition at a time, as it's computed.'''
+        return CacheWriter(self, key, args)
+
+    def _describe(self, key, args, n_rows, data_format):
+        # Write the description of a saved selection - it's only found in the cache once this exists
+        description = {'key': key,
+                       'args': args,
+                       'n_rows': n_rows,
+                       'created': time.strftime("%Y-%m-%d %H:%M:%S"),
+                       'last_used': time.time(),
+                       'format': data_format,
+                       'data_file': key+'.'+data_format}
+        description['size_bytes'] = _size_bytes(os.path.join(self.cache_directory, description['data_file']))
+        with open(self._description_path(key), 'w') as f:
+            json.dump(description, f, default=str)
+        print("Selection saved in the result cache.")
+        self.evict(keep=key)
+
+    def entries(self):
+        '''The descriptions of all the cached selections, least recently used first.'''
+        descriptions = []
+        for description_path in glob.glob(os.path.join(self.cache_directory, '*.json')):
+            with open(description_path) as f:
+                descriptions.append(json.load(f))
+        return sorted(descriptions, key=lambda d: d['last_used'])
+
+    def remove(self, key):
+        for path in glob.glob(os.path.join(self.cache_directory, key+'.*')):
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+
+    def evict(self, keep=None):
+        '''Remove the least recently used selections until the cache fits in max_gb (never removing keep).'''
+        entries = self.entries()
+        total = sum(d['size_bytes'] for d in entries)
+        for description in entries:
+            if total <= self.max_bytes:
+                break
+            if description['key'] == keep:
+                continue
+            self.remove(description['key'])
+            total = total - description['size_bytes']
+            print("Removed an old selection from the result cache (last used "
+                  + time.strftime("%Y-%m-%d %H:%M", time.localtime(description['last_used']))+").")
+
+
+class CacheWriter(object):
+    """Saves a selection in the cache as its partitions are computed, one parquet file per partition in a key.parquet
+    directory. The selection is only found in the cache once finish is called."""
+
+    def __init__(self, cache, key, args):
+        self.cache = cache
+        self.key = key
+        self.args = args
+        self.data_path = os.path.join(cache.cache_directory, key+'.parquet')
+        self.n_rows = 0
+        self.n_parts = 0
+        self.failed = False
+        self.finished = False
+        # Start from nothing, in case an earlier attempt was interrupted
+        cache.remove(key)
+        os.makedirs(self.data_path)
+
+    def add(self, part):
+        if self.failed:
+            return
+        # PUPRN as a string, so the files don't each have their own categories
+        part = part.assign(PUPRN=part.PUPRN.astype(str))
+        try:
+            part.to_parquet(os.path.join(self.data_path, 'part.'+str(self.n_parts).zfill(5)+'.parquet'), index=False)
+        except (ImportError, ValueError, TypeError, NotImplementedError) as e:
+            print("Couldn't cache the selection as parquet ("+str(e)+"), so it won't be cached.")
+            self.failed = True
+            self.cleanup()
+            return
+        self.n_rows = self.n_rows + len(part.index)
+        self.n_parts = self.n_parts + 1
+
+    def finish(self):
+        if self.failed:
+            return
+        self.cache._describe(self.key, self.args, self.n_rows, 'parquet')
+        self.finished = True
+
+    def cleanup(self):
+        # Remove a partly written selection (after an error, or if it couldn't be saved)
+        if not self.finished:
+            self.cache.remove(self.key)
+
+
+def _size_bytes(path):
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+    return os.path.getsize(path)
@@ -0,0 +1,159 @@
+"""
+Run records for the data picker
+
+A RunRecord is kept for each selection (selector.run_record) and records where
+the time and memory went:
+- the wall clock and CPU time of each stage (reading the contextual data,
+  finding the files, building and computing the selection, writing it out)
+- the time the dask tasks spent in each kind of step (parsing the csv files,
+  each filter, merges...), from dask's Profiler. This isn't available with the
+  'distributed' scheduler, which has its own dashboard.
+- the number of files, bytes and partitions read
+- the number of rows after each step of the selection. These are counted
+  partition by partition as the selection is computed, in the same pass.
+- the peak memory used by this process
+
+save_metadata adds it to the metadata file and saves it as json beside it.
+"""
+import json
+import time
+import contextlib
+from datetime import datetime
+import dask
+from dask.utils import key_split, format_bytes
+import data_picker_writer
+
+try:
+    from dask.diagnostics import Profiler
+except ImportError:
+    Profiler = None
+
+
+def peak_memory():
+    '''Peak memory (resident set size) of this process so far, in bytes, or None if it can't be found.'''
+    try:
+        import resource
+        import sys
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Reported in kilobytes on Linux, bytes on macOS
+        return maxrss if sys.platform == 'darwin' else maxrss*1024
+    except ImportError:
+        pass
+    try:
+        import psutil
+        info = psutil.Process().memory_info()
+        return getattr(info, 'peak_wset', info.rss)
+    except ImportError:
+        return None
+
+
+class _CountedPartitions(object):
+    # Yields the partitions of a dask dataframe, counting the rows at each of the record's checkpoints on the way. The
+    # partitions are computed a window at a time (see data_picker_writer.compute_in_windows), each with its counts
+    def __init__(self, record, data):
+        self.record = record
+        self.data = data
+        self.columns = data.columns
+
+    def __iter__(self):
+        parts = self.data.to_delayed(optimize_graph=False)
+        checkpoints = self.record.checkpoint_partitions()
+        self.record.reset_counts()
+        tasks = [(part, [counts[i] for counts in checkpoints]) for i, part in enumerate(parts)]
+        for part, counts in data_picker_writer.compute_in_windows(tasks):
+            self.record.add_counts(counts)
+            yield part
+
+
+class RunRecord(object):
+    """Timings, row counts and memory for one selection"""
+
+    def __init__(self):
+        self.started = datetime.now().isoformat(timespec='seconds')
+        self.stages = []
+        self.task_seconds = {}
+        self.counters = {}
+        self.rows = {}
+        self._checkpoints = []
+
+    @contextlib.contextmanager
+    def stage(self, name, profile_tasks=False):
+        '''Time the with block as the stage called name. With profile_tasks, also time the dask tasks computed in it.'''
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        if profile_tasks and Profiler is not None:
+            with Profiler() as profiler:
+                yield
+            for task in profiler.results:
+                task_type = key_split(task.key)
+                self.task_seconds[task_type] = self.task_seconds.get(task_type, 0) + task.end_time - task.start_time
+        else:
+            yield
+        self.stages.append({'stage': name,
+                            'wall_seconds': round(time.perf_counter()-wall, 3),
+                            'cpu_seconds': round(time.process_time()-cpu, 3)})
+
+    def set(self, **counters):
+        self.counters.update(counters)
+
+    def checkpoint(self, name, data):
+        '''Count the rows of the (dask) data at this point of the selection, once it's computed.'''
+        self._checkpoints.append((name, data.map_partitions(len)))
+
+    def checkpoint_partitions(self):
+        '''The row count tasks of each checkpoint, one per partition, to compute alongside the data's partitions.'''
+        return [counts.to_delayed(optimize_graph=False) for _, counts in self._checkpoints]
+
+    def reset_counts(self):
+        for name, _ in self._checkpoints:
+            self.rows[name] = 0
+
+    def add_counts(self, counts):
+        # counts holds one partition's row count at each checkpoint, in order
+        for (name, _), n in zip(self._checkpoints, counts):
+            self.rows[name] = self.rows.get(name, 0) + int(n)
+
+    def include(self, shared):
+        '''Add the stages, task times and counters of the shared record (e.g. a batch's shared read) to this one.'''
+        self.stages = [dict(s, stage='shared - '+s['stage']) for s in shared.stages] + self.stages
+        for task_type, seconds in shared.task_seconds.items():
+            self.task_seconds[task_type] = self.task_seconds.get(task_type, 0) + seconds
+        self.counters = dict(shared.counters, **self.counters)
+
+    def compute(self, data):
+        '''Compute the (dask) data, counting the rows at each checkpoint in the same pass.'''
+        results = dask.compute(data, *[counts for _, counts in self._checkpoints])
+        for (name, _), counts in zip(self._checkpoints, results[1:]):
+            self.rows[name] = int(counts.sum())
+        self._checkpoints = []
+        return results[0]
+
+    def counted_partitions(self, data):
+        '''An iterable over the partitions of the (dask) data, counting the rows at each checkpoint as it goes.'''
+        if len(self._checkpoints) == 0:
+            return data
+        return _CountedPartitions(self, data)
+
+    def as_dict(self):
+        memory = peak_memory()
+        return {'started': self.started,
+                'stages': self.stages,
+                'task_seconds': {k: round(v, 3) for k, v in sorted(self.task_seconds.items(), key=lambda kv: -kv[1])},
+                'counters': self.counters,
+                'rows': self.rows,
+                'peak_memory_bytes': memory}
+
+    def metadata(self):
+        '''The record as {description: value} lines for the metadata file.'''
+        record = self.as_dict()
+        memory = record['peak_memory_bytes']
+        return {'Run record - time per stage (wall seconds, CPU seconds)':
+                    {s['stage']: (s['wall_seconds'], s['cpu_seconds']) for s in record['stages']},
+                'Run record - time in each type of dask task (seconds, summed over workers)': record['task_seconds'],
+                'Run record - files, bytes and partitions read': record['counters'],
+                'Run record - rows remaining after each step': record['rows'],
+                'Run record - peak memory used': 'Unknown' if memory is None else format_bytes(memory)}
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.as_dict(), f, indent=1, default=str)
@@ -0,0 +1,128 @@
+"""
+Deterministic samples of PUPRNs for the data picker
+
+load_data(sample=0.01) keeps a 1% sample of the participants, so the whole
+Module 1 -> 2 -> 3 pipeline can be tried out on a small, representative
+subset of homes in minutes.
+
+Each PUPRN is hashed (with a seed) to a number between 0 and 1, and a home is
+in the sample if its number is below the fraction asked for. So the sample is
+the same on every run and every machine, a bigger fraction always contains
+the homes in a smaller one, and a home stays in (or out of) the sample when
+other participants are added. With stratify_on (participant data columns,
+e.g. ['Region'] or ['Region', 'IMD_quintile']), the same share of the homes
+in each group is kept instead - the homes with the lowest numbers in each
+group, at least one per group.
+
+The sample is taken from all the participants, before any other PUPRN
+filters, and is applied by the data picker like those filters: only the
+files (and parquet row groups) holding the sampled homes are read.
+
+save_data saves the sample used as Sample_of_PUPRNs.json next to its outputs.
+The later Module 1 notebooks and Modules 2 and 3 copy it from their inputs to
+their outputs (carry_sample_spec), so outputs made from a sample say so.
+"""
+import os
+import json
+import hashlib
+import warnings
+import numpy as np
+import pandas as pd
+
+DEFAULT_SEED = 'SERL'
+SAMPLE_SPEC_FILENAME = 'Sample_of_PUPRNs.json'
+
+
+def sample_spec(sample):
+    '''The full description of a sample, from load_data's sample argument: a fraction (e.g. 0.01), or a dictionary
+    of {'fraction': ..., 'stratify_on': [participant data columns], 'seed': ...}. None if there's no sample.'''
+    if sample is None or sample is False:
+        return None
+    if not isinstance(sample, dict):
+        sample = {'fraction': sample}
+    fraction = float(sample['fraction'])
+    if not 0 < fraction <= 1:
+        raise ValueError("The sample fraction must be more than 0 and at most 1, not "+str(sample['fraction']))
+    stratify_on = sample.get('stratify_on') or []
+    if isinstance(stratify_on, str):
+        stratify_on = [stratify_on]
+    return {'fraction': fraction,
+            'stratify_on': list(stratify_on),
+            'seed': str(sample.get('seed', DEFAULT_SEED))}
+
+
+def describe(spec):
+    '''A one line description of the sample, for the metadata and printouts.'''
+    if spec is None:
+        return 'All PUPRNs'
+    text = format(spec['fraction']*100, '.4g')+"% of PUPRNs, sampled by hash (seed '"+spec['seed']+"')"
+    if len(spec['stratify_on']) > 0:
+        text = text+", stratified on "+", ".join(spec['stratify_on'])
+    return text
+
+
+def puprn_hashes(puprns, seed=DEFAULT_SEED):
+    '''A number between 0 and 1 for each PUPRN, fixed for a given seed.'''
+    return np.array([int(hashlib.sha256((seed+':'+str(puprn)).encode()).hexdigest()[:15], 16)/16**15
+                     for puprn in puprns])
+
+
+def sample_puprns(participant_data, spec):
+    '''The PUPRNs (as a pandas Index) in the sample described by spec (see sample_spec), from participant_data.'''
+    missing = [col for col in spec['stratify_on'] if col not in participant_data.columns]
+    if len(missing) > 0:
+        raise ValueError("Can't stratify the sample on "+", ".join(missing)+" - not in the participant data.")
+    homes = participant_data[['PUPRN']+spec['stratify_on']].drop_duplicates('PUPRN')
+    homes = homes.assign(sample_hash=puprn_hashes(homes.PUPRN, spec['seed']))
+    if len(spec['stratify_on']) == 0:
+        return pd.Index(homes.PUPRN[homes.sample_hash < spec['fraction']])
+    groups = homes.groupby(spec['stratify_on'], dropna=False).sample_hash
+    rank = groups.rank(method='first')
+    keep = np.maximum(np.round(spec['fraction']*groups.transform('size')), 1)
+    return pd.Index(homes.PUPRN[rank <= keep])
+
+
+def save_sample_spec(directory, spec, n_puprns=None):
+    '''Save the sample next to the outputs in directory, or remove the one there if the outputs aren't from a sample.
+    Warns if outputs from a different sample (or from all PUPRNs) were already there - keep them in separate
+    directories, as the later steps take the whole directory to be from the last sample saved.'''
+    path = os.path.join(directory, SAMPLE_SPEC_FILENAME)
+    existing = load_sample_spec(directory)
+    if spec is None:
+        if existing is not None:
+            warnings.warn(directory+" held outputs made from a sample of PUPRNs ("+existing['description']
+                          + "). These outputs are from all the selected PUPRNs, so that sample has been removed.")
+            os.remove(path)
+        return
+    if existing is not None and {k: existing.get(k) for k in spec} != spec:
+        warnings.warn(directory+" already holds outputs made from a different sample of PUPRNs ("
+                      + existing['description']+") - it's been replaced by this one.")
+    with open(path, 'w') as f:
+        json.dump(dict(spec, description=describe(spec), n_puprns=n_puprns), f, indent=1)
+
+
+def load_sample_spec(directory):
+    '''The sample the outputs in directory were made from (as saved by save_sample_spec), or None.'''
+    path = os.path.join(directory, SAMPLE_SPEC_FILENAME)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def carry_sample_spec(source_directory, output_directory):
+    '''Copy the sample the inputs in source_directory were made from (if any) to output_directory, where the outputs
+    made from them are saved. Returns it.'''
+    spec = load_sample_spec(source_directory)
+    output_path = os.path.join(output_directory, SAMPLE_SPEC_FILENAME)
+    if spec is None:
+        # Left over from an earlier run on a sample
+        if os.path.exists(output_path):
+            os.remove(output_path)
+        return None
+    print("NB. These outputs are made from a sample: "+spec['description']+".")
+    if not os.path.exists(output_directory):
+        os.makedirs(output_directory)
+    with open(output_path, 'w') as f:
+        json.dump(spec, f, indent=1)
+    return spec
@@ -0,0 +1,280 @@
+"""
+Per-home writer for the data picker
+
+Writes one file per PUPRN. The data is sorted by PUPRN once, cut into
+contiguous blocks of whole homes, and the blocks are written by a pool of
+worker processes, rather than filtering the whole dataframe once per home.
+
+If the data is a dask dataframe (which may not fit in memory), its partitions
+are computed a window at a time (one per dask worker, so they're computed in
+parallel), sorted, and the sorted runs are spilled to disk in buckets keyed on the first character(s) of the PUPRN. Each bucket only holds
+a fraction of the homes, so it can then be merged and written in memory.
+Because the buckets are in PUPRN order, reading them back in turn also gives
+the whole selection sorted by PUPRN, which is how a single sorted file is
+written without holding it all in memory. Files are written as csv, or in any
+of the other formats in data_picker_formats.
+
+iter_homes uses the same bucketing to hand the selection to later steps one
+home at a time, without writing the per-home csvs at all.
+
+StreamMetadata collects the numbers reported by save_metadata (PUPRNs, first
+and last date, row count) from the partitions as they stream past, so the
+data only has to be computed once.
+"""
+import os
+import shutil
+import pickle
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import dask
+import data_picker_formats
+
+DEFAULT_PREFIX_LEN = 1
+BLOCKS_PER_WORKER = 4
+
+
+class StreamMetadata(object):
+    """Metadata about the data, gathered one partition at a time"""
+
+    def __init__(self, datecol='Read_date_effective_local'):
+        self.datecol = datecol
+        self.puprns = set()
+        self.first_date = None
+        self.last_date = None
+        self.n_rows = 0
+        self.head = None
+
+    def update(self, part):
+        if len(part.index) == 0:
+            return
+        self.n_rows = self.n_rows + len(part.index)
+        self.puprns.update(part.PUPRN.unique().tolist())
+        part_first = part[self.datecol].min()
+        part_last = part[self.datecol].max()
+        self.first_date = part_first if self.first_date is None else min(self.first_date, part_first)
+        self.last_date = part_last if self.last_date is None else max(self.last_date, part_last)
+        if self.head is None:
+            self.head = part.head()
+
+
+def home_boundaries(puprns):
+    '''For an array of PUPRNs that's already sorted, return the start and end row of each home.'''
+    puprns = np.asarray(puprns)
+    if len(puprns) == 0:
+        return np.array([], dtype=int), np.array([], dtype=int)
+    starts = np.flatnonzero(np.r_[True, puprns[1:] != puprns[:-1]])
+    ends = np.r_[starts[1:], len(puprns)]
+    return starts, ends
+
+
+def _write_homes(data, output_path, file_format='csv'):
+    # Write each home in a block that's already sorted by PUPRN to its own file
+    starts, ends = home_boundaries(data.PUPRN.values)
+    ext = data_picker_formats.extension(file_format)
+    for start, end in zip(starts, ends):
+        homedata = data.iloc[start:end]
+        data_picker_formats.write_frame(homedata, os.path.join(output_path, str(homedata.PUPRN.iat[0])+ext), file_format)
+    return len(starts)
+
+
+def _split_into_blocks(data, n_blocks):
+    # Cut sorted data into roughly equal blocks, without splitting any home across two blocks
+    starts, ends = home_boundaries(data.PUPRN.values)
+    if len(starts) == 0:
+        return []
+    block_edges = np.unique(np.searchsorted(starts, np.linspace(0, len(data.index), n_blocks+1)[1:-1]))
+    cuts = [0] + [starts[i] for i in block_edges if 0 < i < len(starts)] + [len(data.index)]
+    return [data.iloc[cuts[i]:cuts[i+1]] for i in range(len(cuts)-1) if cuts[i+1] > cuts[i]]
+
+
+def write_sorted_homes(data, output_path, n_workers=None, pool=None, file_format='csv'):
+    '''Write data that's already sorted by PUPRN as one file per home (in file_format), spread across a pool of
+    workers. Returns the number of homes written.'''
+    if n_workers is None:
+        n_workers = os.cpu_count()
+    if n_workers <= 1 or len(data.index) == 0:
+        return _write_homes(data, output_path, file_format)
+    blocks = _split_into_blocks(data, n_workers*BLOCKS_PER_WORKER)
+    if pool is None:
+        with ProcessPoolExecutor(max_workers=n_workers) as new_pool:
+            return sum(new_pool.map(_write_homes, blocks, [output_path]*len(blocks), [file_format]*len(blocks)))
+    return sum(pool.map(_write_homes, blocks, [output_path]*len(blocks), [file_format]*len(blocks)))
+
+
+def puprn_bucket(puprns, prefix_len=DEFAULT_PREFIX_LEN):
+    '''The spill bucket each PUPRN belongs in - the first prefix_len characters of the PUPRN.'''
+    return puprns.astype(str).str.slice(0, prefix_len)
+
+
+def spill_partition(part, spill_dir, sortcols, prefix_len=DEFAULT_PREFIX_LEN):
+    '''Sort one pandas partition and append it, split by PUPRN bucket, to each bucket's spill file.
+    Returns the names of the buckets written to.'''
+    if len(part.index) == 0:
+        return []
+    part = part.sort_values(by=sortcols)
+    bucket = puprn_bucket(part.PUPRN, prefix_len)
+    names = []
+    for name, run in part.groupby(bucket, sort=False):
+        with open(os.path.join(spill_dir, 'bucket_'+name+'.pkl'), 'ab') as f:
+            pickle.dump(run, f, protocol=pickle.HIGHEST_PROTOCOL)
+        names.append(name)
+    return names
+
+
+def spill_by_puprn(partitions, spill_dir, sortcols, prefix_len=DEFAULT_PREFIX_LEN, on_partition=None):
+    '''Sort each pandas partition and append it, split by PUPRN bucket, to that bucket's spill file.
+    on_partition, if given, is called with each partition first. Returns the bucket names, in PUPRN order.'''
+    buckets = set()
+    n_partitions = 0
+    for part in partitions:
+        n_partitions = n_partitions + 1
+        if on_partition is not None:
+            on_partition(part)
+        buckets.update(spill_partition(part, spill_dir, sortcols, prefix_len))
+        if n_partitions % 50 == 0:
+            print(n_partitions, "partitions spilled to disk. Continuing...")
+    return sorted(buckets)
+
+
+def read_bucket(spill_dir, bucket, sortcols):
+    '''Read back all the sorted runs spilled for one bucket and merge them into a single sorted dataframe.'''
+    runs = []
+    with open(os.path.join(spill_dir, 'bucket_'+bucket+'.pkl'), 'rb') as f:
+        while True:
+            try:
+                runs.append(pickle.load(f))
+            except EOFError:
+                break
+    # The runs are each sorted already, so a stable sort of the concatenation is a merge
+    return pd.concat(runs, ignore_index=True).sort_values(by=sortcols, kind='mergesort')
+
+
+def compute_in_windows(tasks, window=None):
+    '''Compute dask tasks (delayed objects, or tuples or lists of them) a window of them at a time, and yield the
+    results in order. Each window is computed by one dask.compute, so its tasks run in parallel on the workers, and
+    any tasks they share are only run once. window defaults to the number of workers dask is set to use (see
+    data_picker_execution.ExecutionProfile.activate).'''
+    tasks = list(tasks)
+    if window is None:
+        window = dask.config.get('num_workers', None) or os.cpu_count() or 1
+    for start in range(0, len(tasks), window):
+        for result in dask.compute(*tasks[start:start+window]):
+            yield result
+
+
+def iter_partitions(data, window=None):
+    '''Yield the partitions of a dask dataframe in order, as pandas dataframes, computing a window of them at a time
+    (see compute_in_windows). data can also be any other iterable of pandas dataframes, e.g. the partitions counted
+    by a RunRecord (see data_picker_run_record).'''
+    if not hasattr(data, 'to_delayed'):
+        for part in data:
+            yield part
+        return
+    for part in compute_in_windows(data.to_delayed(), window):
+        yield part
+
+
+def iter_sorted_buckets(data, sortcols, spill_directory=None, prefix_len=DEFAULT_PREFIX_LEN, on_partition=None):
+    '''Yield the data in blocks of whole homes, sorted by sortcols (which must start with PUPRN), holding
+    only one block in memory at a time. A pandas dataframe is just sorted; a dask dataframe is spilled to
+    disk by PUPRN bucket first and the buckets are read back in order. on_partition, if given, is called
+    with each (unsorted) partition as it's computed.'''
+    if isinstance(data, pd.DataFrame):
+        if on_partition is not None:
+            on_partition(data)
+        yield data.sort_values(by=sortcols)
+        return
+    spill_dir = tempfile.mkdtemp(prefix='serl_spill_', dir=spill_directory)
+    try:
+        buckets = spill_by_puprn(iter_partitions(data), spill_dir, sortcols, prefix_len, on_partition)
+        for bucket in buckets:
+            yield read_bucket(spill_dir, bucket, sortcols)
+    finally:
+        shutil.rmtree(spill_dir, ignore_errors=True)
+
+
+def iter_homes(data, sortcols, spill_directory=None, prefix_len=DEFAULT_PREFIX_LEN, on_partition=None):
+    '''Yield (PUPRN, dataframe) for each home in a pandas or dask dataframe, in PUPRN order, each sorted by sortcols.
+    Each home's dataframe looks as it would if its per-home csv were read back in: a fresh index, and PUPRN as
+    plain strings.'''
+    for block in iter_sorted_buckets(data, sortcols, spill_directory, prefix_len, on_partition):
+        starts, ends = home_boundaries(block.PUPRN.values)
+        for start, end in zip(starts, ends):
+            homedata = block.iloc[start:end].reset_index(drop=True)
+            if isinstance(homedata.PUPRN.dtype, pd.CategoricalDtype):
+                homedata['PUPRN'] = homedata.PUPRN.astype(str)
+            yield homedata.PUPRN.iat[0], homedata
+
+
+def _write_blocks_per_home(blocks, output_path, n_workers=None, file_format='csv'):
+    # Write blocks of whole homes, each already sorted, as one file per home
+    if not os.path.exists(output_path):
+        os.makedirs(output_path)
+    if n_workers is None:
+        n_workers = os.cpu_count()
+    homes_saved = 0
+    pool = ProcessPoolExecutor(max_workers=n_workers) if n_workers > 1 else None
+    try:
+        for block in blocks:
+            homes_saved = homes_saved + write_sorted_homes(block, output_path, n_workers, pool, file_format)
+            print(homes_saved, "homes saved so far. Continuing...")
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    return homes_saved
+
+
+def _write_blocks_single_file(blocks, output_file, columns, file_format='csv', n_workers=None):
+    # Write sorted blocks of whole homes one after the other into a single file, in chunks (see data_picker_formats)
+    data_picker_formats.write_chunked(blocks, output_file, columns, file_format, n_workers)
+
+
+def write_per_home(data, output_path, sortcols, n_workers=None, spill_directory=None, prefix_len=DEFAULT_PREFIX_LEN,
+                   on_partition=None, file_format='csv'):
+    '''Write a pandas or dask dataframe as one file per PUPRN in output_path, each sorted by sortcols.
+    Returns the number of homes written.'''
+    blocks = iter_sorted_buckets(data, sortcols, spill_directory, prefix_len, on_partition)
+    return _write_blocks_per_home(blocks, output_path, n_workers, file_format)
+
+
+def write_single_file(data, output_file, sortcols, spill_directory=None, prefix_len=DEFAULT_PREFIX_LEN, on_partition=None,
+                      file_format='csv', n_workers=None):
+    '''Write a pandas or dask dataframe to a single file, sorted by sortcols (which must start with PUPRN).'''
+    blocks = iter_sorted_buckets(data, sortcols, spill_directory, prefix_len, on_partition)
+    _write_blocks_single_file(blocks, output_file, data.columns, file_format, n_workers)
+
+
+class SpillingWriter(object):
+    """Writes one selection that's handed to it a partition at a time, e.g. during a pass over the source data
+    shared with other selections. Partitions are spilled to disk by PUPRN bucket as they arrive, and written out
+    (per home, or to a single file) by finish() once they've all been added."""
+
+    def __init__(self, save_method, output, columns, sortcols, n_workers=None, spill_directory=None,
+                 prefix_len=DEFAULT_PREFIX_LEN, file_format='csv'):
+        self.save_method = save_method
+        self.file_format = file_format
+        self.output = output
+        self.columns = columns
+        self.sortcols = sortcols
+        self.n_workers = n_workers
+        self.prefix_len = prefix_len
+        self.spill_dir = tempfile.mkdtemp(prefix='serl_spill_', dir=spill_directory)
+        self.buckets = set()
+
+    def add(self, part):
+        self.buckets.update(spill_partition(part, self.spill_dir, self.sortcols, self.prefix_len))
+
+    def finish(self):
+        '''Write out everything added so far. Returns the number of homes written for 'per_home'.'''
+        try:
+            blocks = (read_bucket(self.spill_dir, bucket, self.sortcols) for bucket in sorted(self.buckets))
+            if self.save_method == 'per_home':
+                return _write_blocks_per_home(blocks, self.output, self.n_workers, self.file_format)
+            _write_blocks_single_file(blocks, self.output, self.columns, self.file_format, self.n_workers)
+        finally:
+            self.cleanup()
+
+    def cleanup(self):
+        shutil.rmtree(self.spill_dir, ignore_errors=True)
@@ -0,0 +1,91 @@
+"""
+Heating and cooling degree days for any number of base temperatures
+
+Heating degree days (hdd) follow the method in McKenna et al (2022) DOI:
+10.1016/j.enbuild.2022.111845, adapted from Spinoni et al (2015), from the
+daily maximum (T_X), minimum (T_N) and mean of the two (T_M):
+- T_X <= T_b: T_b - T_M
+- T_M <= T_b < T_X: (T_b - T_N)/2 - (T_X - T_b)/4
+- T_N <= T_b < T_M: (T_b - T_N)/4
+- otherwise 0.
+Cooling degree days (cdd) mirror them:
+- T_N >= T_b: T_M - T_b
+- T_N < T_b <= T_M: (T_X - T_b)/2 - (T_b - T_N)/4
+- T_M < T_b <= T_X: (T_X - T_b)/4
+- otherwise 0.
+Days without T_X or T_N get 0, as in step 2 before.
+
+The cases are worked out for every grid cell, day and base temperature at
+once, by broadcasting the daily temperatures against the base temperatures,
+so a sensitivity analysis over several base temperatures is one call rather
+than one run of the temperature notebook per base.
+"""
+import numpy as np
+import pandas as pd
+
+DEFAULT_BASE_TEMPERATURE = 15.5
+
+
+def _broadcast(T_X, T_N, T_M, base_temperatures):
+    # Add a last axis for the base temperatures
+    T_X = np.asarray(T_X, dtype=float)[..., np.newaxis]
+    T_N = np.asarray(T_N, dtype=float)[..., np.newaxis]
+    T_M = (T_X + T_N)/2 if T_M is None else np.asarray(T_M, dtype=float)[..., np.newaxis]
+    T_b = np.atleast_1d(np.asarray(base_temperatures, dtype=float))
+    return T_X, T_N, T_M, T_b
+
+
+def heating_degree_days(T_X, T_N, T_M=None, base_temperatures=DEFAULT_BASE_TEMPERATURE):
+    '''Heating degree days for arrays of daily T_X and T_N (and T_M, which is worked out from them if not given), of
+    any shape, for each of base_temperatures. Returns an array of their shape plus a last axis for the bases.'''
+    T_X, T_N, T_M, T_b = _broadcast(T_X, T_N, T_M, base_temperatures)
+    with np.errstate(invalid='ignore'):
+        return np.select([T_X <= T_b,
+                          (T_X > T_b) & (T_M <= T_b),
+                          (T_M > T_b) & (T_N <= T_b)],
+                         [T_b - T_M,
+                          (T_b - T_N)/2 - (T_X - T_b)/4,
+                          (T_b - T_N)/4],
+                         default=0)
+
+
+def cooling_degree_days(T_X, T_N, T_M=None, base_temperatures=DEFAULT_BASE_TEMPERATURE):
+    '''Cooling degree days, as heating_degree_days.'''
+    T_X, T_N, T_M, T_b = _broadcast(T_X, T_N, T_M, base_temperatures)
+    with np.errstate(invalid='ignore'):
+        return np.select([T_N >= T_b,
+                          (T_N < T_b) & (T_M >= T_b),
+                          (T_M < T_b) & (T_X >= T_b)],
+                         [T_M - T_b,
+                          (T_X - T_b)/2 - (T_b - T_N)/4,
+                          (T_X - T_b)/4],
+                         default=0)
+
+
+class DegreeDays(object):
+    """hdd and cdd as grid_cell x day x base temperature arrays"""
+
+    def __init__(self, grid_cells, dates, base_temperatures, hdd, cdd):
+        self.grid_cells = list(grid_cells)
+        self.dates = list(dates)
+        self.base_temperatures = list(base_temperatures)
+        self.hdd = hdd
+        self.cdd = cdd
+
+    @classmethod
+    def from_daily(cls, daily, base_temperatures):
+        '''Degree days from daily temperatures indexed by grid_cell and Read_date_effective_local, with T_X, T_N and
+        T_M columns (as made in step 2 - see climate_data.ClimateData.daily). Days missing for a grid cell get 0.'''
+        T_X = daily.T_X.unstack()
+        T_N = daily.T_N.unstack().reindex_like(T_X)
+        T_M = daily.T_M.unstack().reindex_like(T_X)
+        base_temperatures = np.atleast_1d(base_temperatures)
+        return cls(T_X.index, T_X.columns, base_temperatures,
+                   heating_degree_days(T_X.values, T_N.values, T_M.values, base_temperatures),
+                   cooling_degree_days(T_X.values, T_N.values, T_M.values, base_temperatures))
+
+    def to_frame(self):
+        '''The degree days as a long dataframe indexed by grid_cell, Read_date_effective_local and base_temperature_C.'''
+        index = pd.MultiIndex.from_product([self.grid_cells, self.dates, self.base_temperatures],
+                                           names=['grid_cell', 'Read_date_effective_local', 'base_temperature_C'])
+        return pd.DataFrame({'hdd': self.hdd.ravel(), 'cdd': self.cdd.ravel()}, index=index)
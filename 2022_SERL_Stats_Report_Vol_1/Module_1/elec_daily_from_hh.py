@@ -0,0 +1,103 @@
+"""
+Daily electricity totals from the hh data (step 1.1C)
+
+Sums each home's hh net and import electricity into daily totals, keeping
+only the days with all their expected net reads - 48, or 46/50 on the days the
+clocks change (n_hh in the bst dates file) - and lists the homes that export
+electricity at any point in the year.
+
+Rather than grouping, merging and appending each home to the output in turn,
+the per-home hh files saved in step 1.1B are read in blocks of homes by a pool
+of worker processes. Each block is summed in one groupby over all its homes
+and days, and the results are written out once, in the order of the files.
+daily_totals does the same for any (pandas) dataframe of hh data, e.g. a
+selection loaded with the data picker.
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+import serl_schema
+import data_picker_formats
+
+HH_COLUMNS = ['PUPRN', 'Read_date_effective_local', 'Elec_act_net_hh_Wh', 'Elec_act_exp_hh_Wh', 'Elec_act_imp_hh_Wh']
+OUTPUT_COLUMNS = ['PUPRN', 'Read_date_effective_local', 'Elec_act_net_flag', 'Elec_act_net_hh_sum_Wh',
+                  'Elec_act_imp_hh_sum_Wh']
+READS_PER_DAY = 48
+FILES_PER_BLOCK = 100
+
+
+def expected_reads(dates, clock_changes):
+    '''The number of hh reads expected on each of dates - 48, or n_hh on the days the clocks change.'''
+    clock_changes = clock_changes.drop_duplicates('Read_date_effective_local')
+    n_hh = pd.Series(clock_changes.n_hh.values, index=clock_changes.Read_date_effective_local.values)
+    return dates.map(n_hh).fillna(READS_PER_DAY)
+
+
+def daily_totals(data, clock_changes):
+    '''Daily net and import totals (Elec_act_net_hh_sum_Wh, Elec_act_imp_hh_sum_Wh) for every home and day in a
+    (pandas) dataframe of hh data, keeping only the days with all their expected net reads. Homes are kept in the
+    order they first appear in data, and each home's days in date order.'''
+    # An ordered categorical keeps the homes in their order in data, rather than sorting them again
+    puprns = pd.Categorical(data.PUPRN, categories=pd.unique(data.PUPRN), ordered=True)
+    grouped = data.groupby([puprns, data.Read_date_effective_local], sort=True, observed=True)
+    values = grouped[['Elec_act_net_hh_Wh', 'Elec_act_imp_hh_Wh']]
+    counts = values.count().Elec_act_net_hh_Wh
+    daily = values.sum().rename(columns={'Elec_act_net_hh_Wh': 'Elec_act_net_hh_sum_Wh',
+                                         'Elec_act_imp_hh_Wh': 'Elec_act_imp_hh_sum_Wh'})
+    daily.index.names = ['PUPRN', 'Read_date_effective_local']
+    daily = daily.reset_index()
+    daily['PUPRN'] = daily.PUPRN.astype(str)
+    complete = (counts.values == expected_reads(daily.Read_date_effective_local, clock_changes).values)
+    daily = daily.loc[complete]
+    daily.insert(2, 'Elec_act_net_flag', 1)
+    return daily[OUTPUT_COLUMNS].reset_index(drop=True)
+
+
+def _daily_totals_for_files(paths, clock_changes):
+    # Read a block of per-home hh files and sum them in one go (in a worker process). Also returns the PUPRNs (from
+    # the file names) of the homes that export at any point.
+    frames = []
+    exporters = []
+    for path in paths:
+        data = data_picker_formats.read_frame(path, usecols=HH_COLUMNS, dtype=serl_schema.dtypes())
+        if data.Elec_act_exp_hh_Wh.sum() > 0: # Ignores Nans, and is False if they're all Nan
+            exporters.append(data_picker_formats.strip_extension(path))
+        frames.append(data)
+    data = pd.concat(frames, ignore_index=True) if len(frames) > 0 else pd.DataFrame(columns=HH_COLUMNS)
+    return daily_totals(data, clock_changes), exporters, len(paths)
+
+
+def daily_totals_from_files(source_directory, filelist, clock_changes, output_file, exporter_file, n_workers=None,
+                            files_per_block=FILES_PER_BLOCK):
+    '''Sum the per-home hh files in filelist (in source_directory) into daily totals, in blocks of files_per_block
+    homes across n_workers worker processes. Saves the daily totals as csv to output_file and the exporting PUPRNs
+    to exporter_file. Returns the number of homes gone through and the list of exporting PUPRNs.'''
+    if n_workers is None:
+        n_workers = os.cpu_count()
+    paths = [os.path.join(source_directory, f) for f in filelist]
+    blocks = [paths[i:i+files_per_block] for i in range(0, len(paths), files_per_block)]
+    daily = []
+    exporters = []
+    homes = 0
+
+    def gather(results):
+        nonlocal homes
+        for block_daily, block_exporters, block_homes in results:
+            if len(block_daily.index) > 0:
+                daily.append(block_daily)
+            exporters.extend(block_exporters)
+            homes = homes + block_homes
+            print(homes, "PUPRNs of data have been processed. Continuing...")
+
+    if n_workers <= 1 or len(blocks) <= 1:
+        gather(_daily_totals_for_files(block, clock_changes) for block in blocks)
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers) as pool:
+            gather(pool.map(_daily_totals_for_files, blocks, [clock_changes]*len(blocks)))
+    # Written once, in the order of filelist
+    if len(daily) > 0:
+        pd.concat(daily, ignore_index=True).to_csv(output_file, index=False)
+    else:
+        pd.DataFrame(columns=OUTPUT_COLUMNS).to_csv(output_file, index=False)
+    pd.Series(exporters, dtype=object).to_csv(exporter_file, index=False)
+    return homes, exporters
@@ -0,0 +1,218 @@
+"""
+Final clean half-hourly data (step 3.2)
+
+HhFinaliser puts each home's gas and electricity hh data (from steps 1.1A and
+1.1B) onto a complete year of half-hours, adds the SERL-style local time
+columns and the temperature of the home's grid cell (from step 2), checks it
+and saves it - in the 'Errors' subfolder if a check fails.
+
+The homes are shared out in blocks to a pool of worker processes. Each worker
+sets up once what every home shares: the year's template index, the local time
+columns for it (which only need working out again for a home with extra
+timestamps), and the temperature matrix, which it memory-maps (see
+temperature_cube.py) and slices per home.
+
+Each home is finalised on its own, so a home that can't be read or processed
+doesn't stop the others. run returns a report with a row per home: whether it
+had gas and electricity data, the result of each check, where it was saved,
+and the error if it couldn't be finalised.
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import serl_schema
+import data_picker_formats
+import temperature_cube
+
+OUTPUT_COLUMNS = ['PUPRN', 'Read_date_time_local', 'Read_date_effective_local', 'Readings_from_midnight_local',
+                  'Clean_elec_net_Wh', 'Clean_gas_Wh', 'temp_C']
+ERRORS_SUBFOLDER = 'Errors'
+HOMES_PER_BLOCK = 25
+PROGRESS_EVERY = 250
+
+
+def template_index(index_start_date, index_end_date):
+    '''The complete year of half-hours (UTC) that every home's data is put onto.'''
+    index = pd.date_range(index_start_date, index_end_date, freq='30T').tz_localize(tz='UTC')
+    return index.set_names('Read_date_time_UTC')
+
+
+def local_time_columns(index):
+    '''Read_date_time_local (e.g. '2021-06-01 13:30:00 BST'), Read_date_effective_local and
+    Readings_from_midnight_local for a UTC index of hh reads, as in the SERL data.'''
+    local = index.tz_convert(tz='Europe/London')
+    offset = local.tz_localize(None) - index.tz_localize(None)
+    zone = np.where(offset == pd.Timedelta(0), ' GMT', ' BST')
+    # Each read is for the half-hour ending at its time, so belongs to the day (and reading number) 15 minutes earlier.
+    # Readings are counted on the local clock, so on the days the clocks change the 01:30 reads are always reading 4.
+    midpoint = local - pd.Timedelta(minutes=15)
+    clock_midpoint = local.tz_localize(None) - pd.Timedelta(minutes=15)
+    return pd.DataFrame({'Read_date_time_local': local.strftime('%Y-%m-%d %H:%M:%S') + zone,
+                         'Read_date_effective_local': midpoint.strftime('%Y-%m-%d'),
+                         'Readings_from_midnight_local': (clock_midpoint.hour + clock_midpoint.minute/60)*2 + 0.5},
+                        index=index)
+
+
+class HhFinaliser(object):
+    """Finalises the hh data of one home at a time, with the settings shared by all the homes"""
+
+    def __init__(self, gas_directory, elec_directory, temperature_directory, temperature_name, puprn_to_grid_cell,
+                 index_start_date, index_end_date, output_directory, filename_suffix, fill_missing_temperature=False):
+        self.gas_directory = gas_directory
+        self.elec_directory = elec_directory
+        self.temperature_directory = temperature_directory
+        self.temperature_name = temperature_name
+        self.puprn_to_grid_cell = puprn_to_grid_cell
+        self.index_start_date = index_start_date
+        self.index_end_date = index_end_date
+        self.output_directory = output_directory
+        self.filename_suffix = filename_suffix
+        # Forward fill a missing temperature by one half-hour (e.g. the last one of 2021, which isn't in Edition 4)
+        self.fill_missing_temperature = fill_missing_temperature
+        self._shared = None
+
+    def __getstate__(self):
+        # What's shared between homes is set up again in each worker, rather than copied to it
+        return dict(self.__dict__, _shared=None)
+
+    def shared(self):
+        '''The template index, its local time columns and the temperature matrix, set up once per process.'''
+        if self._shared is None:
+            template = template_index(self.index_start_date, self.index_end_date)
+            self._shared = (template, local_time_columns(template),
+                            temperature_cube.TemperatureCube.open(self.temperature_directory, self.temperature_name))
+        return self._shared
+
+    def _read(self, directory, puprn, column):
+        # A home's hh data for one fuel, indexed by Read_date_time_UTC, or None if it has no file for that fuel
+        path = data_picker_formats.find_data_file(directory, puprn)
+        if not os.path.exists(path):
+            return None
+        data = data_picker_formats.read_frame(path, usecols=['Read_date_time_UTC', column],
+                                              index_col=['Read_date_time_UTC'], parse_dates=['Read_date_time_UTC'],
+                                              dtype=serl_schema.dtypes())
+        data.index = data.index.tz_localize(tz='UTC')
+        return data
+
+    def finalise_home(self, puprn):
+        '''Finalise and save one home's data. Returns its row of the report.'''
+        template, template_local, temperatures = self.shared()
+        elec = self._read(self.elec_directory, puprn, 'Elec_act_net_hh_Wh')
+        gas = self._read(self.gas_directory, puprn, 'Gas_hh_Wh')
+        result = {'PUPRN': puprn, 'elec_data': elec is not None, 'gas_data': gas is not None}
+
+        # Join the energy data onto a complete year
+        energy_data_final = pd.DataFrame(index=template)
+        for fuel_data, column in [(elec, 'Elec_act_net_hh_Wh'), (gas, 'Gas_hh_Wh')]:
+            if fuel_data is None:
+                fuel_data = pd.DataFrame(index=template, columns=[column])
+            energy_data_final = pd.merge(energy_data_final, fuel_data, left_index=True, right_index=True, how='outer')
+        energy_data_final.index.name = 'Read_date_time_UTC'
+        energy_data_final.rename(columns={'Elec_act_net_hh_Wh': 'Clean_elec_net_Wh', 'Gas_hh_Wh': 'Clean_gas_Wh'},
+                                 inplace=True)
+        energy_data_final['PUPRN'] = puprn
+
+        # The local time columns - already worked out, unless the home has timestamps that aren't in the template
+        if energy_data_final.index.equals(template):
+            local = template_local
+        else:
+            local = local_time_columns(energy_data_final.index)
+        for col in local.columns:
+            energy_data_final[col] = local[col].values
+
+        # The temperature of the home's grid cell at each half-hour
+        grid_cell = self.puprn_to_grid_cell.at[puprn, 'grid_cell']
+        energy_data_final['temp_C'] = temperatures.temperatures(grid_cell, energy_data_final.index)
+        if self.fill_missing_temperature:
+            energy_data_final['temp_C'] = energy_data_final.temp_C.fillna(method='ffill', limit=1)
+
+        # Check for data errors, and save (in a subfolder if there's an error)
+        result.update({'n_rows': energy_data_final.shape[0],
+                       'temp_nans': int(energy_data_final.temp_C.isnull().sum()),
+                       'out_of_sequence': not energy_data_final.index.is_monotonic_increasing,
+                       'duplicate_rows': not energy_data_final.index.is_unique,
+                       'wrong_length': energy_data_final.shape[0] - len(template)})
+        failed = (result['temp_nans'] > 0 or result['out_of_sequence'] or result['duplicate_rows']
+                  or result['wrong_length'] != 0)
+        subfolder = ERRORS_SUBFOLDER if failed else ''
+        energy_data_final[OUTPUT_COLUMNS].to_csv(os.path.join(self.output_directory, subfolder,
+                                                              puprn+self.filename_suffix), index=True)
+        result['saved_in'] = os.path.join(self.output_directory, subfolder)
+        return result
+
+    def finalise_homes(self, puprns):
+        '''Finalise each of puprns in turn, noting any that fail in the report rather than stopping.'''
+        results = []
+        for puprn in puprns:
+            try:
+                results.append(self.finalise_home(puprn))
+            except Exception as e:
+                results.append({'PUPRN': puprn, 'error': type(e).__name__+': '+str(e)})
+        return results
+
+    def run(self, puprns, n_workers=None, homes_per_block=HOMES_PER_BLOCK):
+        '''Finalise and save all of puprns, in blocks of homes_per_block across n_workers worker processes (one per
+        CPU if None). Returns the report, with a row per home in the order of puprns.'''
+        if not os.path.exists(os.path.join(self.output_directory, ERRORS_SUBFOLDER)):
+            os.makedirs(os.path.join(self.output_directory, ERRORS_SUBFOLDER))
+        if n_workers is None:
+            n_workers = os.cpu_count()
+        blocks = [puprns[i:i+homes_per_block] for i in range(0, len(puprns), homes_per_block)]
+        results = []
+        if n_workers <= 1 or len(blocks) <= 1:
+            block_results = (self.finalise_homes(block) for block in blocks)
+            for block in block_results:
+                print_progress(len(results), len(results)+len(block))
+                results.extend(block)
+        else:
+            with ProcessPoolExecutor(max_workers=n_workers, initializer=_start_worker, initargs=(self,)) as pool:
+                for block in pool.map(_finalise_block, blocks):
+                    print_progress(len(results), len(results)+len(block))
+                    results.extend(block)
+        return make_report(results)
+
+
+_worker = None
+
+
+def _start_worker(finaliser):
+    # Each worker process keeps its own copy of the finaliser, so sets up what the homes share only once
+    global _worker
+    _worker = finaliser
+
+
+def _finalise_block(puprns):
+    return _worker.finalise_homes(puprns)
+
+
+def make_report(results):
+    '''The report of a run, as a dataframe with a row per home.'''
+    report = pd.DataFrame(results, columns=['PUPRN', 'elec_data', 'gas_data', 'n_rows', 'temp_nans', 'out_of_sequence',
+                                            'duplicate_rows', 'wrong_length', 'saved_in', 'error'])
+    report[['saved_in', 'error']] = report[['saved_in', 'error']].fillna('')
+    return report
+
+
+def homes_with_errors(report):
+    '''The PUPRNs that failed a check (saved in the 'Errors' subfolder) or couldn't be finalised at all.'''
+    failed = ((report.temp_nans > 0) | (report.out_of_sequence == True) | (report.duplicate_rows == True)
+              | (report.wrong_length.fillna(0) != 0) | (report.error != ''))
+    return report.PUPRN[failed].tolist()
+
+
+def summary(report):
+    '''A description of the homes with errors in the report, to print.'''
+    lines = [str(len(homes_with_errors(report)))+" PUPRNs with errors, of which:",
+             str(int((report.temp_nans > 0).sum()))+" have missing temperature readings;",
+             str(int((report.out_of_sequence == True).sum()))+" have out of sequence datetime rows;",
+             str(int((report.duplicate_rows == True).sum()))+" have duplicate rows;",
+             str(int((report.wrong_length.fillna(0) != 0).sum()))+" have too many or too few rows;",
+             str(int((report.error != '').sum()))+" couldn't be finalised at all (see the error column of the report)."]
+    return "\n".join(lines)
+
+
+def print_progress(n_before, n_after):
+    # Every PROGRESS_EVERY homes - the homes with errors are summarised once the run is done
+    if n_after // PROGRESS_EVERY > n_before // PROGRESS_EVERY:
+        print(n_after, "PUPRNs of data have been processed. Continuing...")
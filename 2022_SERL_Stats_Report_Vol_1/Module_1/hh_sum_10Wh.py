@@ -0,0 +1,124 @@
+"""
+Electricity hh data in units of 10Wh
+
+Some electricity meters sometimes report their hh data in units of 10Wh, so a
+day's import hh sum is around a tenth of its daily import read. find_10Wh
+compares the two for every PUPRN and day at once, and classifies each day with
+both reads as
+- 'as_expected'
+- '10Wh': the daily read is 8 to 12 times the hh sum, and the home doesn't
+  export that day (the net and import hh sums are equal)
+- '10Wh_exporting': as '10Wh', but the home exports that day
+- 'zero_hh_sum': the hh sum is 0, so the ratio of the two isn't defined
+and each PUPRN with any days of 10Wh as 'every_day' (every day with both reads)
+or 'some_days'.
+
+Step 3.1 uses the same range (daily_cleaning.days_of_10Wh), but also counts the
+days where the daily read and hh sum are both 0 as days of 10Wh. Its 'by_day'
+treatment (daily_cleaning.fix_10Wh_by_day) only keeps the daily read on those
+days, and every other day of 10Wh becomes Nan.
+
+The result is a compact table with a row per run of days of the same class
+for a PUPRN (days without both reads don't break a run): PUPRN, first_date,
+last_date, n_days, day_class, PUPRN_class and the median ratio of the daily read
+to the hh sum. It can be joined onto data at any stage by PUPRN, or by PUPRN
+and date range.
+
+Step 3.1C saves the table for its year. Run this file directly to make it for a
+year from the step 1.1 outputs, e.g. after a new edition of the data arrives:
+    python hh_sum_10Wh.py 2021
+"""
+import os
+import argparse
+import numpy as np
+import pandas as pd
+import serl_schema
+import data_picker_formats
+import daily_cleaning
+
+DAY_CLASSES = ['as_expected', '10Wh', '10Wh_exporting', 'zero_hh_sum']
+TABLE_COLUMNS = ['PUPRN', 'first_date', 'last_date', 'n_days', 'day_class', 'PUPRN_class', 'median_ratio']
+
+
+def classify_days(elec_daily_data_from_daily, elec_daily_data_from_hh):
+    '''The ratio of the daily import read to the import hh sum, and the class of the day (see DAY_CLASSES), for every
+    PUPRN and day with both, from the step 1.1 daily electricity and daily-from-hh data (indexed by PUPRN and
+    Read_date_effective_local). Sorted by PUPRN then date.'''
+    data = pd.merge(elec_daily_data_from_daily[['Elec_act_imp_d_Wh']],
+                    elec_daily_data_from_hh[['Elec_act_imp_hh_sum_Wh', 'Elec_act_net_hh_sum_Wh']],
+                    left_index=True, right_index=True, how='inner')
+    data = data[data.Elec_act_imp_d_Wh.notnull() & data.Elec_act_imp_hh_sum_Wh.notnull()].sort_index()
+    daily = data.Elec_act_imp_d_Wh.values.astype(float)
+    hh_sum = data.Elec_act_imp_hh_sum_Wh.values.astype(float)
+    # The ratio only where the hh sum is above 0 - the other days are 'zero_hh_sum', whatever the daily read
+    zero = hh_sum <= 0
+    ratio = np.full(len(daily), np.nan)
+    ratio[~zero] = daily[~zero]/hh_sum[~zero]
+    days = (ratio >= 8) & (ratio <= 12)
+    exporting = hh_sum != data.Elec_act_net_hh_sum_Wh.values
+    codes = np.where(zero, 3, np.where(days, np.where(exporting, 2, 1), 0))
+    return pd.DataFrame({'ratio': ratio, 'day_class': pd.Categorical.from_codes(codes, DAY_CLASSES)},
+                        index=data.index)
+
+
+def anomaly_table(days):
+    '''The runs of days of 10Wh in days (from classify_days), as a table with a row per run (see TABLE_COLUMNS).'''
+    puprns = days.index.get_level_values('PUPRN').astype(str)
+    dates = days.index.get_level_values('Read_date_effective_local')
+    codes = days.day_class.cat.codes.values
+    # A new run starts at each change of PUPRN or class
+    starts = np.ones(len(codes), dtype=bool)
+    starts[1:] = (puprns[1:] != puprns[:-1]) | (codes[1:] != codes[:-1])
+    runs = pd.DataFrame({'run': np.cumsum(starts), 'PUPRN': puprns, 'date': dates, 'code': codes,
+                         'ratio': days.ratio.values})
+    # A PUPRN is 'every_day' if all of its days are days of 10Wh
+    other_puprns = set(runs.PUPRN[(runs.code == 0) | (runs.code == 3)])
+    runs = runs[(runs.code == 1) | (runs.code == 2)]
+    table = runs.groupby('run', sort=True).agg(PUPRN=('PUPRN', 'first'), first_date=('date', 'min'),
+                                               last_date=('date', 'max'), n_days=('date', 'size'),
+                                               code=('code', 'first'), median_ratio=('ratio', 'median'))
+    table['day_class'] = np.asarray(DAY_CLASSES, dtype=object)[table.code.values]
+    table['PUPRN_class'] = np.where(table.PUPRN.isin(other_puprns), 'some_days', 'every_day')
+    return table[TABLE_COLUMNS].reset_index(drop=True)
+
+
+def find_10Wh(elec_daily_data_from_daily, elec_daily_data_from_hh):
+    '''The table of runs of days of 10Wh, from the step 1.1 daily electricity and daily-from-hh data.'''
+    return anomaly_table(classify_days(elec_daily_data_from_daily, elec_daily_data_from_hh))
+
+
+def summary(table):
+    '''A description of the table, to print.'''
+    return (str(int(table.n_days.sum()))+" days of 10Wh found for "+str(table.PUPRN.nunique())+" PUPRNs ("
+            + str(table.loc[table.PUPRN_class == 'every_day', 'PUPRN'].nunique())+" on every day with both reads), of which "
+            + str(int(table.loc[table.day_class == '10Wh_exporting', 'n_days'].sum()))+" days were exporting.")
+
+
+def output_filename(year):
+    return 'Step_3_1_Elec_'+str(year)+'_days_of_10Wh.csv'
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Find the electricity hh data in units of 10Wh for a year, from the "
+                                                 "outputs of step 1.1")
+    parser.add_argument('year')
+    parser.add_argument('--source_directory', default='Step_1_1_Outputs')
+    parser.add_argument('--output_directory', default='Step_3_1_Outputs')
+    args = parser.parse_args()
+    index_col = ['PUPRN', 'Read_date_effective_local']
+    elec_daily_data_from_daily = data_picker_formats.read_frame(
+        data_picker_formats.find_data_file(args.source_directory, 'Step_1_1B_Elec_'+args.year+'_daily_from_daily.csv'),
+        usecols=index_col+daily_cleaning.ELEC_DAILY_COLUMNS, index_col=index_col, dtype=serl_schema.dtypes())
+    elec_daily_data_from_hh = pd.read_csv(os.path.join(args.source_directory,
+                                                       'Step_1_1C_Elec_'+args.year+'_daily_from_hh.csv'),
+                                          usecols=index_col+daily_cleaning.ELEC_HH_COLUMNS, index_col=index_col,
+                                          dtype=serl_schema.dtypes())
+    table = find_10Wh(elec_daily_data_from_daily, elec_daily_data_from_hh)
+    print(summary(table))
+    if not os.path.exists(args.output_directory):
+        os.makedirs(args.output_directory)
+    table.to_csv(os.path.join(args.output_directory, output_filename(args.year)), index=False)
+
+
+if __name__ == "__main__":
+    main()
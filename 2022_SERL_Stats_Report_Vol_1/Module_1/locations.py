@@ -15,3 +15,24 @@ energy_daily_regexp = '****'
 energy_hh_directory = r'****'
 energy_hh_regexp = '****'
 climate_directory = r'****'
+climate_regexp = 'serl_climate_data_YYYY_MM_edition04.csv'
+
+# Where the parquet copies of the smart meter data are kept (written by data_picker_parquet_store.py - must be writable).
+energy_daily_parquet_directory = r'****'
+energy_hh_parquet_directory = r'****'
+
+# Where the manifests of the smart meter data files are kept (written by data_picker_manifest.py - must be writable).
+manifest_directory = r'****'
+
+# Where the cached copies of the participant, survey and EPC files are kept (written by contextual_data_cache.py - must be
+# writable). Leave as None to keep them next to the source files.
+contextual_cache_directory = None
+
+# Where the hourly temperatures read from the climate data files are cached (written by climate_data.py - must be
+# writable). Relative to the working directory, so nothing is written into the SERL data tree.
+climate_cache_directory = 'Climate_cache'
+
+# Where load_data(cache=True) keeps the selections it has already made (written by data_picker_result_cache.py - must be
+# writable), and how big that cache is allowed to grow (in GB) before the least recently used selections are removed.
+result_cache_directory = r'****'
+result_cache_max_gb = 50
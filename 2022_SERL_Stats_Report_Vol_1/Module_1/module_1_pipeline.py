@@ -0,0 +1,400 @@
+"""
+Module 1 pipeline runner
+
+Runs the Module 1 notebooks for a year as a dependency graph, instead of by
+hand in order with the year edited into each one. The steps, and the steps
+whose outputs they need:
+- 1_1AB (gas and electricity data): none
+- 1_1C (electricity daily data from hh): 1_1B
+- 2 (temperature data): none
+- 3_1A (gas daily data): 1_1A
+- 3_1B (electricity daily data): 1_1B and 1_1C
+- 3_1C (final daily data): 1_1A, 1_1B, 1_1C and 2
+- 3_2 (final hh data): 1_1A, 1_1B and 2
+where 1_1A (the gas data) and 1_1B (the electricity data) are both made by
+1_1AB, which reads each of the smart meter data files once for both (see
+SerlDataSelector.load_batch). With split_1_1 (--split_1_1), notebooks 1_1A and
+1_1B are run as separate steps instead, each reading the whole edition.
+Each notebook runs in its own python process. By default one step runs at a
+time, as each notebook already sizes its dask and writer workers (and their
+memory) to the whole machine. With n_workers (--n_workers), up to that many
+steps run at once, each started as soon as the steps it needs are done, so the
+gas and electricity, and temperature branches can run in parallel on a machine
+with the memory for it. 3_1A and 3_1B are only run if asked for, as 3_1C no longer needs them
+(see daily_cleaning.py).
+
+Each step has a key, hashed from:
+- its notebook's code, and the source of the Module 1 modules it imports
+  (and the modules they import, including locations.py)
+- its parameters, e.g. year or treat_hh_sum_10Wh
+- the size and modification time of the SERL data it reads (as set in
+  locations.py - for step 2, only the year's monthly climate files, not the
+  rest of the climate directory) and of the outputs of the steps before it.
+A step is skipped if it has run before with the same key and its outputs are
+still as it left them, so e.g. a change to the temperature notebook re-runs
+steps 2, 3_1C and 3_2, but not the electricity extraction. The key and a log of
+each run are kept in Module_1_pipeline_state, in the Module 1 folder.
+
+Parameters are the variables set in the first code cell of a notebook (the
+'Required user input' cell). They're set after that cell runs, so a notebook
+only takes the parameters it has, and keeps its own defaults for the others.
+
+Run this file directly, from any folder (the notebooks are always run in the
+Module 1 folder), e.g.
+    python module_1_pipeline.py 2021
+    python module_1_pipeline.py 2021 --targets 3_1C --set treat_hh_sum_10Wh=by_day
+"""
+import os
+import sys
+import ast
+import glob
+import json
+import hashlib
+import argparse
+import datetime
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+import climate_data
+import locations # This is a separate Python script specifying the locations of all the different SERL data within the SERL secure environment.
+
+MODULE_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+STATE_DIRECTORY = 'Module_1_pipeline_state'
+DEFAULT_TARGETS = ['3_1C', '3_2']
+# The steps run as one, unless the pipeline is split_1_1
+COMBINED_STEPS = {'1_1A': '1_1AB', '1_1B': '1_1AB'}
+
+
+class Step(object):
+    """One notebook of the pipeline: the steps it needs run first, the SERL data it reads (names of settings in
+    locations.py, or functions giving the files it reads for a year) and the outputs it makes (paths or glob patterns,
+    relative to the Module 1 folder, with {year})."""
+
+    def __init__(self, name, notebook, depends_on, data, outputs):
+        self.name = name
+        self.notebook = notebook
+        self.depends_on = depends_on
+        self.data = data
+        self.outputs = outputs
+
+    def output_paths(self, year, directory):
+        '''The outputs for year that exist in directory (the Module 1 folder), relative to it (one pattern may match
+        several, e.g. the same file in another format).'''
+        paths = []
+        for pattern in self.outputs:
+            paths.extend(sorted(os.path.relpath(path, directory)
+                                for path in glob.glob(os.path.join(directory, pattern.format(year=year)))))
+        return paths
+
+    def has_outputs(self, year, directory):
+        return all(len(glob.glob(os.path.join(directory, pattern.format(year=year)))) > 0 for pattern in self.outputs)
+
+
+def climate_files(year):
+    '''The monthly climate data files step 2 reads for year. The climate directory also holds the other years' files.'''
+    return [climate_data.climate_file(month) for month in climate_data.year_months(year)]
+
+
+STEPS = [Step('1_1AB', '1_1AB_Get_gas_and_elec_data.ipynb', [],
+              ['energy_daily_directory', 'energy_hh_directory', 'participant_data_file'],
+              ['Step_1_1_Outputs/Step_1_1A_Gas_{year}_daily.*', 'Step_1_1_Outputs/Step_1_1A_Gas_{year}_hh',
+               'Step_1_1_Outputs/Step_1_1B_Elec_{year}_daily_from_daily.*', 'Step_1_1_Outputs/Step_1_1B_Elec_{year}_hh']),
+         Step('1_1A', '1_1A_Get_gas_data.ipynb', [],
+              ['energy_daily_directory', 'energy_hh_directory', 'participant_data_file'],
+              ['Step_1_1_Outputs/Step_1_1A_Gas_{year}_daily.*', 'Step_1_1_Outputs/Step_1_1A_Gas_{year}_hh']),
+         Step('1_1B', '1_1B_Get_elec_data.ipynb', [],
+              ['energy_daily_directory', 'energy_hh_directory', 'participant_data_file'],
+              ['Step_1_1_Outputs/Step_1_1B_Elec_{year}_daily_from_daily.*', 'Step_1_1_Outputs/Step_1_1B_Elec_{year}_hh']),
+         Step('1_1C', '1_1C_Calc_elec_daily_data_from_hh.ipynb', ['1_1B'],
+              ['bst_dates'],
+              ['Step_1_1_Outputs/Step_1_1C_Elec_{year}_daily_from_hh.csv',
+               'Step_1_1_Outputs/Step_1_1C_Elec_{year}_list_of_exporter_puprns.csv']),
+         Step('2', '2_Get_temperature_data.ipynb', [],
+              [climate_files, 'participant_data_file'],
+              ['Step_2_Outputs/Step_2_Temp_{year}_daily.csv', 'Step_2_Outputs/Step_2_Temp_{year}_hh.npy',
+               'Step_2_Outputs/Step_2_Temp_{year}_hh_index.json']),
+         Step('3_1A', '3_1A_Gas_daily_data.ipynb', ['1_1A'],
+              [],
+              ['Step_3_1_Outputs/Step_3_1A_Gas_{year}_daily.csv']),
+         Step('3_1B', '3_1B_Elec_daily_data.ipynb', ['1_1B', '1_1C'],
+              [],
+              ['Step_3_1_Outputs/Step_3_1B_Elec_{year}_daily.csv']),
+         Step('3_1C', '3_1C_Finalise_daily_data.ipynb', ['1_1A', '1_1B', '1_1C', '2'],
+              ['participant_data_file'],
+              ['Module_1_final_outputs/annual_report_sm_daily_{year}.csv',
+               'Module_1_final_outputs/annual_report_sm_daily_{year}_arrays.npz',
+               'Step_3_1_Outputs/Step_3_1_Elec_{year}_days_of_10Wh.csv']),
+         Step('3_2', '3_2_Finalise_hh_data.ipynb', ['1_1A', '1_1B', '2'],
+              ['participant_data_file'],
+              ['Module_1_final_outputs/hh_{year}', 'Module_1_final_outputs/Report_on_hh_data_{year}.csv'])]
+
+
+def notebook_cells(path):
+    '''The source of each code cell of a notebook.'''
+    with open(path, encoding='utf-8') as f:
+        notebook = json.load(f)
+    return [''.join(cell['source']) for cell in notebook['cells'] if cell['cell_type'] == 'code']
+
+
+def assigned_names(source):
+    '''The names assigned to in some python source (e.g. the parameters of a notebook's first cell).'''
+    names = []
+    for node in ast.walk(ast.parse(source)):
+        if isinstance(node, ast.Name) and isinstance(node.ctx, ast.Store):
+            names.append(node.id)
+    return names
+
+
+def _as_type_of(value, default):
+    # year is a string in some notebooks and a number in others, so parameters take the type of the notebook's value
+    if isinstance(default, (str, int, float)) and not isinstance(default, bool) and not isinstance(value, bool):
+        return type(default)(value)
+    return value
+
+
+def run_notebook(path, params):
+    '''Run the code cells of a notebook in order, in this process, setting params (a dict) after the first cell.'''
+    cells = notebook_cells(path)
+    namespace = {'__name__': '__main__'}
+    for i, source in enumerate(cells):
+        exec(compile(source, path+' cell '+str(i+1), 'exec'), namespace)
+        if i == 0:
+            for name, value in params.items():
+                if name in namespace:
+                    namespace[name] = _as_type_of(value, namespace[name])
+
+
+def imported_modules(source, directory=MODULE_DIRECTORY, found=None):
+    '''The Module 1 modules (files in directory) imported by some python source, and by those modules in turn.'''
+    if found is None:
+        found = set()
+    for node in ast.walk(ast.parse(source)):
+        if isinstance(node, ast.Import):
+            names = [alias.name for alias in node.names]
+        elif isinstance(node, ast.ImportFrom) and node.module is not None:
+            names = [node.module]
+        else:
+            continue
+        for name in names:
+            path = os.path.join(directory, name.split('.')[0]+'.py')
+            if name not in found and os.path.exists(path):
+                found.add(name)
+                with open(path, encoding='utf-8') as f:
+                    imported_modules(f.read(), directory, found)
+    return found
+
+
+def fingerprint(path):
+    '''The size and modification time of a file, or of every file in a directory (recursively).'''
+    if os.path.isdir(path):
+        files = []
+        for root, dirs, filenames in os.walk(path):
+            dirs.sort()
+            for filename in sorted(filenames):
+                stat = os.stat(os.path.join(root, filename))
+                files.append([os.path.relpath(os.path.join(root, filename), path), stat.st_size, stat.st_mtime])
+        return files
+    if os.path.exists(path):
+        stat = os.stat(path)
+        return [stat.st_size, stat.st_mtime]
+    return None
+
+
+def data_path(setting):
+    '''The path of the SERL data named setting in locations.py, or None if it isn't set.'''
+    value = getattr(locations, setting, None)
+    if value is None:
+        return None
+    return os.path.join(locations.serl_data_path, value)
+
+
+class Pipeline(object):
+    """The Module 1 steps for one year, with params for the notebooks. Unless split_1_1, the steps in COMBINED_STEPS
+    are run as the one step that combines them."""
+
+    def __init__(self, year, params=None, steps=STEPS, module_directory=MODULE_DIRECTORY, state_directory=STATE_DIRECTORY,
+                 split_1_1=False):
+        self.year = year
+        self.params = dict(params or {}, year=year)
+        self.combined = {} if split_1_1 else COMBINED_STEPS
+        if split_1_1:
+            steps = [step for step in steps if step.name not in COMBINED_STEPS.values()]
+        else:
+            steps = [Step(step.name, step.notebook, self._depends_on(step), step.data, step.outputs) for step in steps
+                     if step.name not in COMBINED_STEPS]
+        self.steps = {step.name: step for step in steps}
+        self.module_directory = module_directory
+        # Relative to the module directory, like the outputs, so it doesn't depend on where the pipeline is run from
+        self.state_directory = os.path.join(module_directory, state_directory)
+
+    def _depends_on(self, step):
+        # The steps step needs, with any that are combined replaced by the step that combines them
+        depends_on = []
+        for name in step.depends_on:
+            name = self.combined.get(name, name)
+            if name not in depends_on:
+                depends_on.append(name)
+        return depends_on
+
+    def required(self, targets):
+        '''The targets and every step they need, in the order they're listed in the pipeline.'''
+        needed = set()
+        to_visit = [self.combined.get(name, name) for name in targets]
+        while len(to_visit) > 0:
+            name = to_visit.pop()
+            if name not in self.steps:
+                raise ValueError("There's no step "+name+" - the steps are "+", ".join(self.steps))
+            if name not in needed:
+                needed.add(name)
+                to_visit.extend(self.steps[name].depends_on)
+        return [name for name in self.steps if name in needed]
+
+    def step_params(self, step):
+        '''The params the step's notebook takes (those set in its first cell).'''
+        cells = notebook_cells(os.path.join(self.module_directory, step.notebook))
+        names = assigned_names(cells[0])
+        return {name: value for name, value in self.params.items() if name in names}
+
+    def key(self, step):
+        '''The hash of everything the step's outputs depend on (see the top of this file).'''
+        cells = notebook_cells(os.path.join(self.module_directory, step.notebook))
+        modules = {}
+        for name in sorted(imported_modules('\n'.join(cells), self.module_directory)):
+            with open(os.path.join(self.module_directory, name+'.py'), 'rb') as f:
+                modules[name] = hashlib.sha1(f.read()).hexdigest()
+        description = {'code': cells,
+                       'modules': modules,
+                       'params': self.step_params(step),
+                       'serl_data_version': str(getattr(locations, 'serl_data_version', '')),
+                       'data': self.data_fingerprints(step),
+                       'upstream': {name: self.outputs_fingerprint(self.steps[name]) for name in step.depends_on}}
+        return hashlib.sha1(json.dumps(description, sort_keys=True, default=str).encode()).hexdigest()
+
+    def data_fingerprints(self, step):
+        '''The fingerprint of the SERL data the step reads, by setting in locations.py (or by file).'''
+        fingerprints = {}
+        for data in step.data:
+            if callable(data):
+                for path in data(self.year):
+                    fingerprints[path] = fingerprint(path)
+            elif data_path(data) is not None:
+                fingerprints[data] = fingerprint(data_path(data))
+        return fingerprints
+
+    def record_path(self, step):
+        return os.path.join(self.state_directory, step.name+'_'+str(self.year)+'.json')
+
+    def log_path(self, step):
+        return os.path.join(self.state_directory, step.name+'_'+str(self.year)+'.log')
+
+    def outputs_fingerprint(self, step):
+        return json.loads(json.dumps({path: fingerprint(os.path.join(self.module_directory, path))
+                                      for path in step.output_paths(self.year, self.module_directory)}))
+
+    def is_up_to_date(self, step, key):
+        '''Whether the step last ran with this key and its outputs haven't changed since.'''
+        if not os.path.exists(self.record_path(step)) or not step.has_outputs(self.year, self.module_directory):
+            return False
+        with open(self.record_path(step)) as f:
+            record = json.load(f)
+        return record['key'] == key and record['outputs'] == self.outputs_fingerprint(step)
+
+    def run_step(self, step):
+        '''Run the step's notebook in a new python process, logging its output. Returns whether it succeeded.'''
+        command = [sys.executable, os.path.abspath(__file__), '--notebook', os.path.join(self.module_directory, step.notebook),
+                   '--params', json.dumps(self.step_params(step))]
+        with open(self.log_path(step), 'w') as log:
+            result = subprocess.run(command, stdout=log, stderr=subprocess.STDOUT, cwd=self.module_directory)
+        return result.returncode == 0
+
+    def _save_record(self, step, key):
+        with open(self.record_path(step), 'w') as f:
+            json.dump({'key': key, 'params': self.step_params(step), 'outputs': self.outputs_fingerprint(step),
+                       'finished': datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")}, f, indent=1)
+
+    def run(self, targets=DEFAULT_TARGETS, force=[], n_workers=1):
+        '''Bring targets (and the steps they need) up to date, running up to n_workers notebooks at once. Steps in force
+        are run even if they're up to date. Returns the status of each step.'''
+        if not os.path.exists(self.state_directory):
+            os.makedirs(self.state_directory)
+        to_do = self.required(targets)
+        force = [self.combined.get(name, name) for name in force]
+        status = {}
+        running = {}
+        with ThreadPoolExecutor(max_workers=n_workers) as pool:
+            while len(to_do) > 0 or len(running) > 0:
+                for name in list(to_do):
+                    step = self.steps[name]
+                    if any(status.get(dep) in ['failed', 'not run'] for dep in step.depends_on):
+                        print(name, "not run, as a step it needs failed")
+                        status[name] = 'not run'
+                        to_do.remove(name)
+                    elif (all(status.get(dep) in ['up to date', 'ran'] for dep in step.depends_on)
+                          and len(running) < n_workers):
+                        to_do.remove(name)
+                        key = self.key(step)
+                        if name not in force and self.is_up_to_date(step, key):
+                            print(name, "is up to date - skipped")
+                            status[name] = 'up to date'
+                        else:
+                            print(name, "started ("+step.notebook+", logging to "+self.log_path(step)+")")
+                            running[pool.submit(self.run_step, step)] = (step, key)
+                if len(running) == 0:
+                    continue
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    step, key = running.pop(future)
+                    if future.result():
+                        # The key is saved from before the run, so the next run sees any change made since it started
+                        self._save_record(step, key)
+                        status[step.name] = 'ran'
+                        print(step.name, "finished")
+                    else:
+                        status[step.name] = 'failed'
+                        print(step.name, "FAILED - see", self.log_path(step))
+        return {name: status[name] for name in self.required(targets)}
+
+
+def _parse_params(settings):
+    # name=value pairs, with values read as python literals where they can be (e.g. numbers and lists)
+    params = {}
+    for setting in settings:
+        name, value = setting.split('=', 1)
+        try:
+            params[name] = ast.literal_eval(value)
+        except (ValueError, SyntaxError):
+            params[name] = value
+    return params
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the Module 1 notebooks for a year, skipping steps that are up to "
+                                                 "date")
+    parser.add_argument('year', nargs='?')
+    parser.add_argument('--targets', nargs='+', default=DEFAULT_TARGETS,
+                        help="Steps to bring up to date, with the steps they need (default: "+" ".join(DEFAULT_TARGETS)+")")
+    parser.add_argument('--force', nargs='+', default=[], help="Steps to run even if they're up to date")
+    parser.add_argument('--set', nargs='+', default=[], metavar='NAME=VALUE',
+                        help="Other notebook parameters, e.g. treat_hh_sum_10Wh=by_day or sample=0.01")
+    parser.add_argument('--n_workers', type=int, default=1,
+                        help="How many notebooks to run at once (default 1 - each one uses the whole machine)")
+    parser.add_argument('--split_1_1', action='store_true',
+                        help="Run notebooks 1_1A and 1_1B as separate steps, rather than 1_1AB")
+    # Used by the pipeline itself, to run one notebook in its own process
+    parser.add_argument('--notebook', help=argparse.SUPPRESS)
+    parser.add_argument('--params', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.notebook is not None:
+        sys.path.insert(0, MODULE_DIRECTORY)
+        run_notebook(args.notebook, json.loads(args.params))
+        return
+    if args.year is None:
+        parser.error("the year is required")
+    pipeline = Pipeline(int(args.year), _parse_params(args.set), split_1_1=args.split_1_1)
+    status = pipeline.run(args.targets, args.force, args.n_workers)
+    print("\n".join(name+": "+state for name, state in status.items()))
+    if 'failed' in status.values():
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
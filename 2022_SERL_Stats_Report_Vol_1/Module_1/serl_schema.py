@@ -0,0 +1,67 @@
+"""
+Declared dtypes for the SERL edition 4 data files
+
+Without these, pandas and dask infer int64 for the read flags, float64 for the
+energy columns and object for PUPRN, which is several times the memory the
+values need. Columns are declared here once and applied by the data picker, the
+Module 1 notebooks and the Module 2 readers:
+- read flags and half hour numbers as nullable Int8, and the True/False columns
+  as nullable boolean (nullable so a missing value doesn't stop the file loading)
+- the electricity Wh columns as float32. Their values are whole Wh, which
+  float32 holds exactly up to ~16.7 million, so nothing is lost. Gas Wh, kWh and
+  m3 columns have fractional values and are left as float64.
+- PUPRN as a categorical, for frames that are held in memory and filtered or
+  grouped by PUPRN. Use observed=True when grouping by it.
+- Read_date_effective_local and Read_date_time_UTC can be parsed as dates.
+  Read_date_time_local has a GMT/BST suffix, so it's left as a string.
+"""
+import pandas as pd
+
+FLAG_COLUMNS = ['Gas_flag', 'Elec_act_imp_flag', 'Elec_act_exp_flag', 'Elec_react_imp_flag', 'Elec_react_exp_flag',
+                'Elec_act_net_flag']
+BOOL_COLUMNS = ['Valid_read_time', 'Gas_sum_match']
+FLOAT32_COLUMNS = ['Elec_act_imp_hh_Wh', 'Elec_act_exp_hh_Wh', 'Elec_act_net_hh_Wh', 'Elec_react_imp_hh_varh',
+                   'Elec_react_exp_hh_varh', 'Elec_act_imp_d_Wh', 'Elec_act_net_hh_sum_Wh', 'Elec_act_imp_hh_sum_Wh']
+FLOAT64_COLUMNS = ['Gas_hh_Wh', 'Gas_d_kWh', 'Gas_hh_sum_m3', 'Gas_hh_sum_kWh']
+SMALL_INT_COLUMNS = ['HH', 'Readings_from_midnight_local']
+DATE_COLUMNS = ['Read_date_effective_local']
+DATETIME_COLUMNS = ['Read_date_time_UTC']
+
+SMART_METER_DTYPES = {}
+SMART_METER_DTYPES.update({col: 'Int8' for col in FLAG_COLUMNS})
+SMART_METER_DTYPES.update({col: 'boolean' for col in BOOL_COLUMNS})
+SMART_METER_DTYPES.update({col: 'float32' for col in FLOAT32_COLUMNS})
+SMART_METER_DTYPES.update({col: 'float64' for col in FLOAT64_COLUMNS})
+SMART_METER_DTYPES.update({col: 'Int8' for col in SMALL_INT_COLUMNS})
+
+
+def dtypes(columns=None, categorical_puprn=False):
+    '''The dtypes to pass to read_csv for the given columns (all known columns if columns is None). PUPRN is only
+    made categorical if categorical_puprn is True - leave it off when frames from different files are going to be
+    merged or concatenated, as their categories won't match.'''
+    declared = dict(SMART_METER_DTYPES)
+    if categorical_puprn:
+        declared['PUPRN'] = 'category'
+    if columns is None:
+        return declared
+    return {col: dtype for col, dtype in declared.items() if col in columns}
+
+
+def parse_dates(columns):
+    '''The columns to pass to read_csv's parse_dates, out of the given columns.'''
+    return [col for col in DATE_COLUMNS+DATETIME_COLUMNS if col in columns]
+
+
+def apply_schema(data, categorical_puprn=False):
+    '''Convert the known columns of an already loaded (pandas or dask) dataframe to their declared dtypes.'''
+    declared = dtypes(data.columns, categorical_puprn)
+    declared = {col: dtype for col, dtype in declared.items() if str(data[col].dtype) != dtype}
+    if len(declared) == 0:
+        return data
+    return data.astype(declared)
+
+
+def puprn_categorical(puprns):
+    '''Convert a (pandas) Series of PUPRNs to a categorical whose categories are in sorted order, so sorting by it
+    gives the same order as sorting the strings.'''
+    return puprns.astype(pd.CategoricalDtype(sorted(puprns.dropna().unique())))
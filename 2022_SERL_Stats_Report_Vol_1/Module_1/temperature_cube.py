@@ -0,0 +1,106 @@
+"""
+Half-hourly temperature cube (from step 2, for step 3.2)
+
+The half-hourly temperatures for a year are saved as one float32 matrix, with
+a row per grid cell and a column per half-hour slot (UTC), in numpy's .npy
+format, plus a small json index naming the grid cell of each row and giving the
+time of the first slot. This is around a tenth of the size of the same data as
+a long csv, which repeats the grid cell and timestamp on every row.
+
+The matrix is memory-mapped when it's opened, so only the rows used are read
+from disk, and a home's temperatures are its grid cell's row, picked out at the
+slots of its timestamps, rather than a merge with the whole table.
+"""
+import os
+import json
+import numpy as np
+import pandas as pd
+
+SLOT = pd.Timedelta(minutes=30)
+
+
+def _utc_naive(times):
+    # Times as a naive UTC DatetimeIndex (the cube's times are UTC)
+    times = pd.DatetimeIndex(times)
+    if times.tz is not None:
+        times = times.tz_convert('UTC').tz_localize(None)
+    return times
+
+
+class TemperatureCube(object):
+    """temp_C as a grid_cell x half-hour slot matrix"""
+
+    def __init__(self, grid_cells, first_slot, values):
+        self.grid_cells = list(grid_cells)
+        self.first_slot = pd.Timestamp(first_slot)
+        self.values = values
+        self._rows = {grid_cell: row for row, grid_cell in enumerate(self.grid_cells)}
+
+    @property
+    def n_slots(self):
+        return self.values.shape[1]
+
+    @property
+    def times(self):
+        return pd.date_range(self.first_slot, periods=self.n_slots, freq=SLOT)
+
+    @classmethod
+    def from_frame(cls, temperature_data_hh):
+        '''Make the cube from long half-hourly data indexed by grid_cell and date_time_utc, with a temp_C column (as
+        made in step 2 - see climate_data.ClimateData.half_hourly).'''
+        grid_cells = temperature_data_hh.index.get_level_values('grid_cell').unique()
+        times = _utc_naive(temperature_data_hh.index.get_level_values('date_time_utc'))
+        first_slot = times.min()
+        n_slots = int((times.max()-first_slot)/SLOT)+1
+        slots = (times-first_slot)/SLOT
+        if not np.array_equal(slots, np.floor(slots)):
+            raise ValueError("The temperature data isn't all on the half-hour.")
+        values = np.full((len(grid_cells), n_slots), np.nan, dtype=np.float32)
+        values[grid_cells.get_indexer(temperature_data_hh.index.get_level_values('grid_cell')),
+               slots.astype(int)] = temperature_data_hh.temp_C.values
+        return cls(grid_cells, first_slot, values)
+
+    @staticmethod
+    def paths(directory, name):
+        return os.path.join(directory, name+'.npy'), os.path.join(directory, name+'_index.json')
+
+    def save(self, directory, name):
+        '''Save as name.npy (the matrix) and name_index.json (the grid cells and slot times) in directory.'''
+        values_path, index_path = self.paths(directory, name)
+        np.save(values_path, self.values)
+        with open(index_path, 'w') as f:
+            json.dump({'grid_cells': self.grid_cells,
+                       'first_slot_utc': str(self.first_slot),
+                       'slot_minutes': int(SLOT/pd.Timedelta(minutes=1)),
+                       'n_slots': self.n_slots}, f, indent=1)
+
+    @classmethod
+    def open(cls, directory, name):
+        '''Open a cube saved with save, memory-mapping the matrix.'''
+        values_path, index_path = cls.paths(directory, name)
+        with open(index_path) as f:
+            index = json.load(f)
+        return cls(index['grid_cells'], index['first_slot_utc'], np.load(values_path, mmap_mode='r'))
+
+    def slots(self, times):
+        '''The slot (column) of each of times, or -1 for times that aren't in the cube.'''
+        offsets = np.asarray((_utc_naive(times)-self.first_slot)/SLOT, dtype=float)
+        slots = np.floor(np.nan_to_num(offsets, nan=-1)).astype(int)
+        slots[(offsets != slots) | (slots >= self.n_slots)] = -1
+        return slots
+
+    def temperatures(self, grid_cell, times):
+        '''temp_C for grid_cell at each of times, as a float32 array (Nan where the cube has no temperature).'''
+        result = np.full(len(times), np.nan, dtype=np.float32)
+        row = self._rows.get(grid_cell)
+        if row is None:
+            return result
+        slots = self.slots(times)
+        found = slots >= 0
+        result[found] = self.values[row][slots[found]]
+        return result
+
+    def to_frame(self):
+        '''The long layout of the temperature data: temp_C indexed by grid_cell and date_time_utc.'''
+        index = pd.MultiIndex.from_product([self.grid_cells, self.times], names=['grid_cell', 'date_time_utc'])
+        return pd.DataFrame({'temp_C': np.asarray(self.values).ravel()}, index=index)
@@ -15,11 +15,19 @@ import warnings
 import time
 import matplotlib.pyplot as plt
 
+try:
+    # Shared cache of the parsed SERL contextual data files (Module_1 needs to be on the python path)
+    import contextual_data_cache
+    read_contextual = contextual_data_cache.read_contextual
+except ImportError:
+    def read_contextual(path):
+        return pd.read_csv(path, low_memory=False)
+
 ed_4_path = ''
 
-serl_survey = pd.read_csv(ed_4_path+ 'serl_survey_data_edition04.csv')
-epc = pd.read_csv(ed_4_path+ 'serl_epc_data_edition04.csv')
-participant = pd.read_csv(ed_4_path+ 'serl_participant_summary_edition04.csv')
+serl_survey = read_contextual(ed_4_path+ 'serl_survey_data_edition04.csv')
+epc = read_contextual(ed_4_path+ 'serl_epc_data_edition04.csv')
+participant = read_contextual(ed_4_path+ 'serl_participant_summary_edition04.csv')
 exporters_path = ''
 exporters = pd.read_csv(exporters_path + 'Elec_2021_list_of_exporter_puprns.csv', header = None)
 # OCCUPANT
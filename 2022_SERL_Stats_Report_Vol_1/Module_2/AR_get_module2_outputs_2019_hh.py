@@ -24,6 +24,7 @@ year = 2019
 hh_data_path = mod_1_output_path + ''
 output_data_path = working_path + ''
 os.chdir(working_path)
+mod2.carry_sample_spec(mod_1_output_path, output_data_path)
 
 puprn_summary_hh = mod2.get_hh_means_all_puprn(hh_data_path)
 puprn_summary_hh.to_csv(output_data_path + 'Annual_report_sm_monthly_mean_hh_profiles_' + str(year) + '.csv', index = False)
@@ -24,6 +24,7 @@ year = 2020
 hh_data_path = mod_1_output_path + ''
 output_data_path = working_path + ''
 os.chdir(working_path)
+mod2.carry_sample_spec(mod_1_output_path, output_data_path)
 
 puprn_summary_daily = mod2.get_daily_means_all_puprn(daily_data_path, year)
 puprn_summary_daily.to_csv(output_data_path + 'Annual_report_sm_monthly_mean_daily_consumption_' + str(year) + '.csv', index = False)
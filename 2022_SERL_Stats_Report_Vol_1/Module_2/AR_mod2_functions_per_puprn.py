@@ -14,6 +14,37 @@ import os
 import warnings
 import time
 import sys
+try:
+    # Declared dtypes for the SERL data (Module_1 needs to be on the python path)
+    import serl_schema
+except ImportError:
+    serl_schema = None
+try:
+    # Reads the Module 1 outputs in whichever format they were saved (Module_1 needs to be on the python path)
+    import data_picker_formats
+except ImportError:
+    data_picker_formats = None
+try:
+    # Notes when the Module 1 outputs were made from a sample of homes (Module_1 needs to be on the python path)
+    import data_picker_sampling
+except ImportError:
+    data_picker_sampling = None
+
+
+def read_data_file(path, **kwargs):
+    '''Read a Module 1 output file - csv, or any of the other formats the data picker can save in if Module_1 is on
+    the python path'''
+    if data_picker_formats is None:
+        return pd.read_csv(path, **kwargs)
+    return data_picker_formats.read_frame(path, **kwargs)
+
+
+def carry_sample_spec(mod_1_output_path, output_data_path):
+    '''If the Module 1 outputs were made from a sample of homes (see data_picker_sampling), note it with the Module 2
+    outputs too, and return the sample. Returns None for outputs from all homes.'''
+    if data_picker_sampling is None:
+        return None
+    return data_picker_sampling.carry_sample_spec(mod_1_output_path, output_data_path)
 
 
 def get_missing_data_threshold(fuel_type, month= np.nan, Hh=np.nan, temperature_banding = False):
@@ -26,7 +57,8 @@ def get_missing_data_threshold(fuel_type, month= np.nan, Hh=np.nan, temperature_
 def get_hh_means_for_one_puprn(hh_data_path, hh_files, file_n, temperature_banding = False):
     '''Summarise the half hourly data for one PUPRN, return lists storing required data'''
     # get data for this puprn and convert the dates to a format we can use            
-    puprn_i_hh_data = pd.read_csv(hh_data_path + hh_files[file_n])
+    puprn_i_hh_data = read_data_file(hh_data_path + hh_files[file_n],
+                                  dtype = serl_schema.dtypes() if serl_schema is not None else None)
     puprn_i_hh_data['Read_date_effective_local'] = pd.to_datetime(puprn_i_hh_data['Read_date_effective_local'])
     puprn_i_hh_data['month_of_consumption'] = puprn_i_hh_data['Read_date_effective_local'].dt.month
     Hh_column = 'Readings_from_midnight_local'
@@ -265,12 +297,19 @@ def get_daily_means_all_puprn(daily_data_path, year, temperature_banding = False
     temperature band'''
     # find relevant file
     daily_dir = os.listdir(daily_data_path)
-    daily_csvs = list(filter(lambda f: f.endswith('.csv'), daily_dir))
+    if data_picker_formats is None:
+        daily_csvs = list(filter(lambda f: f.endswith('.csv'), daily_dir))
+    else:
+        daily_csvs = list(filter(data_picker_formats.is_data_file, daily_dir))
     daily_files = list(filter(lambda f: str(year) in f, daily_csvs))
+    # Module 1 also saves its lists and reports of PUPRNs with errors here - use the daily data file if there is one
+    daily_files = sorted(daily_files, key = lambda f: not f.startswith('annual_report_sm_daily'))
     # keep track of processing time
     start = time.process_time()
     # load data and convert date type as required
-    daily_data = pd.read_csv(daily_data_path + daily_files[0], parse_dates =[1], infer_datetime_format = True)
+    # PUPRN is held as a categorical - the data is filtered on it once per PUPRN below
+    daily_data = read_data_file(daily_data_path + daily_files[0], parse_dates =[1], infer_datetime_format = True,
+                             dtype = serl_schema.dtypes(categorical_puprn = True) if serl_schema is not None else None)
     daily_data['month'] = daily_data['Read_date_effective_local'].dt.month
     daily_data['day_of_week'] = daily_data.Read_date_effective_local.dt.dayofweek
     
@@ -15,6 +15,16 @@ import numpy as np
 from datetime import datetime
 import matplotlib.pyplot as plt
 import warnings
+try:
+    # Shared cache of the parsed SERL contextual data files (Module_1 needs to be on the python path)
+    import contextual_data_cache
+except ImportError:
+    contextual_data_cache = None
+try:
+    # Notes when the module 2 outputs were made from a sample of homes (Module_1 needs to be on the python path)
+    import data_picker_sampling
+except ImportError:
+    data_picker_sampling = None
 
 #%%
 class Module3:
@@ -23,6 +33,9 @@ class Module3:
         self.m1_output_path = m1_output_path #<--- location of module 2 outputs to load
         self.save_path = save_path #<--- location to save module 3 outputs
         self.serl_data_path = serl_data_path #<--- location of serl data to load
+        self.sample_spec = None #<--- the sample of homes the module 1 and 2 outputs were made from, if any
+        if data_picker_sampling is not None:
+            self.sample_spec = data_picker_sampling.carry_sample_spec(m2_output_path, save_path)
         self.my_input_data = {}
         self.my_output_df = pd.DataFrame(columns=['fuel',
                                                   'unit',
@@ -82,18 +95,24 @@ class Module3:
             pd.read_csv(self.m2_output_path + file_name)
         
         
+    def read_contextual_file(self, file_name):
+        # Use the cached copy shared with the data picker if Module_1 is available
+        if contextual_data_cache is not None:
+            return contextual_data_cache.read_contextual(self.serl_data_path+file_name)
+        return pd.read_csv(self.serl_data_path+file_name, low_memory=False)
+        
     def load_contextual(self):
         file_name = 'serl_epc_data_edition04.csv'
-        self.my_input_data['epc'] = pd.read_csv(self.serl_data_path+file_name)
+        self.my_input_data['epc'] = self.read_contextual_file(file_name)
         
         file_name = 'serl_survey_data_edition04.csv'
-        self.my_input_data['serl_survey'] = pd.read_csv(self.serl_data_path+file_name)
+        self.my_input_data['serl_survey'] = self.read_contextual_file(file_name)
         
         file_name = 'serl_participant_summary_edition04.csv'
-        self.my_input_data['participant'] = pd.read_csv(self.serl_data_path+file_name)
+        self.my_input_data['participant'] = self.read_contextual_file(file_name)
         
         file_name = 'serl_smart_meter_rt_summary_edition04.csv'
-        self.my_input_data['read_type'] = pd.read_csv(self.serl_data_path+file_name)
+        self.my_input_data['read_type'] = self.read_contextual_file(file_name)
         
     def preprocess_total_energy_data(self, year:str, heating_season: bool):
         # Module 2 naively calculates total energy consumption as total of 
@@ -1162,6 +1181,9 @@ class Module3:
     def export_data(self, year:str):
 
         self.my_output_df.to_csv(self.save_path+'m3_outputs'+year+'.csv', index = False)
+        if self.sample_spec is not None:
+            warnings.warn('These outputs are from a sample of homes (' + self.sample_spec['description'] + \
+                          ') - only use them for checking the pipeline, not for reporting.')
 #%%
 def run_year(m2_output_path, 
              m1_output_path,